@@ -1,18 +1,214 @@
 #!/usr/bin/env python
 
-from quoboard import up, right, down, left, vdir, logging
-import quoboard
-import copy, random
+from quoboard import up, right, down, left, vdir, logging, pawn_move, move_to_str
+import quoboard, quotrace, quosnapshot
+import copy, random, time
+import multiprocessing
 from collections import deque
 
+# Larger than any loss
+infinity = 9999999
+
+class SearchTimeout(Exception):
+    """Raised when the time budget of a search is exhausted."""
+    pass
+
+class TranspositionTable:
+    """Bounded transposition table.
+
+    Entries are (key, depth, value, bound, move) tuples, stored in a fixed
+    number of buckets indexed by the position key. When two positions fall in
+    the same bucket, the replacement policy decides which one is kept:
+    "always" keeps the newest entry, "depth" keeps the entry searched to the
+    largest depth."""
+
+    exact = 0
+    lower = 1
+    upper = 2
+
+    def __init__(self, size=1 << 16, replace='depth'):
+        if replace != 'always' and replace != 'depth':
+            logging.critical('Replacement policy must be always or depth')
+            raise
+        self.size = size
+        self.replace = replace
+        self.clear()
+
+    def clear(self):
+        self.entries = [None] * self.size
+
+    def probe(self, key):
+        """Return the entry stored for key, or None"""
+        e = self.entries[key % self.size]
+        if e is not None and e[0] == key:
+            return e
+        return None
+
+    def store(self, key, depth, value, bound, move):
+        i = key % self.size
+        e = self.entries[i]
+        if e is None or self.replace == 'always' or e[0] == key or depth >= e[1]:
+            self.entries[i] = (key, depth, value, bound, move)
+
+class SearchStats:
+    """Counters and timers of a search.
+
+    Collected only if the engine is created with stats=True. Times are in
+    seconds; the distance update time is spent repairing the distance
+    fields during the search (see ServerBoard.player_dists). The per-ply lists are indexed by the distance from the
+    root, ply 0 being my move."""
+
+    def __init__(self):
+        self.nodes = 0
+        self.evaluations = 0
+        self.cutoffs = 0
+        self.tt_hits = 0
+        self.barrier_checks = 0
+        self.illegal_barriers = 0
+        self.depth = 0
+        self.move_gen_time = 0.
+        self.dist_update_time = 0.
+        self.eval_time = 0.
+        self.total_time = 0.
+        # Interior nodes and legal moves searched, per ply
+        self.expanded = []
+        self.children = []
+
+    def expand(self, ply, nchildren, nodes=1):
+        """Record nodes at the given ply, with nchildren legal moves in
+        total"""
+        while len(self.expanded) <= ply:
+            self.expanded.append(0)
+            self.children.append(0)
+        self.expanded[ply] += nodes
+        self.children[ply] += nchildren
+
+    def branching(self):
+        """Return the mean branching factor per ply"""
+        return [ float(c) / e if e else 0. for e, c in zip(self.expanded, self.children) ]
+
+    def merge(self, other):
+        """Add the counts of other (e.g. from a worker process)"""
+        for name in ['nodes', 'evaluations', 'cutoffs', 'tt_hits',
+                'barrier_checks', 'illegal_barriers', 'move_gen_time',
+                'dist_update_time', 'eval_time']:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for ply in range(len(other.expanded)):
+            self.expand(ply, other.children[ply], other.expanded[ply])
+
+    def as_dict(self):
+        d = dict(self.__dict__)
+        d['branching'] = self.branching()
+        return d
+
+# Engine used by a search worker process, and snapshot of the position
+# its board holds
+worker_engine = None
+worker_snapshot = None
+
+def init_worker(engine, bound):
+    """Set up a search worker process.
+
+    Workers are forked from the process owning the engine and keep their
+    copy of it, with its transposition table, for the lifetime of the pool.
+    The positions to search are sent as snapshots (see quosnapshot)."""
+    global worker_engine
+    worker_engine = engine
+    engine.bound = bound
+    engine.in_worker = True
+
+def search_root_move(args):
+    """Search one of my moves in a worker process.
+
+    args is (snapshot, board_class, enemy, deadline, m, depth), enemy being
+    the seat of the enemy chosen by the engine. Returns the move, its loss
+    and whether the loss is exact (it may be a lower bound if the search was
+    cut by the shared bound) and the search statistics (None if they are
+    not collected), or None if the time ran out."""
+    global worker_snapshot
+    snapshot, board_class, enemy, deadline, m, depth = args
+    engine = worker_engine
+    if snapshot != worker_snapshot:
+        # The moves of a position are usually searched by the same workers,
+        # which load it only once
+        engine.board = quosnapshot.loads(snapshot, board_class)
+        engine.identify_me_and_others()
+        worker_snapshot = snapshot
+    engine.set_enemy(engine.board.pp[enemy])
+    engine.deadline = deadline
+    if engine.collect_stats:
+        engine.stats = SearchStats()
+    try:
+        return (m,) + engine.search_root_move(m, depth) + (engine.stats,)
+    except SearchTimeout:
+        return None
+
 class QuoAIEngine:
     """AI engine."""
 
-    def __init__(self, h):
-        self.h = h
+    # Loss associated with a pawn reaching its goal during the search
+    win_loss = 10000
+
+    def __init__(self, seat, tt_size=1 << 16, tt_replace='depth', max_time=None, max_depth=32, mode='paranoid', workers=1, stats=False, book=None, prune=True, max_barriers=None):
+        """The engine plays for the pawn of player seat (its index in the
+        pawns of the board).
+
+        If max_time (in seconds) is given, the engine searches to
+        increasing depths until the time is over (iterative deepening).
+        Otherwise it searches my move followed by one reply for each of the
+        other pawns.
+
+        With 3 or 4 players, mode selects the search algorithm: "paranoid"
+        (all the other pawns play against me, alpha-beta search) or "maxn"
+        (each pawn minimises its own loss). 2-player games always use
+        alpha-beta.
+
+        If workers > 1, my moves are searched in parallel by a pool of
+        worker processes, sharing the best loss found so far as a bound.
+        The pool is started by the first search and kept until close() is
+        called.
+
+        If stats is true, the statistics of the last search are available
+        in self.stats as a SearchStats object. Otherwise self.stats is None
+        and nothing is collected.
+
+        book is an optional quobook.OpeningBook, consulted before
+        searching.
+
+        If prune is true, the barriers that leave all the distances unchanged
+        are not searched (see possible_moves). If max_barriers is set, at
+        most that many barriers are searched per node, taken from a single
+        shortest path of each other pawn: on large boards, the branching
+        factor and the work per node then do not grow with the square of
+        the side."""
+        if mode != 'paranoid' and mode != 'maxn':
+            logging.critical('Search mode must be paranoid or maxn')
+            raise
+        self.seat = seat
+        self.tt = TranspositionTable(tt_size, tt_replace)
+        self.max_time = max_time
+        self.max_depth = max_depth
+        self.mode = mode
+        self.workers = workers
+        self.pool = None
+        self.in_worker = False
+        self.deadline = None
+        self.collect_stats = stats
+        self.book = book
+        self.prune = prune
+        self.max_barriers = max_barriers
+        self.stats = None
+        # Keys describing the search context (who moves next, who is the
+        # enemy, max-n search), mixed with the board hash to get the table
+        # keys
+        self.turn_keys = [ random.getrandbits(64) for i in range(4) ]
+        self.enemy_keys = [ random.getrandbits(64) for i in range(4) ]
+        self.maxn_key = random.getrandbits(64)
 
     def get_move(self, board):
-        """Given a board, choose the next move."""
+        """Given a board, choose the next move.
+
+        Returns None if my pawn has no legal move."""
 
         self.board = board
         self.identify_me_and_others()
@@ -22,11 +218,13 @@ class QuoAIEngine:
     def identify_me_and_others(self):
         """Identify our and other players' Pawns."""
         
-        self.me = filter(lambda q: q.h == self.h, self.board.pp)[0]
-        self.others = self.board.pp[self.board.pp.index(self.me)+1:] + self.board.pp[:self.board.pp.index(self.me)]
+        pp = self.board.pp
+        self.me = pp[self.seat]
+        self.others = pp[self.seat+1:] + pp[:self.seat]
         if len(self.others) + 1 != self.board.nplayers:
             logging.critical("len(others) == %d, nplayers == %d", len(self.others), self.board.nplayers)
             raise
+        self.players = [self.me] + self.others
 
     def identify_enemy(self):
         """Determine the "enemy", i.e. the pawn closest to the goal."""
@@ -34,7 +232,17 @@ class QuoAIEngine:
         for p in self.others:
             p.distance = self.board.distance_to_goal(p)
         closest = min( p.distance for p in self.others )
-        self.enemy = random.choice(filter(lambda p: p.distance==closest, self.others))
+        self.set_enemy(random.choice(filter(lambda p: p.distance==closest, self.others)))
+
+    def set_enemy(self, p):
+        self.enemy = p
+        self.enemy_key = self.enemy_keys[(p.seat - self.seat) % self.board.nplayers - 1]
+
+    def close(self):
+        """Stop the worker processes of the parallel search, if any"""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
 
     def choose_move(self):
         """Think about how to move.
@@ -42,82 +250,407 @@ class QuoAIEngine:
         Uses a minimax strategy."""
 
         logging.debug('Choosing a new move')
+        if self.collect_stats:
+            self.stats = SearchStats()
+            start = time.time()
         ms_me = self.possible_moves(self.me)
-        self.running_min = 9999999
-        for m_me in ms_me:
-            self.max_loss = 0
-            logging.debug('Considering m_me == %s', m_me.s)
-            if self.board.apply_move(self.h, m_me):
-                logging.debug('Accepted')
-                if self.board.check_win(self.h):
-                    return m_me
-                others_queue = deque(self.others)
-                self.move_others(others_queue)
-                self.board.restore_move(self.h, m_me)
-                logging.debug('self.max_loss is now %d', self.max_loss)
-                m_me.max_loss = self.max_loss
-                logging.debug('m_me.max_loss is now %d', m_me.max_loss)
-                self.running_min = min(self.running_min, m_me.max_loss)
-                logging.debug('self.running_min is now %d', self.running_min)
-        del self.max_loss
-        
-        m = min(filter(lambda m: hasattr(m,'max_loss'), ms_me), key=lambda m: m.max_loss)
-        logging.debug('move chosen: %s', m.s)
-        return min(filter(lambda m: hasattr(m,'max_loss'), ms_me), key=lambda m: m.max_loss)
-
-    def move_others(self, queue):
-        """Recursively move the other Pawns."""
-
-        if queue:
-            p = queue.popleft()
-            for m_p in self.possible_moves(p):
-                logging.debug('Considering m_p == %s', m_p.s)
-                if self.board.apply_move(p.h, m_p):
-                    logging.debug('Accepted')
-                    self.move_others(queue)
-                    logging.debug('self.max_loss is now %d', self.max_loss)
-                    self.board.restore_move(p.h, m_p)
-                    logging.debug('int(self.max_loss+0.5), int(self.running_min+0.5), int(self.max_loss+0.5) > int(self.running_min+0.5): %d, %d, %s', int(self.max_loss+0.5), int(self.running_min+0.5), repr(int(self.max_loss+0.5) > int(self.running_min+0.5)))
-                    if int(self.max_loss+0.5) > int(self.running_min+0.5):
-                        logging.debug('Breaking out, max_loss == %d > running_min == %d', self.max_loss, self.running_min)
-                        queue=[]
+        self.best = None
+        best = None
+        try:
+            if self.book is not None:
+                m = self.book.lookup(self.board, self.seat)
+                if m in ms_me:
+                    logging.debug('book move: %s', move_to_str(m, self.board.slots))
+                    self.best = m
+                    return m
+            if self.max_time is None:
+                self.deadline = None
+            else:
+                self.deadline = time.time() + self.max_time
+
+            if self.workers > 1 and self.pool is None:
+                self.bound = multiprocessing.Value('i', infinity)
+                self.pool = multiprocessing.Pool(self.workers, init_worker, (self, self.bound))
+
+            if self.max_time is None:
+                self.search_root(ms_me, len(self.players))
+                best = self.best
+                if self.stats is not None:
+                    self.stats.depth = len(self.players)
+            else:
+                # Iterative deepening
+                for depth in range(1, self.max_depth+1):
+                    try:
+                        scores = self.search_root(ms_me, depth)
+                    except SearchTimeout:
+                        logging.debug('Out of time at depth %d', depth)
                         break
-        else:
-            self.max_loss = max(self.max_loss, self.evaluate_position_enemy())
+                    best = self.best
+                    if best is None:
+                        # No legal move, searching deeper will not find one
+                        break
+                    if self.stats is not None:
+                        self.stats.depth = depth
+                    logging.debug('depth %d: move chosen: %s', depth, move_to_str(best, self.board.slots))
+                    if scores.get(best) == -self.win_loss:
+                        break
+                    # Search the most promising moves first at the next depth
+                    ms_me.sort(key=lambda m: scores.get(m, self.win_loss+1))
+        finally:
+            self.deadline = None
+            if self.stats is not None:
+                self.stats.total_time = time.time() - start
+
+        if best is None:
+            # Not even the first iteration completed, use what we have
+            best = self.best
+        if best is None:
+            best = self.board.first_legal_move(self.seat, ms_me)
+        if best is None:
+            logging.debug('No legal move for player %d', self.seat+1)
+            return None
+        logging.debug('move chosen: %s', move_to_str(best, self.board.slots))
+        return best
+
+    def check_time(self):
+        if self.deadline is not None and time.time() > self.deadline:
+            raise SearchTimeout
+
+    def search_root(self, moves, depth):
+        """Search my moves to the given depth (in plies).
+
+        The best move is stored in self.best, and kept there if the time
+        runs out (SearchTimeout) before all the moves are searched. Returns
+        the dictionary of the scores of the legal moves. Only the score of the best move is exact,
+        the others may be bounds."""
+
+        if self.pool is not None:
+            return self.search_root_parallel(moves, depth)
+
+        best_loss = infinity
+        scores = {}
+        nlegal = 0
+        trace = quotrace.recorder
+        for m_me in moves:
+            if scores:
+                # The deadline is checked once there is a move to fall back
+                # on: the depth-1 search below the root never checks it
+                self.check_time()
+            if trace is not None:
+                trace.record('root', depth, m_me)
+            max_loss, exact = self.search_root_move(m_me, depth, best_loss)
+            if max_loss is None:
+                continue
+            nlegal += 1
+            scores[m_me] = max_loss
+            if trace is not None:
+                trace.record('root_loss', depth, m_me, max_loss)
+            if max_loss < best_loss:
+                best_loss = max_loss
+                self.best = m_me
+                if max_loss == -self.win_loss:
+                    break
+
+        if self.stats is not None:
+            self.stats.expand(0, nlegal)
+        return scores
+
+    def search_root_move(self, m_me, depth, beta=None):
+        """Search one of my moves to the given depth.
+
+        The search is cut when the loss reaches beta (by default, the shared
+        bound of the parallel search). Returns the loss (None if the move is
+        illegal) and whether it is exact."""
+
+        if beta is None:
+            beta = self.bound.value
+        self.root_depth = depth
+        stats = self.stats
+        if stats is not None:
+            stats.nodes += 1
+            # Distance fields are repaired lazily, when they are read: the
+            # board accounts for the time spent
+            dist_time = self.board.dist_time
+        legal = self.board.apply_move(self.seat, m_me)
+        if stats is not None and m_me & 1:
+            stats.barrier_checks += 1
+            stats.illegal_barriers += not legal
+        if not legal:
+            if stats is not None:
+                stats.dist_update_time += self.board.dist_time - dist_time
+            return None, False
+        maxn = self.mode == 'maxn' and len(self.players) > 2
+        try:
+            if self.board.check_win(self.seat):
+                max_loss = -self.win_loss
+            elif maxn:
+                max_loss = self.search_maxn(1, depth-1)[0]
+            else:
+                max_loss = self.search(1, depth-1, -infinity, beta)
+        finally:
+            self.board.restore_move(self.seat, m_me)
+            if stats is not None:
+                stats.dist_update_time += self.board.dist_time - dist_time
+        if self.in_worker:
+            # Share the new bound with the other workers
+            with self.bound.get_lock():
+                if max_loss < self.bound.value:
+                    self.bound.value = max_loss
+        return max_loss, maxn or max_loss < beta
+
+    def search_root_parallel(self, moves, depth):
+        """Parallel version of search_root.
+
+        My moves are distributed among the worker processes."""
+
+        self.bound.value = infinity
+        snapshot = quosnapshot.dumps(self.board)
+        results = self.pool.map(search_root_move, [ (snapshot, type(self.board),
+            self.enemy.seat, self.deadline, m, depth) for m in moves ])
+        if None in results:
+            raise SearchTimeout
+
+        scores = {}
+        best_loss = infinity
+        for m_me, max_loss, exact, stats in results:
+            if stats is not None:
+                self.stats.merge(stats)
+            if max_loss is None:
+                continue
+            scores[m_me] = max_loss
+            # Values cut by the shared bound are only lower bounds, and there
+            # is always an exact value among the smallest ones
+            if exact and max_loss < best_loss:
+                best_loss = max_loss
+                self.best = m_me
+
+        if self.stats is not None:
+            self.stats.expand(0, len(scores))
+        return scores
+
+    def search(self, turn, depth, alpha, beta):
+        """Paranoid alpha-beta search of the moves of self.players[turn] to
+        the given depth.
+
+        I try to minimise the loss and the other Pawns all try to maximise
+        it. The search is fail-soft: a value <= alpha is an upper bound and a
+        value >= beta is a lower bound of the loss."""
+
+        stats = self.stats
+        if stats is not None:
+            stats.nodes += 1
+        if depth == 0:
+            if stats is None:
+                return self.evaluate_position_enemy()
             # Or, alternatively:
-            # self.max_loss = max(self.max_loss, self.evaluate_position_others())
+            # return self.evaluate_position_others()
+            t = time.time()
+            value = self.evaluate_position_enemy()
+            stats.evaluations += 1
+            stats.eval_time += time.time() - t
+            return value
+
+        self.check_time()
 
-    class Move:
-        """Move class.
+        key = self.board.zobrist ^ self.turn_keys[turn] ^ self.enemy_key
+        e = self.tt.probe(key)
+        best_m = None
+        if e is not None:
+            best_m = e[4]
+            if e[1] >= depth:
+                value, bound = e[2], e[3]
+                if bound == TranspositionTable.exact or \
+                   (bound == TranspositionTable.lower and value >= beta) or \
+                   (bound == TranspositionTable.upper and value <= alpha):
+                    if stats is not None:
+                        stats.tt_hits += 1
+                    return value
 
-        Moves are encoded as strings. An initial "m" character indicates a
-        move, and should be followed by one of the directions (1, 2, 4, 8). An
-        initial "b" character indicates a barrier, and should be followed by
-        two digits (the coordinates of the barrier origin) and a direction."""
+        alpha0, beta0 = alpha, beta
+        p = self.players[turn]
+        nextturn = (turn+1) % len(self.players)
+        if stats is not None:
+            t = time.time()
+        moves = self.order_moves(self.possible_moves(p), best_m)
+        if stats is not None:
+            stats.move_gen_time += time.time() - t
+        if turn == 0:
+            best = infinity
+        else:
+            best = -infinity
+        moved = 0
+        trace = quotrace.recorder
+        for m_p in moves:
+            if trace is not None:
+                trace.record('search', turn, depth, m_p)
+            legal = self.board.apply_move(p.seat, m_p)
+            if stats is not None and m_p & 1:
+                stats.barrier_checks += 1
+                stats.illegal_barriers += not legal
+            if legal:
+                moved += 1
+                try:
+                    if self.board.check_win(p.seat):
+                        if turn == 0:
+                            loss = -self.win_loss
+                        else:
+                            loss = self.win_loss
+                    else:
+                        loss = self.search(nextturn, depth-1, alpha, beta)
+                finally:
+                    self.board.restore_move(p.seat, m_p)
+                if turn == 0:
+                    if loss < best:
+                        best = loss
+                        best_m = m_p
+                        beta = min(beta, best)
+                        if best <= alpha:
+                            if stats is not None:
+                                stats.cutoffs += 1
+                            break
+                elif loss > best:
+                    best = loss
+                    best_m = m_p
+                    alpha = max(alpha, best)
+                    if best >= beta:
+                        if stats is not None:
+                            stats.cutoffs += 1
+                        break
+        if stats is not None:
+            stats.expand(self.root_depth - depth, moved)
+        if not moved:
+            # The pawn is stuck, it has to skip its turn
+            best = self.search(nextturn, depth-1, alpha, beta)
+
+        if best <= alpha0:
+            bound = TranspositionTable.upper
+        elif best >= beta0:
+            bound = TranspositionTable.lower
+        else:
+            bound = TranspositionTable.exact
+        self.tt.store(key, depth, best, bound, best_m)
+        return best
+
+    def search_maxn(self, turn, depth):
+        """Max-n search of the moves of self.players[turn] to the given depth.
+
+        Returns the list of the losses of all the players (in the order of
+        self.players). Each Pawn minimises its own loss. There is no pruning,
+        only the transposition table and move ordering."""
+
+        stats = self.stats
+        if stats is not None:
+            stats.nodes += 1
+        if depth == 0:
+            if stats is None:
+                return self.evaluate_position_all()
+            t = time.time()
+            losses = self.evaluate_position_all()
+            stats.evaluations += 1
+            stats.eval_time += time.time() - t
+            return losses
+
+        self.check_time()
+
+        key = self.board.zobrist ^ self.turn_keys[turn] ^ self.maxn_key
+        e = self.tt.probe(key)
+        best_m = None
+        if e is not None:
+            best_m = e[4]
+            if e[1] >= depth:
+                if stats is not None:
+                    stats.tt_hits += 1
+                return e[2]
+
+        p = self.players[turn]
+        nextturn = (turn+1) % len(self.players)
+        if stats is not None:
+            t = time.time()
+        moves = self.order_moves(self.possible_moves(p), best_m)
+        if stats is not None:
+            stats.move_gen_time += time.time() - t
+        best = None
+        moved = 0
+        trace = quotrace.recorder
+        for m_p in moves:
+            if trace is not None:
+                trace.record('search_maxn', turn, depth, m_p)
+            legal = self.board.apply_move(p.seat, m_p)
+            if stats is not None and m_p & 1:
+                stats.barrier_checks += 1
+                stats.illegal_barriers += not legal
+            if legal:
+                moved += 1
+                try:
+                    if self.board.check_win(p.seat):
+                        losses = [ self.win_loss ] * len(self.players)
+                        losses[turn] = -self.win_loss
+                    else:
+                        losses = self.search_maxn(nextturn, depth-1)
+                finally:
+                    self.board.restore_move(p.seat, m_p)
+                if best is None or losses[turn] < best[turn]:
+                    best = losses
+                    best_m = m_p
+        if stats is not None:
+            stats.expand(self.root_depth - depth, moved)
+        if best is None:
+            # The pawn is stuck, it has to skip its turn
+            best = self.search_maxn(nextturn, depth-1)
 
-        def __init__(self, s):
-            self.s = s
+        self.tt.store(key, depth, best, TranspositionTable.exact, best_m)
+        return best
+
+    def order_moves(self, moves, best_m):
+        """Order the moves for the search.
+
+        possible_moves already lists the pawn moves first, sorted by
+        sort_best_moves; the best move found by a previous search (if any) is
+        moved to the front."""
+        if best_m is not None:
+            moves.sort(key=lambda m: m != best_m)
+        return moves
 
     def possible_moves(self, p):
-        """Return all the possible moves for pawn p."""
+        """Return all the possible moves for pawn p, encoded as integers.
+
+        If the engine prunes barriers, only the ones cutting a shortest path
+        of another pawn are returned, those cutting the most shortest-path
+        edges first: the others cannot change any distance but the one of p,
+        and can only lengthen it. If none of these moves is legal, all the
+        barriers are returned.
+
+        If max_barriers is set, only the first max_barriers barriers
+        cutting a shortest path of another pawn are returned (see
+        ServerBoard.path_barriers), with the same fallback."""
 
         # Look for moves
-        moves = [ self.Move("m " + str(d)) for d in self.sort_best_moves(p)
+        moves = [ pawn_move(d) for d in self.sort_best_moves(p)
             if self.board.moves[p.position[0]][p.position[1]] & d ]
 
         # Look for barriers
-        for x in range(self.board.side):
-            for y in range(self.board.side):
-                for d in [up, right, down, left]:
-                    if self.board.check_barrier(quoboard.Barrier(x, y, d)):
-                        moves.append( self.Move("b " + str(x) + " " + str(y) + " " + str(d)) )
+        i = p.seat
+        others = [ j for j in range(self.board.nplayers) if j != i ]
+        if self.max_barriers is not None:
+            slots = self.board.path_barriers(others)[:self.max_barriers]
+            moves.extend( s << 1 | 1 for s in slots )
+        elif self.prune:
+            counts = self.board.effective_barriers(others)
+            moves.extend( s << 1 | 1 for s in sorted(counts, key=lambda s: (-counts[s], s)) )
+        else:
+            moves.extend( s << 1 | 1 for s in self.board.free_slots )
+            return moves
 
+        if self.board.first_legal_move(i, moves) is None:
+            # p is boxed in and all these barriers would close a pawn off:
+            # the other barriers are the only moves left
+            moves = [ s << 1 | 1 for s in self.board.free_slots ]
         return moves
 
     def sort_best_moves(self, p):
         """Returns the best possible moves, sorted by path length."""
 
-        dist = self.board.dists[self.board.pp.index(p)]
+        dist = self.board.player_dists(p.seat)
 
         return sorted([ d for d in [up, right, down, left] if self.board.moves[p.position[0]][p.position[1]] & d and dist[p.position[0]][p.position[1]] >= 0],
             key = lambda d: dist[p.position[0]+vdir[d][0]][p.position[1]+vdir[d][1]] )
@@ -129,6 +662,14 @@ class QuoAIEngine:
         return float(self.board.distance_to_goal(self.me) / \
             float(min( self.board.distance_to_goal(p) for p in self.others )+1))
 
+    def evaluate_position_all(self):
+        """Merit function for the evaluation of a position.
+
+        Returns the loss of each Pawn (in the order of self.players) with
+        respect to its closest opponent. Large == bad."""
+        ds = [ self.board.distance_to_goal(p) for p in self.players ]
+        return [ d - min(ds[:i] + ds[i+1:]) + 1 for i, d in enumerate(ds) ]
+
     def evaluate_position_enemy(self):
         """Merit function for the evaluation of a position.
         
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+
+"""Benchmarks of the board and engine hot paths.
+
+Times the distance computations (full fields and single A* queries), barrier
+placement and removal, the closed-off check, move generation and a full
+engine move, on seeded random positions over a grid of board sizes, player
+counts and barrier densities.
+The density is the number of barriers per board square: a standard 9x9 game
+with all its 20 barriers placed has a density of about 0.25.
+With --dist-cache, the boards get a distance field cache, whose counters
+(hits, evictions) are reported along with the timings to help sizing it.
+
+Results are written as JSON. With --compare, they are checked against a
+previously saved run and the exit status is 1 if anything got slower than
+the threshold.
+
+Examples:
+    python quobench.py --output baseline.json
+    python quobench.py --compare baseline.json --output new.json
+    python quobench.py --sides 51,101 --backend compact --max-barriers 16"""
+
+import quoserver
+from quoboard import up, right, down, left, logging
+import random, time, json, argparse, platform, sys
+
+def random_position(backend, side, nplayers, density, seed, cache_size=0):
+    """Build a board with seeded random barriers and pawn positions, and a
+    distance field cache of cache_size bytes if it is not 0"""
+
+    # The pawn hashes and the engine keys come from the random module
+    random.seed(seed)
+    rng = random.Random(seed)
+    board = quoserver.board_backends[backend](side, nplayers, [True] * nplayers)
+    if cache_size > 0:
+        board.dist_cache = quoserver.DistCache(cache_size)
+
+    nbarriers = int(round(density * side * side))
+    candidates = sorted(board.free_slots)
+    rng.shuffle(candidates)
+    for s in candidates:
+        if len(board.barriers) >= nbarriers:
+            break
+        board.place_barrier(s)
+
+    # Walk the pawns a few random steps away from their starting squares
+    for k in range(side/2):
+        for p in board.pp:
+            board.move_pawn(p.seat, rng.choice([up, right, down, left]))
+
+    return board, rng
+
+def sample_slots(board, rng, n=16):
+    """Pick up to n free slots where a barrier can actually be placed"""
+    slots = []
+    candidates = sorted(board.free_slots)
+    rng.shuffle(candidates)
+    for s in candidates:
+        if len(slots) >= n:
+            break
+        if board.place_barrier(s):
+            board.lift_barrier(s)
+            slots.append(s)
+    return slots
+
+def bench_init_dist(board, rng, options):
+    goals = [ p.goal for p in board.pp ]
+    def run():
+        for g in goals:
+            status = board.new_field(0, 'B')
+            board.init_dist(g, status)
+    return run
+
+def bench_recompute_dists(board, rng, options):
+    return board.recompute_dists
+
+def bench_reconsider_dists(board, rng, options):
+    barriers = [ board.slots.barriers[s] for s in sample_slots(board, rng) ]
+    players = range(board.nplayers)
+    def run():
+        # The fields are repaired lazily: read them to include the repairs
+        for barrier in barriers:
+            board.add_barrier_to_map(barrier)
+            board.reconsider_dists(barrier)
+            for i in players:
+                board.player_dists(i)
+            board.remove_barrier_from_map(barrier)
+            board.reconsider_dists(barrier)
+            for i in players:
+                board.player_dists(i)
+    return run
+
+def bench_add_remove_barrier(board, rng, options):
+    barriers = [ board.slots.barriers[s] for s in sample_slots(board, rng) ]
+    def run():
+        for barrier in barriers:
+            board.add_barrier(barrier)
+            board.remove_barrier(barrier)
+    return run
+
+def bench_are_pawns_closed_off(board, rng, options):
+    return board.are_pawns_closed_off
+
+def bench_goal_distance(board, rng, options):
+    def run():
+        for p in board.pp:
+            board.goal_distance(p.position, p.goal)
+    return run
+
+def bench_possible_moves(board, rng, options):
+    def run():
+        for p in board.pp:
+            p.ai.board = board
+            p.ai.max_barriers = options['max_barriers']
+            p.ai.possible_moves(p)
+    return run
+
+def bench_get_move(board, rng, options):
+    ai = board.pp[0].ai
+    # Fixed depth: iterative deepening with a deadline that is never hit
+    ai.max_time = 1e9
+    ai.max_depth = options['search_depth']
+    ai.max_barriers = options['max_barriers']
+    def run():
+        ai.tt.clear()
+        ai.get_move(board)
+    return run
+
+benchmarks = [
+    ('init_dist',               bench_init_dist),
+    ('recompute_dists',         bench_recompute_dists),
+    ('reconsider_dists',        bench_reconsider_dists),
+    ('add_remove_barrier',      bench_add_remove_barrier),
+    ('are_pawns_closed_off',    bench_are_pawns_closed_off),
+    ('goal_distance',           bench_goal_distance),
+    ('possible_moves',          bench_possible_moves),
+    ('get_move',                bench_get_move)
+]
+
+def measure(run, min_time, repeat):
+    """Time run, calling it in rounds lasting at least min_time seconds.
+
+    Returns the best time per call over repeat rounds, and the number of
+    calls per round."""
+    # Warm up: the first call pays for the lazy repairs of the distance
+    # fields left pending by the setup
+    run()
+    number = 1
+    while True:
+        start = time.time()
+        for k in xrange(number):
+            run()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+    best = elapsed / number
+    for r in range(repeat-1):
+        start = time.time()
+        for k in xrange(number):
+            run()
+        best = min(best, (time.time() - start) / number)
+    return best, number
+
+def result_key(r):
+    return (r['benchmark'], r['backend'], r['side'], r['players'], r['density'])
+
+def compare(results, baseline, threshold):
+    """Print the ratios of the new timings to the baseline ones.
+
+    Returns the number of regressions, i.e. of the benchmarks more than
+    threshold (a fraction) slower than the baseline."""
+    old = dict( (result_key(r), r) for r in baseline['results'] )
+    regressions = 0
+    for r in results:
+        k = result_key(r)
+        if k not in old:
+            continue
+        ratio = r['time'] / old[k]['time'] if old[k]['time'] > 0 else float('inf')
+        if ratio > 1 + threshold:
+            flag = 'SLOWER'
+            regressions += 1
+        elif ratio < 1 - threshold:
+            flag = 'faster'
+        else:
+            flag = ''
+        print '%-22s %-4s side %2d, %d players, density %.2f: %10.6f -> %10.6f s  x%.2f %s' % (
+            k + (old[k]['time'], r['time'], ratio, flag))
+    return regressions
+
+def parse_list(s, type):
+    return [ type(v) for v in s.split(',') ]
+
+def main():
+    parser = argparse.ArgumentParser(description='Quoridor benchmarks')
+    parser.add_argument('--sides', default='5,9,15,31',
+        help='comma-separated board sides')
+    parser.add_argument('--players', default='2,4',
+        help='comma-separated player counts')
+    parser.add_argument('--densities', default='0,0.1,0.25',
+        help='comma-separated barrier densities (barriers per square)')
+    parser.add_argument('--backend', default='list',
+        choices=sorted(quoserver.board_backends.keys()), help='board backend')
+    parser.add_argument('--benchmarks', default=','.join( n for n, f in benchmarks ),
+        help='comma-separated benchmarks to run')
+    parser.add_argument('--seed', type=int, default=0, help='position seed')
+    parser.add_argument('--search-depth', type=int, default=1,
+        help='search depth of the get_move benchmark')
+    parser.add_argument('--max-barriers', type=int, default=0,
+        help='barriers searched per node by the engine (0: all)')
+    parser.add_argument('--dist-cache', type=float, default=0,
+        help='size of the distance field cache in MB (0: no cache)')
+    parser.add_argument('--min-time', type=float, default=0.1,
+        help='minimum duration of a timing round in seconds')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='number of timing rounds; the best one is kept')
+    parser.add_argument('--output', default=None, help='JSON file receiving the results')
+    parser.add_argument('--compare', default=None, help='baseline JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+        help='slowdown fraction counted as a regression')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    names = parse_list(args.benchmarks, str)
+    for name in names:
+        if name not in dict(benchmarks):
+            parser.error('unknown benchmark %s' % name)
+    options = {
+        'search_depth': args.search_depth,
+        'max_barriers': args.max_barriers or None
+    }
+
+    results = []
+    for side in parse_list(args.sides, int):
+        for nplayers in parse_list(args.players, int):
+            for density in parse_list(args.densities, float):
+                for name, setup in benchmarks:
+                    if name not in names:
+                        continue
+                    # A fresh position for every benchmark, so that they do
+                    # not depend on each other
+                    board, rng = random_position(args.backend, side, nplayers,
+                        density, args.seed, int(args.dist_cache * (1 << 20)))
+                    t, number = measure(setup(board, rng, options),
+                        args.min_time, args.repeat)
+                    r = {
+                        'benchmark':    name,
+                        'backend':      args.backend,
+                        'side':         side,
+                        'players':      nplayers,
+                        'density':      density,
+                        'barriers':     len(board.barriers),
+                        'time':         t,
+                        'calls':        number
+                    }
+                    if board.dist_cache is not None:
+                        r['dist_cache'] = board.dist_cache.as_dict()
+                    results.append(r)
+                    sys.stderr.write('%-22s side %2d, %d players, density %.2f: %.6f s\n' % (
+                        name, side, nplayers, density, t))
+
+    report = {
+        'python':   platform.python_version(),
+        'platform': platform.platform(),
+        'options':  vars(args),
+        'results':  results
+    }
+    if args.output:
+        out = open(args.output, 'w')
+        json.dump(report, out, indent=2, sort_keys=True)
+        out.close()
+
+    if args.compare:
+        f = open(args.compare)
+        baseline = json.load(f)
+        f.close()
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
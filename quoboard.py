@@ -3,14 +3,13 @@
 # For debugging!
 import pdb
 
-# Set up logging
-import logging, os.path
-logging.basicConfig(level=logging.DEBUG,
-        format='%(asctime)s %(levelname)-8s %(message)s',
-        datefmt='%a, %d %b %Y %H:%M:%S',
-        filename=os.path.expanduser('~/.quoserver.log'))
+# Logging is configured by the applications (see quoserver.py); the hot
+# loops use quotrace instead
+import logging
+import quotrace
 
 from collections import deque
+import random, heapq, array
 
 # Global variables
 global up, right, down, left
@@ -30,10 +29,42 @@ vdir={
                 down:   (0,1),
                 left:   (-1,0)
             }
+# Moves to the neighbouring squares, as (direction, dx, dy)
+steps = tuple( (d, vdir[d][0], vdir[d][1]) for d in [up, right, down, left] )
 length = 2
 
 
 
+# Moves are encoded as integers. Bit 0 tells pawn moves (0) from barriers
+# (1); the other bits hold the direction of the pawn move or the slot of the
+# barrier. Strings are only used to communicate with the outside world.
+def pawn_move(direction):
+    return direction << 1
+
+def barrier_move(slot):
+    return slot << 1 | 1
+
+def move_to_str(m, slots):
+    """Convert a move to a string: "m d" for pawn moves, "b x y d" for
+    barriers"""
+    if m & 1:
+        b = slots.barriers[m >> 1]
+        return "b " + str(b.position[0]) + " " + str(b.position[1]) + " " + str(b.direction)
+    else:
+        return "m " + str(m >> 1)
+
+def move_from_str(s, slots):
+    """Convert a string to a move. Returns None if the barrier does not fit on
+    the board."""
+    mspl = s.split()
+    if mspl[0] == 'm':
+        return pawn_move(int(mspl[1]))
+    elif mspl[0] == 'b':
+        slot = slots.lookup(int(mspl[1]), int(mspl[2]), int(mspl[3]))
+        if slot is None:
+            return None
+        return barrier_move(slot)
+
 # Class definitions
 
 class Barrier:
@@ -61,6 +92,7 @@ class Barrier:
                 self.direction=right
             else:
                 self.direction=down
+        self.nodelist=tuple( self.node(i) for i in range(length) )
 
     def __eq__(self, other):
         return self.position == other.position and self.direction == other.direction and self.length == other.length
@@ -91,21 +123,163 @@ class Barrier:
         return tuple( map(sum, zip( self.position,tuple([i*x for x in vdir[self.direction]]) ) ) )
 
     def nodes(self):
-        """Return a list of barrier nodes"""
-        return [ self.node(i) for i in range(self.length) ]
+        """Return the tuple of barrier nodes"""
+        return self.nodelist
+
+class BarrierSlots:
+    """Table of the barrier slots of a board.
+
+    A slot is a legal barrier position, in normalised form (direction right
+    or down). Each slot is identified by an integer index. For each slot the
+    table stores the interned Barrier, the board edges it cuts and the list
+    of the slots it conflicts with (including itself). The table only
+    depends on the board side and on the barrier length, use barrier_slots()
+    to get the shared instance."""
 
-class Board:
+    def __init__(self, side, length=length):
+        self.side = side
+        self.length = length
+        self.barriers = []
+        self.index = {}
+        for x in range(side-length+1):
+            for y in range(1,side):
+                self.add_slot(Barrier(x, y, right, length))
+        for x in range(1,side):
+            for y in range(side-length+1):
+                self.add_slot(Barrier(x, y, down, length))
+
+        # Barriers can also be given in "backward" form
+        for s, b in enumerate(self.barriers):
+            x2, y2 = b.position2
+            if b.direction == right:
+                self.index[(x2, y2, left)] = s
+            else:
+                self.index[(x2, y2, up)] = s
+
+        # Cut edges, as (x, y, direction) triples
+        self.edges = []
+        for b in self.barriers:
+            edges = []
+            for x, y in b.nodes():
+                if b.direction == right:
+                    edges.append((x, y-1, down))
+                    edges.append((x, y, up))
+                else:
+                    edges.append((x-1, y, right))
+                    edges.append((x, y, left))
+            self.edges.append(edges)
+
+        # Slots cutting each edge, indexed by (x, y, direction)
+        self.edge_slots = {}
+        for s, edges in enumerate(self.edges):
+            for e in edges:
+                self.edge_slots.setdefault(e, []).append(s)
+
+        # Conflicting slots. Only slots starting close to each other can
+        # intersect.
+        self.conflicts = []
+        for s, b in enumerate(self.barriers):
+            x, y = b.position
+            conflicts = []
+            for dx in range(-length+1, length):
+                for dy in range(-length+1, length):
+                    for d in [right, down]:
+                        o = self.index.get((x+dx, y+dy, d))
+                        if o is not None and (o == s or b.intersects_with(self.barriers[o])):
+                            conflicts.append(o)
+            conflicts.sort()
+            self.conflicts.append(conflicts)
+
+    def add_slot(self, barrier):
+        self.index[(barrier.position[0], barrier.position[1], barrier.direction)] = len(self.barriers)
+        self.barriers.append(barrier)
+
+    def __len__(self):
+        return len(self.barriers)
+
+    def lookup(self, x, y, direction):
+        """Return the slot of the barrier starting at (x,y) in the given
+        direction, or None if the barrier does not fit on the board"""
+        return self.index.get((x, y, direction))
+
+    def slot_of(self, barrier):
+        """Return the slot of a Barrier object, or None"""
+        return self.index.get((barrier.position[0], barrier.position[1], barrier.direction))
+
+barrier_slot_tables = {}
+
+def barrier_slots(side, length=length):
+    """Return the (shared) table of barrier slots for the given board side and
+    barrier length"""
+    try:
+        return barrier_slot_tables[(side, length)]
+    except KeyError:
+        table = barrier_slot_tables[(side, length)] = BarrierSlots(side, length)
+        return table
+
+class ZobristKeys:
+    """Random keys for the Zobrist hashing of positions.
+
+    There is one key per (player, square) pair and one key per barrier slot.
+    Squares are numbered as y*side+x. The keys are drawn from a generator
+    seeded with the board side, so that hashes are reproducible across
+    processes. Use zobrist_keys() to get the shared instance."""
+
+    def __init__(self, side, nslots, maxplayers=4):
+        rng = random.Random(side)
+        self.pawn = [ [ rng.getrandbits(64) for n in range(side*side) ]
+            for i in range(maxplayers) ]
+        self.slot = [ rng.getrandbits(64) for s in range(nslots) ]
+
+zobrist_key_tables = {}
+
+def zobrist_keys(side):
+    """Return the (shared) Zobrist keys for the given board side"""
+    try:
+        return zobrist_key_tables[side]
+    except KeyError:
+        keys = zobrist_key_tables[side] = ZobristKeys(side, len(barrier_slots(side)))
+        return keys
+
+class Board(object):
     """Board class with barriers and table of allowed moves"""
     def __init__(self,side):
         self.side = side
         self.middle = self.side/2
-        self.moves = [[up | down | right | left for i in range(self.side)] for j in range(self.side)]
+        self.moves = self.new_field(up | down | right | left, 'B')
         for i in range(side):
             self.moves[0][i]      &= ~left
             self.moves[side-1][i] &= ~right
             self.moves[i][0]      &= ~up
             self.moves[i][side-1] &= ~down
+        self.init_barriers()
+
+    def new_field(self, value, typecode=None):
+        """Return a new table of the squares, indexed [x][y], with every
+        entry set to value.
+
+        typecode is the array type code of the entries in the compact
+        backend (by default, the one of the distance fields); here the
+        table is a list of lists."""
+        return [ [ value ] * self.side for x in range(self.side) ]
+
+    def as_field(self, columns, typecode=None):
+        """Return the sequence of columns as a table of the squares, in the
+        format of new_field"""
+        return [ list(column) for column in columns ]
+
+    def init_barriers(self):
+        """Set up an empty list of barriers and the table of barrier slots"""
         self.barriers=[]
+        self.slots = barrier_slots(self.side)
+        # Occupied slots, one byte per slot (a bitset of the slots would
+        # cost O(slots) per update on large boards)
+        self.occupied = bytearray(len(self.slots))
+        # Set of the slots where a barrier can currently be placed
+        self.free_slots = set(range(len(self.slots)))
+        # Zobrist hash of the position
+        self.zkeys = zobrist_keys(self.side)
+        self.zobrist = 0
 
     def is_pawn_position_legal(self,x,y):
         """Check if the proposed pawn position is within the board limits"""
@@ -129,32 +303,129 @@ class Board:
         """Check if barrier is allowed"""
 
         # Check if the barrier is allowed
-        if not self.is_barrier_legal( barrier ):
+        s = self.slots.slot_of(barrier)
+        if s is None:
             return False
 
         # Check if new barrier overlaps with existing barriers
-        for oldbarrier in self.barriers:
-            if barrier.intersects_with(oldbarrier): return False
-
-        # Barrier is good
-        return True
+        return self.check_slot(s)
+
+    def check_slot(self, s):
+        """Check if the barrier slot s is free, i.e. if it does not conflict
+        with any of the placed barriers"""
+        return s in self.free_slots
+
+    def occupy_slot(self, s):
+        """Record the barrier in slot s as placed"""
+        self.barriers.append(self.slots.barriers[s])
+        self.occupied[s] = 1
+        self.zobrist ^= self.zkeys.slot[s]
+        self.free_slots.difference_update(self.slots.conflicts[s])
+
+    def release_slot(self, s):
+        """Record the barrier in slot s as removed"""
+        self.barriers.remove(self.slots.barriers[s])
+        self.occupied[s] = 0
+        self.zobrist ^= self.zkeys.slot[s]
+        # Only the slots conflicting with s can become free again
+        occupied = self.occupied
+        conflicts = self.slots.conflicts
+        for c in conflicts[s]:
+            if not any( occupied[o] for o in conflicts[c] ):
+                self.free_slots.add(c)
 
     def are_pawns_closed_off(self):
         """Check if any of the pawns are sealed off (not allowed by the
         rules)"""
 
         for p in self.pp:
-            d = self.distance_to_goal(p)
-            if d < 0:
-                logging.debug('%s %d %d %d', p.h, p.position[0], p.position[1], d)
+            if self.is_closed_off(p):
+                logging.debug('P%s %d %d closed off', p.symbol, p.position[0], p.position[1])
                 return True
             #if self.distance_to_goal(p.position,p.goal) < 0: return True
 
         return False
 
+    def is_closed_off(self, p):
+        """Check if pawn p cannot reach its goal.
+
+        This and distance_to_goal serve boards without distance fields:
+        ServerBoard overrides both with reads of its fields."""
+        return not self.goal_reachable(p.position, p.goal)
+
+    def distance_to_goal(self, p):
+        """Distance of pawn p to its goal, -1 if it cannot reach it"""
+        return self.goal_distance(p.position, p.goal)
+
+    def goal_heuristic(self, g):
+        """Return the function giving the number of rows or columns between
+        a square and goal g. It never overestimates the distance."""
+        side = self.side
+        if g == up:
+            return lambda x, y: y
+        elif g == right:
+            return lambda x, y: side-1 - x
+        elif g == down:
+            return lambda x, y: side-1 - y
+        else:
+            return lambda x, y: x
+
+    def goal_distance(self, position, g):
+        """A* search of the distance from position to goal g.
+
+        Only the squares that may lie on a shortest path are expanded,
+        instead of filling a whole distance field. Returns -1 if the goal
+        cannot be reached."""
+        h = self.goal_heuristic(g)
+        moves = self.moves
+        x, y = position
+        # Entries are (f, h, x, y): among equal f, the squares closest to
+        # the goal are expanded first
+        heap = [ (h(x, y), h(x, y), x, y) ]
+        best = { position: 0 }
+        while heap:
+            f, hp, x, y = heapq.heappop(heap)
+            if hp == 0:
+                return f
+            d = f - hp
+            if best[(x,y)] < d:
+                continue
+            m = moves[x][y]
+            for dd, dx, dy in steps:
+                if m & dd:
+                    q = (x+dx, y+dy)
+                    if best.get(q, d+2) > d+1:
+                        best[q] = d+1
+                        hq = h(*q)
+                        heapq.heappush(heap, (d+1 + hq, hq, q[0], q[1]))
+        return -1
+
+    def goal_reachable(self, position, g):
+        """Check if goal g can be reached from position.
+
+        Greedy best-first search: the squares closest to the goal are
+        expanded first, which finds a path quickly when there is one."""
+        h = self.goal_heuristic(g)
+        moves = self.moves
+        x, y = position
+        heap = [ (h(x, y), x, y) ]
+        seen = set([position])
+        while heap:
+            hp, x, y = heapq.heappop(heap)
+            if hp == 0:
+                return True
+            m = moves[x][y]
+            for dd, dx, dy in steps:
+                if m & dd:
+                    q = (x+dx, y+dy)
+                    if q not in seen:
+                        seen.add(q)
+                        heapq.heappush(heap, (h(*q), q[0], q[1]))
+        return False
+
     def init_dist(self, g, moves_status):
 
-        dist = [ [ -1 for x in range(self.side) ] for y in range(self.side) ]
+        dist = self.new_field(-1)
         if g == down:
             for x in range(self.side):
                 dist[x][self.side-1] = 0
@@ -181,9 +452,12 @@ class Board:
         return dist
 
     def bfs(self, queue, dist, moves_status):
-        """Breadth-first search of the shortest path to any board square."""
+        """Breadth-first search of the shortest path to any board square.
 
-        logging.debug("bfs: queue = %s", repr(queue))
+        If tracing is on, each square popped from the queue is recorded as a
+        ("bfs", x, y, distance) event."""
+
+        trace = quotrace.recorder
         while queue:
 
 #            if not hasattr(self, 'notfirst'):
@@ -191,9 +465,8 @@ class Board:
 #                    logging.debug('%s', repr(dist[x]))
 
             p = queue.popleft()
-            for y in range(self.side):
-                logging.debug("bfs: dist, moves_status = %s\t%s", repr([dist[x][y] for x in range(self.side)]), repr([moves_status[x][y] for x in range(self.side)]))
-            logging.debug("")
+            if trace is not None:
+                trace.record('bfs', p[0], p[1], dist[p[0]][p[1]])
 #            if p == pf:
 #                break
             moves_status[p[0]][p[1]] |= visited
@@ -232,26 +505,17 @@ class Board:
 
     def add_barrier_to_map(self, barrier):
         """Update the moves map with the new barrier"""
-        for pos in barrier.nodes():
-            if barrier.direction == right:
-                self.moves[pos[0]][pos[1]-1] &= ~down
-                self.moves[pos[0]][pos[1]]   &= ~up
-            else:
-                self.moves[pos[0]-1][pos[1]] &= ~right
-                self.moves[pos[0]][pos[1]]   &= ~left
+        for x, y, d in self.slots.edges[self.slots.slot_of(barrier)]:
+            self.moves[x][y] &= ~d
 
     def remove_barrier_from_map(self, barrier):
         """Remove the barrier from the allowed moves"""
-        for pos in barrier.nodes():
-            if barrier.direction == right:
-                self.moves[pos[0]][pos[1]-1] |= down
-                self.moves[pos[0]][pos[1]]   |= up
-            else:
-                self.moves[pos[0]-1][pos[1]] |= right
-                self.moves[pos[0]][pos[1]]   |= left
+        for x, y, d in self.slots.edges[self.slots.slot_of(barrier)]:
+            self.moves[x][y] |= d
 
-    def check_win(self, h):
-        p = filter(lambda p: p.h==h, self.pp)[0]
+    def check_win(self, i):
+        """Check if the pawn of player i has reached its goal"""
+        p = self.pp[i]
         if (p.goal == up and p.position[1] == 0) or \
             (p.goal == right and p.position[0] == self.side-1) or \
             (p.goal == down and p.position[1] == self.side-1) or \
@@ -260,3 +524,170 @@ class Board:
         else:
             return False
 
+class CompactBoard(Board):
+    """Board class storing the tables of the squares as typed arrays.
+
+    Each table is a list of array columns, one byte per entry for the
+    allowed moves and the BFS status, two bytes for the distances (four if
+    they may not fit). The tables are indexed [x][y] as the lists of Board,
+    but take a fraction of their memory: this is the backend for the large
+    boards (side 51 and above)."""
+
+    def __init__(self,side):
+        self.dist_code = 'h' if side * side <= 0x7fff else 'i'
+        super(CompactBoard, self).__init__(side)
+
+    def new_field(self, value, typecode=None):
+        column = array.array(typecode or self.dist_code, [ value ]) * self.side
+        return [ array.array(column.typecode, column) for x in range(self.side) ]
+
+    def as_field(self, columns, typecode=None):
+        return [ array.array(typecode or self.dist_code, column) for column in columns ]
+
+class BitBoard(Board):
+    """Board class storing the table of allowed moves as bitboards as well.
+
+    Square (x,y) is represented by bit number y*side+x. There is one
+    bitboard per direction, with a bit set for each square from which a move
+    in that direction is allowed. Moving a whole set of squares one step in a
+    given direction is then a single shift. The table of Board is kept in
+    step with the bitboards, for the code looking at one square at a
+    time."""
+
+    def __init__(self,side):
+        super(BitBoard, self).__init__(side)
+        self.full = (1 << side*side) - 1
+        self.row0 = (1 << side) - 1
+        self.col0 = sum( 1 << y*side for y in range(side) )
+        self.bits = {
+                up:     self.full & ~self.row0,
+                right:  self.full & ~(self.col0 << side-1),
+                down:   self.full & ~(self.row0 << side*(side-1)),
+                left:   self.full & ~self.col0
+            }
+
+    def is_move_allowed(self,position,direction):
+        """Check if the proposed move is allowed by barriers"""
+        return self.bits[direction] >> (position[1]*self.side + position[0]) & 1
+
+    def goal_mask(self, g):
+        """Return the bitboard of the squares lying on goal g"""
+        if g == up:
+            return self.row0
+        elif g == right:
+            return self.col0 << self.side-1
+        elif g == down:
+            return self.row0 << self.side*(self.side-1)
+        elif g == left:
+            return self.col0
+
+    def wavefront(self, frontier, seen=0, old=None, changed=0):
+        """Breadth-first search on bitboards.
+
+        Returns the list of BFS levels (as bitboards), the first one being
+        frontier. Squares in seen are never entered.
+
+        old may hold the levels of an earlier search from the same frontier
+        and seen squares, on a map whose edges differ only between squares
+        of changed. Once all the squares of changed are behind the wave, and
+        two levels in a row are the old ones, so are all the next ones: they
+        are taken from old."""
+        s = self.side
+        u, r, d, l = self.bits[up], self.bits[right], self.bits[down], self.bits[left]
+        seen |= frontier
+        levels = []
+        nold = len(old) if old is not None else 0
+        while frontier:
+            k = len(levels)
+            if k < nold and frontier == old[k] and k > 0 and levels[-1] == old[k-1] \
+                    and not changed & frontier and not changed & ~seen:
+                levels.extend(old[k:])
+                break
+            levels.append(frontier)
+            frontier = ( (frontier & u) >> s | (frontier & d) << s |
+                         (frontier & r) << 1 | (frontier & l) >> 1 ) & ~seen
+            seen |= frontier
+        return levels
+
+    def fill_dist(self, levels, dist, base=0):
+        """Write the distances corresponding to a list of BFS levels into the
+        dist table"""
+        s = self.side
+        for d, level in enumerate(levels, base):
+            while level:
+                low = level & -level
+                n = low.bit_length() - 1
+                dist[n % s][n // s] = d
+                level ^= low
+        return dist
+
+    def init_dist(self, g, moves_status):
+        dist = [ [ -1 for x in range(self.side) ] for y in range(self.side) ]
+        self.fill_dist(self.wavefront(self.goal_mask(g)), dist)
+        for x in range(self.side):
+            for y in range(self.side):
+                if dist[x][y] >= 0:
+                    moves_status[x][y] |= visited_or_enqueued
+        return dist
+
+    def bfs(self, queue, dist, moves_status):
+        """Breadth-first search of the shortest path to any board square.
+
+        All the squares in queue must lie at the same distance. Squares that
+        are already marked as visited or enqueued in moves_status are not
+        explored again."""
+        if not queue:
+            return dist
+        s = self.side
+        frontier = 0
+        seen = 0
+        for x in range(s):
+            for y in range(s):
+                if moves_status[x][y] & visited_or_enqueued:
+                    seen |= 1 << y*s + x
+        for p in queue:
+            frontier |= 1 << p[1]*s + p[0]
+        base = dist[queue[0][0]][queue[0][1]]
+        levels = self.wavefront(frontier, seen)
+        self.fill_dist(levels, dist, base)
+        for level in levels:
+            while level:
+                low = level & -level
+                n = low.bit_length() - 1
+                moves_status[n % s][n // s] |= visited_or_enqueued
+                level ^= low
+        return dist
+
+    def clean_moves(self):
+        # Nothing to clean, visit flags are never stored in the bitboards
+        pass
+
+    def barrier_bits(self, barrier):
+        """Return the bitboard of the squares lying right below (for
+        horizontal barriers) or right of (for vertical barriers) the barrier"""
+        bits = 0
+        for pos in barrier.nodes():
+            bits |= 1 << pos[1]*self.side + pos[0]
+        return bits
+
+    def add_barrier_to_map(self, barrier):
+        """Update the moves map with the new barrier"""
+        super(BitBoard, self).add_barrier_to_map(barrier)
+        bits = self.barrier_bits(barrier)
+        if barrier.direction == right:
+            self.bits[up]    &= ~bits
+            self.bits[down]  &= ~(bits >> self.side)
+        else:
+            self.bits[left]  &= ~bits
+            self.bits[right] &= ~(bits >> 1)
+
+    def remove_barrier_from_map(self, barrier):
+        """Remove the barrier from the allowed moves"""
+        super(BitBoard, self).remove_barrier_from_map(barrier)
+        bits = self.barrier_bits(barrier)
+        if barrier.direction == right:
+            self.bits[up]    |= bits
+            self.bits[down]  |= bits >> self.side
+        else:
+            self.bits[left]  |= bits
+            self.bits[right] |= bits >> 1
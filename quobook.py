@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""Opening book.
+
+The book maps positions, keyed by their Zobrist hash and the seat of the
+player to move, to the move to play. It is built offline by searching the
+first plies of the game for every seat, and stored as an open-addressing
+hash table on disk. The table is memory-mapped and probed in place: opening
+a book parses nothing but its header, and a lookup is a few reads.
+
+Layout (little endian):
+
+    header      magic "QUOB", version, number of players, board side, number
+                of buckets (a power of two), number of entries
+    buckets     key (64 bits, 0 for an empty bucket), move (32 bits)
+
+Example:
+    python quobook.py --side 9 --players 4 --plies 4 --ai-time 10 \\
+        --output book9x4.bin"""
+
+import quoserver, quoaiengine, quosnapshot
+from quoboard import up, right, down, left, logging, pawn_move
+import struct, mmap, random, argparse, multiprocessing
+
+magic = 'QUOB'
+version = 2
+
+header = struct.Struct('<4sBBHII')
+bucket = struct.Struct('<QI')
+
+# Keys of the seat of the player to move, mixed with the position hash
+turn_keys = [ random.Random(0xb00c + i).getrandbits(64) for i in range(4) ]
+
+def book_key(board, seat):
+    """Return the book key of the position, with seat to move"""
+    return (board.zobrist ^ turn_keys[seat]) or 1
+
+class OpeningBook:
+    """Memory-mapped opening book"""
+
+    def __init__(self, filename, side=None, nplayers=None):
+        """Open a book. If side or nplayers is given, the book must have been
+        built for that board side or number of players."""
+        f = open(filename, 'rb')
+        try:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        if len(self.data) < header.size:
+            logging.critical('Opening book %s is truncated', filename)
+            raise IOError('Truncated opening book')
+        m, v, self.nplayers, self.side, self.nbuckets, self.nentries = \
+            header.unpack_from(self.data)
+        if m != magic or v != version or \
+                len(self.data) < header.size + self.nbuckets * bucket.size:
+            logging.critical('%s is not a valid opening book', filename)
+            raise IOError('Invalid opening book')
+        if (side is not None and side != self.side) or \
+                (nplayers is not None and nplayers != self.nplayers):
+            logging.critical('Opening book %s is for side %d and %d players', filename,
+                self.side, self.nplayers)
+            raise IOError('Opening book built for another board')
+        self.mask = self.nbuckets - 1
+
+    def close(self):
+        self.data.close()
+
+    def __len__(self):
+        return self.nentries
+
+    def lookup(self, board, seat):
+        """Return the book move for seat in the position of board, or None.
+
+        Boards of another side or number of players are not in the book."""
+        if board.side != self.side or board.nplayers != self.nplayers:
+            return None
+        key = book_key(board, seat)
+        i = key & self.mask
+        # A valid book always has empty buckets, a corrupt one may not
+        for n in xrange(self.nbuckets):
+            k, m = bucket.unpack_from(self.data, header.size + i * bucket.size)
+            if k == key:
+                return m
+            if k == 0:
+                return None
+            i = (i + 1) & self.mask
+        return None
+
+def write_book(filename, entries, side, nplayers):
+    """Write a book holding entries, a dictionary mapping keys to moves, for
+    the given board side and number of players"""
+    nbuckets = 1
+    while nbuckets < 2 * len(entries):
+        nbuckets *= 2
+    table = [ (0, 0) ] * nbuckets
+    for key, m in entries.items():
+        i = key & (nbuckets - 1)
+        while table[i][0] != 0:
+            i = (i + 1) & (nbuckets - 1)
+        table[i] = (key, m)
+    f = open(filename, 'wb')
+    try:
+        f.write(header.pack(magic, version, nplayers, side, nbuckets, len(entries)))
+        for key, m in table:
+            f.write(bucket.pack(key, m))
+    finally:
+        f.close()
+
+def search_position(args):
+    """Search a position in a worker process. args is (snapshot, seat,
+    max_time). Returns the best move."""
+    snapshot, seat, max_time = args
+    board = quosnapshot.loads(snapshot)
+    ai = quoaiengine.QuoAIEngine(seat, max_time=max_time)
+    return ai.get_move(board)
+
+def build_book(side, nplayers, plies, max_time, workers):
+    """Search the positions of the first plies of the game.
+
+    In each position, the searched move and every legal pawn move are
+    expanded, so that the book also covers simple deviations from the
+    main line. Returns the dictionary of the book entries."""
+    entries = {}
+    pool = multiprocessing.Pool(workers)
+    try:
+        level = [ quosnapshot.dumps(quoserver.ServerBoard(side, nplayers,
+            [False] * nplayers)) ]
+        for ply in range(plies):
+            seat = ply % nplayers
+            boards = [ quosnapshot.loads(s) for s in level ]
+            # Transpositions are searched once
+            unique = {}
+            for b in boards:
+                unique.setdefault(book_key(b, seat), b)
+            keys = unique.keys()
+            moves = pool.map(search_position, [ (quosnapshot.dumps(unique[k]),
+                seat, max_time) for k in keys ])
+            logging.info('Ply %d: %d positions', ply, len(keys))
+            level = []
+            for k, m in zip(keys, moves):
+                if m is None:
+                    # No legal move
+                    continue
+                entries[k] = m
+                b = unique[k]
+                for m_next in set([m] + [ pawn_move(d) for d in [up, right, down, left] ]):
+                    if b.apply_move(seat, m_next):
+                        level.append(quosnapshot.dumps(b))
+                        b.restore_move(seat, m_next)
+    finally:
+        pool.terminate()
+    return entries
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a Quoridor opening book')
+    parser.add_argument('--side', type=int, default=9, help='board side')
+    parser.add_argument('--players', type=int, default=2, choices=[2, 3, 4],
+        help='number of players')
+    parser.add_argument('--plies', type=int, default=4,
+        help='number of plies covered by the book')
+    parser.add_argument('--ai-time', type=float, default=10.,
+        help='time budget of the search of each position in seconds')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+        help='number of worker processes')
+    parser.add_argument('--output', required=True, help='book file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+        format='%(asctime)s %(levelname)-8s %(message)s')
+    entries = build_book(args.side, args.players, args.plies, args.ai_time,
+        args.workers)
+    write_book(args.output, entries, args.side, args.players)
+    logging.info('%d positions written to %s', len(entries), args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""Vectorised computation of the distance fields.
+
+The distance fields of all the players are computed together, as a stacked
+array of shape (nplayers, side, side), by expanding the BFS wavefront of every
+player at once over the passability masks of the board.
+
+NumPy is optional: if it cannot be imported, numpy is None and callers should
+fall back to Board.init_dist."""
+
+from quoboard import up, right, down, left, visited_or_enqueued
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def passability(board):
+    """Return the passability masks of the board, as a dictionary of boolean
+    arrays indexed by direction. Each array is indexed as [x, y]."""
+    if isinstance(board.moves, list):
+        moves = numpy.array(board.moves, dtype=numpy.uint8)
+    else:
+        moves = numpy.array([ [ board.moves[x][y] for y in range(board.side) ]
+            for x in range(board.side) ], dtype=numpy.uint8)
+    return dict( (d, (moves & d).astype(bool)) for d in [up, right, down, left] )
+
+def goal_frontier(side, goals):
+    """Return the stacked boolean array of the goal squares of each player."""
+    frontier = numpy.zeros((len(goals), side, side), dtype=bool)
+    for i, g in enumerate(goals):
+        if g == up:
+            frontier[i, :, 0] = True
+        elif g == right:
+            frontier[i, side-1, :] = True
+        elif g == down:
+            frontier[i, :, side-1] = True
+        elif g == left:
+            frontier[i, 0, :] = True
+    return frontier
+
+def wavefront(pmasks, frontier):
+    """Expand all the BFS wavefronts in frontier at once.
+
+    Returns the stacked array of distances, -1 marking unreachable squares."""
+    u, r, d, l = pmasks[up], pmasks[right], pmasks[down], pmasks[left]
+    dists = numpy.where(frontier, 0, -1).astype(numpy.int32)
+    step = 0
+    while frontier.any():
+        step += 1
+        new = numpy.zeros_like(frontier)
+        new[:, :, :-1] |= frontier[:, :, 1:] & u[:, 1:]
+        new[:, 1:, :]  |= frontier[:, :-1, :] & r[:-1, :]
+        new[:, :, 1:]  |= frontier[:, :, :-1] & d[:, :-1]
+        new[:, :-1, :] |= frontier[:, 1:, :] & l[1:, :]
+        new &= dists < 0
+        dists[new] = step
+        frontier = new
+    return dists
+
+def goal_dists(board, goals):
+    """Return the stacked distance fields of the given goals."""
+    return wavefront(passability(board), goal_frontier(board.side, goals))
+
+def init_dists(board, goals, moves_status):
+    """Drop-in replacement for a sequence of Board.init_dist calls.
+
+    Returns the list of the distance fields (as lists of lists) and marks the
+    reachable squares in moves_status, one table per goal."""
+    dists = goal_dists(board, goals)
+    for i in range(len(goals)):
+        reached = (dists[i] >= 0).tolist()
+        for x in range(board.side):
+            for y in range(board.side):
+                if reached[x][y]:
+                    moves_status[i][x][y] |= visited_or_enqueued
+    return dists.tolist()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+"""Monte Carlo tree search engine.
+
+MCTSEngine is an alternative to QuoAIEngine with the same get_move(board)
+interface. Each iteration walks down the tree choosing children by UCB1
+(UCT), expands one untried move, plays a fast rollout from the new node and
+backs its result up the walked path. Results hold a reward for every seat,
+and each child is chosen for the pawn to move in its parent, so that 3 and
+4-player games are searched as max-n games.
+
+The branching factor is kept low by only searching the barriers cutting the
+shortest path of an opponent. Rollouts are guided by the distance fields:
+the pawns step down their field towards their goal and, now and then, place
+a barrier across the shortest path of the pawn in the lead. A rollout is cut
+after rollout_plies plies, and the race is then decided from the distances.
+
+The budget is a number of iterations or a time. With workers > 1, every
+worker process grows its own tree from a snapshot of the board (root
+parallelism) and the statistics of the root moves are summed.
+
+Example:
+    python quoselfplay.py --side 9 --players 4 --engine mcts --iterations 2000"""
+
+import quosnapshot
+from quoboard import vdir, steps, logging, pawn_move, barrier_move, move_to_str
+import math, random, time, multiprocessing
+
+# Budget of a search given neither a number of iterations nor a time
+default_iterations = 1000
+
+class SearchError(Exception):
+    """Raised when the search finds no move although the pawn has one."""
+    pass
+
+class Node:
+    """Node of the search tree"""
+
+    def __init__(self, move, seat, nplayers, parent=None):
+        # Move leading to the node, and seat of the pawn to move in the node
+        self.move = move
+        self.seat = seat
+        self.parent = parent
+        self.children = []
+        # Moves not expanded yet, generated on the first visit; the most
+        # promising one comes last
+        self.untried = None
+        # Whether untried was extended to all the barriers because none of
+        # the candidate moves was legal
+        self.widened = False
+        self.visits = 0
+        # Sum of the rewards of each seat over the visits
+        self.rewards = [ 0. ] * nplayers
+        # Seat of the pawn that reached its goal with move, if any
+        self.winner = None
+
+def search_worker(args):
+    """Grow a search tree in a worker process.
+
+    args is (snapshot, board_class, seat, iterations, max_time, seed,
+    options), options being the keyword arguments of the engine. Returns the
+    statistics of the root moves (see MCTSEngine.root_stats)."""
+    snapshot, board_class, seat, iterations, max_time, seed, options = args
+    random.seed(seed)
+    board = quosnapshot.loads(snapshot, board_class)
+    engine = MCTSEngine(seat, iterations=iterations, max_time=max_time, **options)
+    engine.board = board
+    engine.search()
+    return engine.root_stats()
+
+class MCTSEngine:
+    """Monte Carlo tree search engine."""
+
+    def __init__(self, seat, iterations=None, max_time=None, workers=1, exploration=1.,
+            rollout_plies=None, block_rate=0.2, book=None):
+        """The engine plays for the pawn of player seat.
+
+        The search stops after the given number of iterations or time (in
+        seconds), whichever comes first; with neither, it runs
+        default_iterations iterations. With workers > 1, iterations is the
+        total over the worker processes.
+
+        exploration is the UCB1 constant. Rollouts are cut after
+        rollout_plies plies (by default, twice the board side), and at each
+        ply the pawn to move tries to block the leader with probability
+        block_rate.
+
+        book is an optional quobook.OpeningBook, consulted before
+        searching."""
+        self.seat = seat
+        self.iterations = iterations
+        self.max_time = max_time
+        self.workers = workers
+        self.exploration = exploration
+        self.rollout_plies = rollout_plies
+        self.block_rate = block_rate
+        self.book = book
+        self.root = None
+        # Number of iterations of the last search, over all the workers
+        self.iterations_done = 0
+
+    def get_move(self, board):
+        """Given a board, choose the next move.
+
+        Returns None if my pawn has no legal move."""
+
+        self.board = board
+        if self.book is not None:
+            m = self.book.lookup(board, self.seat)
+            if m is not None and board.apply_move(self.seat, m):
+                board.restore_move(self.seat, m)
+                logging.debug('book move: %s', move_to_str(m, board.slots))
+                return m
+
+        if self.workers > 1:
+            stats = self.search_parallel()
+        else:
+            self.search()
+            stats = self.root_stats()
+        if not stats:
+            if board.first_legal_move(self.seat, [ pawn_move(d) for d, dx, dy in steps ] +
+                    [ barrier_move(s) for s in board.free_slots ]) is None:
+                logging.debug('No legal move for player %d', self.seat+1)
+                return None
+            logging.critical('No move found for player %d', self.seat+1)
+            raise SearchError('No move found for player %d' % (self.seat+1))
+        # The most visited move is the most robust choice
+        m = max(stats, key=lambda m: stats[m])
+        logging.debug('move chosen: %s (%d iterations)', move_to_str(m, board.slots),
+            self.iterations_done)
+        return m
+
+    def root_stats(self):
+        """Return the dictionary mapping the root moves to their number of
+        visits and total reward"""
+        return dict( (c.move, (c.visits, c.rewards[self.seat]))
+            for c in self.root.children )
+
+    def search(self):
+        """Grow a new tree from the current position until the budget is
+        exhausted"""
+        iterations = self.iterations
+        if iterations is None and self.max_time is None:
+            iterations = default_iterations
+        deadline = None if self.max_time is None else time.time() + self.max_time
+        self.root = Node(None, self.seat, self.board.nplayers)
+        k = 0
+        while True:
+            self.iterate()
+            k += 1
+            if (iterations is not None and k >= iterations) or \
+                    (deadline is not None and time.time() >= deadline):
+                break
+        self.iterations_done = k
+
+    def search_parallel(self):
+        """Grow one tree per worker process and sum their root statistics"""
+        iterations = self.iterations
+        if iterations is None and self.max_time is None:
+            iterations = default_iterations
+        if iterations is not None:
+            iterations = max(1, iterations // self.workers)
+        options = {
+            'exploration':      self.exploration,
+            'rollout_plies':    self.rollout_plies,
+            'block_rate':       self.block_rate
+        }
+        snapshot = quosnapshot.dumps(self.board)
+        tasks = [ (snapshot, type(self.board), self.seat, iterations, self.max_time,
+            random.getrandbits(32), options) for k in range(self.workers) ]
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            results = pool.map(search_worker, tasks)
+        finally:
+            pool.terminate()
+        stats = {}
+        for r in results:
+            for m, (visits, reward) in r.items():
+                v, w = stats.get(m, (0, 0.))
+                stats[m] = (v + visits, w + reward)
+        self.iterations_done = sum( v for v, w in stats.values() )
+        return stats
+
+    def iterate(self):
+        """Run one iteration: selection, expansion, rollout and
+        back-propagation"""
+        board = self.board
+        n = board.nplayers
+        node = self.root
+        played = []
+
+        # Walk down the fully expanded nodes
+        while node.winner is None and not node.untried and node.children:
+            seat = node.seat
+            node = self.select(node)
+            board.apply_move(seat, node.move)
+            played.append((seat, node.move))
+
+        # Expand one move
+        if node.winner is None:
+            if node.untried is None:
+                node.untried = self.candidate_moves(node.seat)
+            child = self.expand(node, played)
+            if child is None and not node.children and not node.widened:
+                # None of the candidates is legal: try all the barriers
+                node.widened = True
+                node.untried = [ barrier_move(s) for s in board.free_slots ]
+                random.shuffle(node.untried)
+                child = self.expand(node, played)
+            if child is not None:
+                node = child
+
+        if node.winner is None:
+            rewards = self.rollout(node.seat)
+        else:
+            rewards = [ 0. ] * n
+            rewards[node.winner] = 1.
+
+        while node is not None:
+            node.visits += 1
+            for i in range(n):
+                node.rewards[i] += rewards[i]
+            node = node.parent
+        for i, m in reversed(played):
+            board.restore_move(i, m)
+
+    def expand(self, node, played):
+        """Apply the first legal move left untried in node, appending it to
+        played, and return its new child node, or None if no untried move
+        is legal"""
+        board = self.board
+        n = board.nplayers
+        while node.untried:
+            m = node.untried.pop()
+            if board.apply_move(node.seat, m):
+                played.append((node.seat, m))
+                child = Node(m, (node.seat + 1) % n, n, node)
+                if not m & 1 and board.check_win(node.seat):
+                    child.winner = node.seat
+                node.children.append(child)
+                return child
+        return None
+
+    def select(self, node):
+        """Return the child of node with the best UCB1 value for the pawn to
+        move in node"""
+        seat = node.seat
+        c = self.exploration
+        log_visits = math.log(node.visits)
+        best = None
+        for child in node.children:
+            value = child.rewards[seat] / child.visits + \
+                c * math.sqrt(log_visits / child.visits)
+            if best is None or value > best_value:
+                best, best_value = child, value
+        return best
+
+    def candidate_moves(self, seat):
+        """Return the moves searched for the pawn in the given seat: its pawn
+        moves, and the barriers cutting the shortest path of another pawn.
+        The pawn moves come last, the one going down the distance field
+        last of all. If none of them is legal, iterate falls back to all
+        the barriers."""
+        board = self.board
+        p = board.pp[seat]
+        x, y = p.position
+        dist = board.player_dists(seat)
+        slots = set()
+        for i in range(board.nplayers):
+            if i != seat:
+                for e in board.shortest_path(i):
+                    slots.update(board.slots.edge_slots.get(e, ()))
+        moves = [ barrier_move(s) for s in slots if s in board.free_slots ]
+        random.shuffle(moves)
+        directions = [ d for d, dx, dy in steps if board.moves[x][y] & d ]
+        directions.sort(key=lambda d: -dist[x+vdir[d][0]][y+vdir[d][1]])
+        moves.extend( pawn_move(d) for d in directions )
+        return moves
+
+    def plies_to_win(self, i, seat):
+        """Return the number of plies pawn i needs to reach its goal if
+        nobody blocks it, seat being the pawn to move"""
+        board = self.board
+        x, y = board.pp[i].position
+        return board.player_dists(i)[x][y] * board.nplayers + (i - seat) % board.nplayers
+
+    def leader(self, seat):
+        """Return the seat of the other pawn closest to winning, seat being
+        the pawn to move"""
+        return min( (i for i in range(self.board.nplayers) if i != seat),
+            key=lambda i: self.plies_to_win(i, seat) )
+
+    def rollout_move(self, seat):
+        """Choose and apply a rollout move for the pawn in the given seat.
+        Returns the move, or None if the pawn cannot move."""
+        board = self.board
+        p = board.pp[seat]
+        if random.random() < self.block_rate:
+            path = board.shortest_path(self.leader(seat))
+            if path:
+                slots = board.slots.edge_slots.get(random.choice(path), [])
+                for s in random.sample(slots, len(slots)):
+                    if s in board.free_slots and board.apply_move(seat, barrier_move(s)):
+                        return barrier_move(s)
+        dist = board.player_dists(seat)
+        x, y = p.position
+        directions = [ d for d, dx, dy in steps if board.moves[x][y] & d ]
+        directions.sort(key=lambda d: dist[x+vdir[d][0]][y+vdir[d][1]])
+        for d in directions:
+            if board.apply_move(seat, pawn_move(d)):
+                return pawn_move(d)
+        return None
+
+    def rollout(self, seat):
+        """Play a fast game from the current position, seat being the pawn to
+        move, and take it back. Returns the rewards of the seats."""
+        board = self.board
+        n = board.nplayers
+        rewards = [ 0. ] * n
+        played = []
+        winner = None
+        for ply in range(self.rollout_plies or 2 * board.side):
+            m = self.rollout_move(seat)
+            if m is not None:
+                played.append((seat, m))
+                if not m & 1 and board.check_win(seat):
+                    winner = seat
+                    break
+            seat = (seat + 1) % n
+        if winner is None:
+            # The race is won by the pawn needing the fewest plies
+            winner = min(range(n), key=lambda i: self.plies_to_win(i, seat))
+        rewards[winner] = 1.
+        for i, m in reversed(played):
+            board.restore_move(i, m)
+        return rewards
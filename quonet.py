@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+
+"""Network server hosting many concurrent games.
+
+A single-threaded asyncore event loop serves any number of independent
+ServerBoard games over TCP. AI turns are computed by a pool of worker
+processes, so that they never block the event loop: each request carries
+a snapshot of the board (see quosnapshot).
+
+The protocol is line based. Client commands:
+
+    NEW <side> <nplayers> <nai>   create a game, the last nai seats being AI
+    LIST                          list the games waiting for players
+    JOIN <game> [<token>]         take a free seat, or take back a seat (the
+                                  only way in once the game has started)
+    MOVE <move>                   "m d" or "b x y d", as in move_to_str
+    PASS                          pass, allowed only without any legal move
+    BOARD                         describe the current position
+    QUIT
+
+Server replies and events:
+
+    GAME <game>
+    GAMES <game>:<free seats> ...
+    JOINED <game> <seat> <token>  the token (pawn hash) identifies the seat
+    START <side> <nplayers>
+    TURN <seat>
+    MOVED <seat> <move>
+    PASSED <seat>                 the pawn of seat had no legal move
+    WIN <seat>
+    DRAW                          nobody can move any more
+    POSITIONS <x>,<y> ...
+    BARRIERS <x>,<y>,<d> ...
+    OK
+    ERR <message>
+
+Example:
+    python quonet.py --port 7070 --ai-time 1
+    python quonet.py --max-side 101 --backend compact"""
+
+import quoserver, quoaiengine, quosnapshot, quobook
+from quoboard import up, right, down, left, logging, pawn_move, barrier_move, \
+    move_to_str, move_from_str
+import asyncore, asynchat, socket, os, Queue, argparse, multiprocessing
+
+# Opening books opened by a worker process, by file name
+books = {}
+# Distance field cache of a worker process, shared by all the games it
+# computes moves for
+dist_cache = None
+# Returned by ai_move when the AI failed, None meaning a pass
+ai_failure = -1
+
+def ai_move(args):
+    """Compute an AI move in a worker process.
+
+    args is (snapshot, board_class, seat, max_time, mode, book, cache_size),
+    book being the file name of the opening book or None, and cache_size the
+    size of the distance field cache in bytes (0 for none). Returns the
+    move, None if the AI has no legal move, or ai_failure if it failed: the
+    pool has no error callback, so exceptions must not escape."""
+    global dist_cache
+    snapshot, board_class, seat, max_time, mode, book, cache_size = args
+    try:
+        board = quosnapshot.loads(snapshot, board_class)
+        if cache_size > 0:
+            if dist_cache is None:
+                dist_cache = quoserver.DistCache(cache_size)
+            board.dist_cache = dist_cache
+        if book is not None and book not in books:
+            books[book] = quobook.OpeningBook(book)
+        ai = quoaiengine.QuoAIEngine(seat, max_time=max_time, mode=mode,
+            book=books.get(book))
+        return ai.get_move(board)
+    except Exception:
+        logging.exception('AI move of seat %d failed', seat)
+        return ai_failure
+
+class Game:
+    """A game hosted by the server"""
+
+    def __init__(self, gid, side, nplayers, nai, board_class=quoserver.ServerBoard):
+        self.gid = gid
+        self.board = board_class(side, nplayers, [False] * nplayers)
+        self.ai = [ i >= nplayers - nai for i in range(nplayers) ]
+        # Connection of each human seat
+        self.seats = [ None ] * nplayers
+        # (seat, move) pairs, move being None for a pass
+        self.history = []
+        self.turn = 0
+        # Number of passes in a row
+        self.passes = 0
+        self.started = False
+        self.finished = False
+        self.thinking = False
+
+    def free_seats(self):
+        return [ i for i in range(self.board.nplayers)
+            if not self.ai[i] and self.seats[i] is None ]
+
+    def broadcast(self, line):
+        for c in self.seats:
+            if c is not None:
+                c.send_line(line)
+
+    def play(self, seat, m):
+        """Play move m for the given seat. Returns False if it is illegal."""
+        if not self.board.apply_move(seat, m):
+            return False
+        self.board.forget_moves()
+        self.history.append((seat, m))
+        self.passes = 0
+        self.broadcast('MOVED %d %s' % (seat, move_to_str(m, self.board.slots)))
+        if self.board.check_win(seat):
+            self.finished = True
+            self.broadcast('WIN %d' % seat)
+        else:
+            self.next_seat()
+        return True
+
+    def can_move(self, seat):
+        """Whether the pawn of seat has a legal move"""
+        moves = [ pawn_move(d) for d in [up, right, down, left] ] + \
+            [ barrier_move(s) for s in self.board.free_slots ]
+        return self.board.first_legal_move(seat, moves) is not None
+
+    def pass_turn(self, seat):
+        """Let the given seat, which has no legal move, pass. The game is
+        drawn once every seat has passed in a row, as the position cannot
+        change any more."""
+        self.history.append((seat, None))
+        self.passes += 1
+        self.broadcast('PASSED %d' % seat)
+        if self.passes == self.board.nplayers:
+            self.finished = True
+            self.broadcast('DRAW')
+        else:
+            self.next_seat()
+
+    def next_seat(self):
+        self.turn = (self.turn + 1) % self.board.nplayers
+        self.broadcast('TURN %d' % self.turn)
+
+    def describe(self):
+        b = self.board
+        return [
+            'POSITIONS ' + ' '.join( '%d,%d' % p.position for p in b.pp ),
+            'BARRIERS ' + ' '.join( '%d,%d,%d' % (s.position[0], s.position[1], s.direction)
+                for s in b.barriers ),
+            'TURN %d' % self.turn ]
+
+class Connection(asynchat.async_chat):
+    """A client connection"""
+
+    def __init__(self, sock, server):
+        asynchat.async_chat.__init__(self, sock)
+        self.server = server
+        self.buffer = []
+        self.game = None
+        self.seat = None
+        self.set_terminator('\n')
+
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+        if sum( len(d) for d in self.buffer ) > 1024:
+            self.send_line('ERR line too long')
+            self.close_when_done()
+
+    def found_terminator(self):
+        line = ''.join(self.buffer).strip()
+        self.buffer = []
+        if not line:
+            return
+        words = line.split()
+        command = 'do_' + words[0].lower()
+        if not hasattr(self, command):
+            self.send_line('ERR unknown command %s' % words[0])
+            return
+        try:
+            getattr(self, command)(words[1:])
+        except (ValueError, IndexError):
+            self.send_line('ERR bad arguments')
+
+    def send_line(self, line):
+        self.push(line + '\n')
+
+    def do_new(self, args):
+        side, nplayers, nai = int(args[0]), int(args[1]), int(args[2])
+        if not 3 <= side <= self.server.max_side or nplayers not in (2, 3, 4) \
+                or not 0 <= nai < nplayers:
+            self.send_line('ERR bad game parameters')
+            return
+        g = self.server.new_game(side, nplayers, nai)
+        self.send_line('GAME %d' % g.gid)
+
+    def do_list(self, args):
+        self.send_line('GAMES ' + ' '.join( '%d:%d' % (g.gid, len(g.free_seats()))
+            for g in self.server.games.values() if not g.started ))
+
+    def do_join(self, args):
+        if self.game is not None:
+            self.send_line('ERR already in a game')
+            return
+        g = self.server.games.get(int(args[0]))
+        if g is None:
+            self.send_line('ERR no such game')
+            return
+        if len(args) > 1:
+            # Take back a seat, e.g. after a lost connection
+            seats = [ i for i in range(g.board.nplayers)
+                if not g.ai[i] and g.board.pp[i].h == args[1] ]
+            if not seats or g.seats[seats[0]] is not None:
+                self.send_line('ERR bad token')
+                return
+            seat = seats[0]
+        elif g.started:
+            # The free seats of a started game were left by players who may
+            # come back with their token
+            self.send_line('ERR game already started')
+            return
+        else:
+            free = g.free_seats()
+            if not free:
+                self.send_line('ERR game is full')
+                return
+            seat = free[0]
+        g.seats[seat] = self
+        self.game, self.seat = g, seat
+        self.send_line('JOINED %d %d %s' % (g.gid, seat, g.board.pp[seat].h))
+        if g.started:
+            for line in g.describe():
+                self.send_line(line)
+        elif not g.free_seats():
+            g.started = True
+            g.broadcast('START %d %d' % (g.board.side, g.board.nplayers))
+            g.broadcast('TURN 0')
+            self.server.next_turn(g)
+
+    def my_turn(self):
+        """Whether the client may play now, replying an error if not"""
+        g = self.game
+        if g is None or not g.started or g.finished:
+            self.send_line('ERR no game in progress')
+            return False
+        if g.turn != self.seat:
+            self.send_line('ERR not your turn')
+            return False
+        return True
+
+    def do_move(self, args):
+        if not self.my_turn():
+            return
+        g = self.game
+        m = move_from_str(' '.join(args), g.board.slots)
+        if m is None or (not m & 1 and m >> 1 not in (up, right, down, left)) \
+                or not g.play(self.seat, m):
+            self.send_line('ERR illegal move')
+            return
+        self.server.next_turn(g)
+
+    def do_pass(self, args):
+        if not self.my_turn():
+            return
+        g = self.game
+        if g.can_move(self.seat):
+            self.send_line('ERR you have a legal move')
+            return
+        g.pass_turn(self.seat)
+        self.server.next_turn(g)
+
+    def do_board(self, args):
+        if self.game is None:
+            self.send_line('ERR not in a game')
+            return
+        for line in self.game.describe():
+            self.send_line(line)
+
+    def do_quit(self, args):
+        self.send_line('OK')
+        self.close_when_done()
+
+    def handle_close(self):
+        if self.game is not None:
+            self.game.seats[self.seat] = None
+            self.server.forget_game(self.game)
+            self.game = None
+        self.close()
+
+class Wakeup(asyncore.file_dispatcher):
+    """Read end of the pipe used by the pool threads to wake up the event
+    loop when an AI move is ready"""
+
+    def __init__(self, fd, server):
+        asyncore.file_dispatcher.__init__(self, fd)
+        self.server = server
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        self.server.collect_ai_moves()
+
+class QuoNetServer(asyncore.dispatcher):
+    """Listening socket and table of the games"""
+
+    def __init__(self, host, port, workers, ai_time, mode='paranoid', max_side=31, book=None,
+            dist_cache=0, backend='list'):
+        # Fork the workers first, so that they do not inherit the sockets
+        self.pool = multiprocessing.Pool(workers)
+        asyncore.dispatcher.__init__(self)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(128)
+        self.games = {}
+        self.next_gid = 1
+        self.ai_time = ai_time
+        self.mode = mode
+        self.book = book
+        # Size of the distance field cache of each worker, in bytes
+        self.dist_cache = dist_cache
+        self.max_side = max_side
+        self.board_class = quoserver.board_backends[backend]
+        # AI moves are handed over from the pool threads through a queue
+        self.ai_moves = Queue.Queue()
+        rfd, self.wakeup_fd = os.pipe()
+        self.wakeup = Wakeup(rfd, self)
+        os.close(rfd)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            Connection(pair[0], self)
+
+    def new_game(self, side, nplayers, nai):
+        g = Game(self.next_gid, side, nplayers, nai, self.board_class)
+        self.games[g.gid] = g
+        self.next_gid += 1
+        return g
+
+    def forget_game(self, g):
+        """Drop g if it is over or nobody is connected to it any more"""
+        if g.finished or all( c is None for c in g.seats ):
+            self.games.pop(g.gid, None)
+
+    def next_turn(self, g):
+        """Dispatch the AI turn, if any"""
+        if g.finished:
+            self.forget_game(g)
+        elif g.ai[g.turn] and not g.thinking:
+            g.thinking = True
+            gid, ply = g.gid, len(g.history)
+            def done(m):
+                self.ai_moves.put((gid, ply, m))
+                os.write(self.wakeup_fd, 'x')
+            self.pool.apply_async(ai_move, ((quosnapshot.dumps(g.board), self.board_class,
+                g.turn, self.ai_time, self.mode, self.book, self.dist_cache),), callback=done)
+
+    def collect_ai_moves(self):
+        while True:
+            try:
+                gid, ply, m = self.ai_moves.get_nowait()
+            except Queue.Empty:
+                return
+            g = self.games.get(gid)
+            if g is None or len(g.history) != ply:
+                # The game was abandoned in the meantime
+                continue
+            g.thinking = False
+            if m is None:
+                g.pass_turn(g.turn)
+            elif m == ai_failure or not g.play(g.turn, m):
+                if m == ai_failure:
+                    logging.error('Game %d: no AI move', gid)
+                else:
+                    logging.error('Game %d: illegal AI move %s', gid, move_to_str(m, g.board.slots))
+                g.finished = True
+                g.broadcast('ERR AI failure')
+            self.next_turn(g)
+
+def main():
+    parser = argparse.ArgumentParser(description='Quoridor network server')
+    parser.add_argument('--host', default='', help='address to listen on')
+    parser.add_argument('--port', type=int, default=7070, help='TCP port')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+        help='number of AI worker processes')
+    parser.add_argument('--ai-time', type=float, default=1.,
+        help='time budget of an AI move in seconds')
+    parser.add_argument('--mode', default='paranoid', choices=['paranoid', 'maxn'],
+        help='AI search mode for 3 or 4 players')
+    parser.add_argument('--book', default=None, help='opening book file')
+    parser.add_argument('--max-side', type=int, default=31, help='largest board side')
+    parser.add_argument('--backend', default='list',
+        choices=sorted(quoserver.board_backends.keys()),
+        help='board backend (compact for large boards)')
+    parser.add_argument('--dist-cache', type=float, default=16,
+        help='size of the distance field cache of each worker in MB (0: no cache)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+        format='%(asctime)s %(levelname)-8s %(message)s')
+    server = QuoNetServer(args.host, args.port, args.workers, args.ai_time, args.mode,
+        max_side=args.max_side, book=args.book, dist_cache=int(args.dist_cache * (1 << 20)),
+        backend=args.backend)
+    logging.info('Listening on port %d', args.port)
+    try:
+        asyncore.loop(use_poll=True)
+    finally:
+        server.pool.terminate()
+
+if __name__ == '__main__':
+    main()
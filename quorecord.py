@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+"""Game records.
+
+A record is an append-only file: the moves are written (and flushed) one by
+one as they are played, and a checkpoint holding a full snapshot of the
+board (see quosnapshot) is written every interval moves. Seeking to any ply
+thus loads the last checkpoint before it and replays at most interval-1
+moves.
+
+Layout (little endian):
+
+    header          magic "QUOR", version, checkpoint interval
+    records         a type byte followed by its payload:
+        "C"         ply, snapshot length, snapshot (ply 0 comes first)
+        "M"         seat, move (as encoded by quoboard.pawn_move and
+                    quoboard.barrier_move)
+        "E"         winner seat, 255 if there is none
+        "X"         number of checkpoints, then (ply, offset) of each
+    trailer         offset of the "X" record, magic "QEND"
+
+The "E" and "X" records and the trailer are written when the game is over.
+A record without them (e.g. after a crash) can still be read: the
+checkpoints are then found by scanning the file."""
+
+import quoserver, quosnapshot
+import struct, bisect
+
+magic = 'QUOR'
+end_magic = 'QEND'
+version = 1
+no_winner = 255
+
+header = struct.Struct('<4sBI')
+checkpoint_record = struct.Struct('<II')
+move_record = struct.Struct('<BI')
+end_record = struct.Struct('<B')
+index_entry = struct.Struct('<II')
+count = struct.Struct('<I')
+trailer = struct.Struct('<I4s')
+
+class RecordError(Exception):
+    """Raised when a game record cannot be decoded."""
+    pass
+
+class GameRecorder:
+    """Writer of a game record"""
+
+    def __init__(self, filename, board, interval=32):
+        """Start recording the game played on board, from its current
+        position"""
+        self.f = open(filename, 'wb')
+        self.interval = interval
+        self.ply = 0
+        self.checkpoints = []
+        self.f.write(header.pack(magic, version, interval))
+        self.checkpoint(board)
+
+    def checkpoint(self, board):
+        data = quosnapshot.dumps(board, dists=False)
+        self.checkpoints.append((self.ply, self.f.tell()))
+        self.f.write('C' + checkpoint_record.pack(self.ply, len(data)) + data)
+        self.f.flush()
+
+    def record(self, seat, m, board):
+        """Record move m of the given seat, board being the position after
+        the move"""
+        self.f.write('M' + move_record.pack(seat, m))
+        self.ply += 1
+        if self.ply % self.interval == 0:
+            self.checkpoint(board)
+        else:
+            self.f.flush()
+
+    def finish(self, winner=None):
+        """Write the end of the record and close it"""
+        self.f.write('E' + end_record.pack(no_winner if winner is None else winner))
+        index_offset = self.f.tell()
+        self.f.write('X' + count.pack(len(self.checkpoints)))
+        for ply, offset in self.checkpoints:
+            self.f.write(index_entry.pack(ply, offset))
+        self.f.write(trailer.pack(index_offset, end_magic))
+        self.f.close()
+
+class GameRecord:
+    """Reader of a game record.
+
+    The file is read incrementally: iterating over the moves of a record of
+    any size takes constant memory."""
+
+    def __init__(self, filename, board_class=None):
+        self.f = open(filename, 'rb')
+        # Class of the boards returned by board_at (by default ServerBoard)
+        self.board_class = board_class
+        m, v, self.interval = header.unpack(self.read(header.size))
+        if m != magic:
+            raise RecordError('Not a game record')
+        if v != version:
+            raise RecordError('Unsupported record version %d' % v)
+        self.start = self.f.tell()
+        self.index = None
+        self.winner = None
+
+    def close(self):
+        self.f.close()
+
+    def read(self, n):
+        data = self.f.read(n)
+        if len(data) != n:
+            raise RecordError('Truncated record')
+        return data
+
+    def records(self, offset=None):
+        """Iterate over the records starting at offset (by default, the
+        first one), yielding (offset, type, payload) tuples. The payload of a
+        checkpoint is (ply, snapshot), the one of a move is (seat, move) and
+        the one of the end of the game is the winner."""
+        self.f.seek(self.start if offset is None else offset)
+        while True:
+            offset = self.f.tell()
+            t = self.f.read(1)
+            try:
+                if t == 'C':
+                    ply, n = checkpoint_record.unpack(self.read(checkpoint_record.size))
+                    payload = (ply, self.read(n))
+                elif t == 'M':
+                    payload = move_record.unpack(self.read(move_record.size))
+                elif t == 'E':
+                    winner = end_record.unpack(self.read(end_record.size))[0]
+                    self.winner = None if winner == no_winner else winner
+                    payload = self.winner
+                elif t == 'X' or t == '':
+                    return
+                else:
+                    raise RecordError('Unknown record type %r at offset %d' % (t, offset))
+            except RecordError:
+                if self.f.read(1) == '':
+                    # The last record was cut short: the writer was
+                    # interrupted
+                    return
+                raise
+            position = self.f.tell()
+            yield offset, t, payload
+            # The consumer may have used the file in the meantime
+            self.f.seek(position)
+
+    def moves(self):
+        """Iterate over the moves, as (ply, seat, move) tuples; ply counts
+        the moves from 1"""
+        ply = 0
+        for offset, t, payload in self.records():
+            if t == 'M':
+                ply += 1
+                yield (ply,) + payload
+
+    def checkpoints(self):
+        """Return the list of the (ply, offset) pairs of the checkpoints"""
+        if self.index is None:
+            self.index = self.read_index()
+        if self.index is None:
+            # No index at the end of the file: scan it
+            self.index = [ (payload[0], offset) for offset, t, payload in self.records()
+                if t == 'C' ]
+        return self.index
+
+    def read_index(self):
+        """Read the index written at the end of a complete record, or return
+        None"""
+        self.f.seek(0, 2)
+        if self.f.tell() < self.start + trailer.size:
+            return None
+        self.f.seek(-trailer.size, 2)
+        index_offset, m = trailer.unpack(self.f.read(trailer.size))
+        if m != end_magic:
+            return None
+        self.f.seek(index_offset)
+        if self.f.read(1) != 'X':
+            raise RecordError('Corrupt record index')
+        n = count.unpack(self.read(count.size))[0]
+        return [ index_entry.unpack(self.read(index_entry.size)) for i in range(n) ]
+
+    def board_at(self, ply):
+        """Return the board after the given number of moves"""
+        index = self.checkpoints()
+        k = bisect.bisect_right([ p for p, offset in index ], ply) - 1
+        if k < 0:
+            raise RecordError('No checkpoint before ply %d' % ply)
+        board = None
+        for offset, t, payload in self.records(index[k][1]):
+            if board is None:
+                if t != 'C':
+                    raise RecordError('No checkpoint at offset %d' % offset)
+                current, data = payload
+                try:
+                    board = quosnapshot.loads(data, self.board_class)
+                except quosnapshot.SnapshotError as e:
+                    raise RecordError('Corrupt checkpoint at ply %d: %s' % (current, e))
+            elif current == ply:
+                break
+            elif t == 'M':
+                seat, m = payload
+                if not board.apply_move(seat, m):
+                    raise RecordError('Illegal move at ply %d' % (current+1))
+                current += 1
+        if board is None:
+            raise RecordError('No checkpoint at offset %d' % index[k][1])
+        if current != ply:
+            raise RecordError('The game has only %d moves' % current)
+        board.forget_moves()
+        return board
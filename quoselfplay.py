@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+"""Headless self-play.
+
+Plays AI-vs-AI games without any user interface, spread over a pool of
+worker processes. Writes one JSON line per game and prints aggregate
+statistics (win rates, game lengths, moves per second). Games can also be
+saved as game records (see quorecord).
+
+Large boards (sides 51 to 101) should be played with the compact backend,
+and with a bound on the barriers searched per node so that the time per
+move does not grow with the side.
+
+Examples:
+    python quoselfplay.py --side 9 --players 4 --games 1000 --ai-time 1 \\
+        --output results.jsonl
+    python quoselfplay.py --side 101 --games 10 --backend compact --max-barriers 16"""
+
+import quoserver, quoboard, quorecord, quobook, quomcts
+from quoboard import logging
+import random, time, json, argparse, multiprocessing, os.path
+
+# Opening book, opened by main before the worker processes are forked so
+# that they all share its mapping
+book = None
+
+def play_game(args):
+    """Play one game. args is a (seed, options) pair, options being a
+    dictionary of the command-line options.
+
+    Returns a dictionary describing the game. A pawn with no legal move
+    passes its turn, listed as None in the moves."""
+
+    seed, options = args
+    random.seed(seed)
+    nplayers = options['players']
+    board = quoserver.board_backends[options['backend']](options['side'], nplayers,
+        [True] * nplayers)
+    if options['dist_cache'] > 0:
+        board.dist_cache = quoserver.DistCache(int(options['dist_cache'] * (1 << 20)))
+    for p in board.pp:
+        p.ai.max_time = options['ai_time']
+        p.ai.mode = options['mode']
+        p.ai.book = book
+        if options['max_barriers'] > 0:
+            p.ai.max_barriers = options['max_barriers']
+    # The random opening moves are drawn from the moves of the minimax engines
+    if options['engine'] == 'mcts':
+        engines = [ quomcts.MCTSEngine(p.seat, iterations=options['iterations'],
+            max_time=options['ai_time'], book=book) for p in board.pp ]
+    else:
+        engines = [ p.ai for p in board.pp ]
+    if options['records']:
+        recorder = quorecord.GameRecorder(
+            os.path.join(options['records'], 'game-%d.quo' % seed), board)
+    else:
+        recorder = None
+
+    winner = None
+    moves = []
+    # Number of players in a row who passed their turn
+    passes = 0
+    start = time.time()
+    while winner is None and len(moves) < options['max_plies']:
+        i = len(moves) % nplayers
+        p = board.pp[i]
+        if len(moves) < options['opening_plies']:
+            # Random opening, so that games with different seeds differ
+            p.ai.board = board
+            candidates = p.ai.possible_moves(p)
+            random.shuffle(candidates)
+            m = board.first_legal_move(i, candidates)
+        else:
+            m = engines[i].get_move(board)
+        if m is None:
+            # The pawn has no legal move and passes its turn. The game is a
+            # draw when nobody can move.
+            passes += 1
+            if passes == nplayers:
+                break
+            moves.append(None)
+            continue
+        if not board.apply_move(i, m):
+            logging.error('Game %d: illegal move %s from player %d', seed,
+                quoboard.move_to_str(m, board.slots), i+1)
+            break
+        passes = 0
+        board.forget_moves()
+        moves.append(quoboard.move_to_str(m, board.slots))
+        if recorder is not None:
+            recorder.record(i, m, board)
+        if board.check_win(i):
+            winner = i
+    elapsed = time.time() - start
+    if recorder is not None:
+        recorder.finish(winner)
+
+    r = {
+        'seed':     seed,
+        'side':     options['side'],
+        'players':  nplayers,
+        'winner':   winner,
+        'plies':    len(moves),
+        'time':     elapsed,
+        'moves':    moves
+    }
+    if board.dist_cache is not None:
+        r['dist_cache'] = board.dist_cache.as_dict()
+    return r
+
+def summarise(results):
+    """Compute aggregate statistics over a list of game results"""
+    ngames = len(results)
+    nplayers = results[0]['players'] if results else 0
+    wins = [ 0 ] * nplayers
+    draws = 0
+    for r in results:
+        if r['winner'] is None:
+            draws += 1
+        else:
+            wins[r['winner']] += 1
+    plies = sorted( r['plies'] for r in results )
+    total_time = sum( r['time'] for r in results )
+    summary = {
+        'games':            ngames,
+        'win_rates':        [ float(w) / ngames for w in wins ] if ngames else [],
+        'draw_rate':        float(draws) / ngames if ngames else 0.,
+        'mean_plies':       float(sum(plies)) / ngames if ngames else 0.,
+        'median_plies':     plies[ngames/2] if ngames else 0,
+        'moves_per_second': sum(plies) / total_time if total_time > 0 else 0.
+    }
+    caches = [ r['dist_cache'] for r in results if 'dist_cache' in r ]
+    if caches:
+        hits = sum( c['hits'] for c in caches )
+        lookups = hits + sum( c['misses'] for c in caches )
+        summary['dist_cache_hit_rate'] = float(hits) / lookups if lookups else 0.
+        summary['dist_cache_evictions'] = sum( c['evictions'] for c in caches )
+    return summary
+
+def main():
+    global book
+    parser = argparse.ArgumentParser(description='Headless Quoridor self-play')
+    parser.add_argument('--side', type=int, default=9, help='board side')
+    parser.add_argument('--players', type=int, default=2, choices=[2, 3, 4],
+        help='number of players')
+    parser.add_argument('--games', type=int, default=100, help='number of games')
+    parser.add_argument('--seed', type=int, default=0,
+        help='seed of the first game; game k uses seed+k')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+        help='number of worker processes')
+    parser.add_argument('--ai-time', type=float, default=None,
+        help='time budget per move in seconds (default: fixed-depth search)')
+    parser.add_argument('--mode', default='paranoid', choices=['paranoid', 'maxn'],
+        help='search mode for 3 or 4 players')
+    parser.add_argument('--engine', default='minimax', choices=['minimax', 'mcts'],
+        help='AI engine')
+    parser.add_argument('--iterations', type=int, default=None,
+        help='iterations per move of the mcts engine (default: %d, or as many '
+        'as --ai-time allows)' % quomcts.default_iterations)
+    parser.add_argument('--opening-plies', type=int, default=2,
+        help='number of random moves at the start of each game')
+    parser.add_argument('--max-plies', type=int, default=1000,
+        help='games longer than this are counted as draws')
+    parser.add_argument('--output', default=None,
+        help='file receiving one JSON line per game')
+    parser.add_argument('--book', default=None, help='opening book file')
+    parser.add_argument('--records', default=None,
+        help='directory receiving the game records')
+    parser.add_argument('--dist-cache', type=float, default=16,
+        help='size of the distance field cache of each game in MB (0: no cache)')
+    parser.add_argument('--backend', default='list',
+        choices=sorted(quoserver.board_backends.keys()),
+        help='board backend (compact for large boards)')
+    parser.add_argument('--max-barriers', type=int, default=0,
+        help='barriers searched per node by the minimax engine (0: all)')
+    args = parser.parse_args()
+
+    # Nobody reads the debug log of a batch run
+    logging.getLogger().setLevel(logging.WARNING)
+
+    options = {
+        'side':         args.side,
+        'players':      args.players,
+        'ai_time':      args.ai_time,
+        'mode':         args.mode,
+        'engine':       args.engine,
+        'iterations':   args.iterations,
+        'opening_plies': args.opening_plies,
+        'max_plies':    args.max_plies,
+        'records':      args.records,
+        'dist_cache':   args.dist_cache,
+        'backend':      args.backend,
+        'max_barriers': args.max_barriers
+    }
+    tasks = [ (args.seed + k, options) for k in range(args.games) ]
+
+    if args.book:
+        book = quobook.OpeningBook(args.book, args.side, args.players)
+
+    out = open(args.output, 'w') if args.output else None
+    results = []
+    start = time.time()
+    pool = multiprocessing.Pool(args.workers)
+    try:
+        for r in pool.imap_unordered(play_game, tasks):
+            results.append(r)
+            if out:
+                out.write(json.dumps(r) + '\n')
+                out.flush()
+    finally:
+        pool.terminate()
+        if out:
+            out.close()
+        if book is not None:
+            book.close()
+
+    summary = summarise(results)
+    summary['wall_time'] = time.time() - start
+    print json.dumps(summary, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,10 @@
 #!/usr/bin/env python
 
-import quoboard, quoui, quoaiengine
-import random, time, curses.wrapper#, copy
+import quoboard, quoui, quoaiengine, quodist, quotrace, quorecord, quobook, quomcts
+import random, time, os.path, array, curses.wrapper#, copy
 
-from quoboard import up, right, down, left, vdir, logging, length, enqueued, visited, visited_or_enqueued
-from collections import deque
+from quoboard import up, right, down, left, vdir, steps, logging, length, enqueued, visited, visited_or_enqueued, pawn_move, barrier_move
+from collections import deque, OrderedDict
 
 
 
@@ -14,190 +14,528 @@ from collections import deque
 class Pawn:
     """Pawn class"""
 
-    def __init__(self,x,y,symbol,goal,ai):
+    def __init__(self,x,y,symbol,goal,ai,seat):
+        """seat is the index of the pawn in the board's list of pawns,
+        which identifies the player everywhere. The random token h is only
+        used to authenticate network clients (see quonet)."""
         self.position=(x,y)
         self.symbol=symbol
         self.goal=goal
+        self.seat=seat
         alphabet='abcdefghijklmnopqrstuvwxyz'
-        self.h=reduce(lambda a,b:a+b, [ random.choice(alphabet) for i in range(15) ] )
+        self.h=''.join( random.choice(alphabet) for i in range(15) )
         if ai:
-            self.ai = quoaiengine.QuoAIEngine(self.h)
+            self.ai = quoaiengine.QuoAIEngine(seat)
         else:
             self.ai = None
 
     def __eq__(self, other):
-        return self.h == other.h
+        return self.seat == other.seat
 
     def move(self,position):
        self.position=position
        return self.position
 
+class DistCache:
+    """Least recently used cache of distance fields.
+
+    Fields are stored packed in arrays, under a (side, goal, barrier key)
+    triple. The barrier key is the Zobrist hash of the barriers on the map:
+    the field of a set of barriers is found again whatever the order in
+    which they were placed, and in any game with the same side. The fields
+    take at most max_bytes bytes; the least recently used ones are evicted
+    first."""
+
+    def __init__(self, max_bytes=1 << 24):
+        self.max_bytes = max_bytes
+        self.clear()
+
+    def clear(self):
+        self.fields = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.fields)
+
+    def get(self, key):
+        """Return the field stored under key, or None"""
+        a = self.fields.pop(key, None)
+        if a is None:
+            self.misses += 1
+            return None
+        # Move it to the most recently used end
+        self.fields[key] = a
+        self.hits += 1
+        return a
+
+    def put(self, key, a):
+        """Store the packed field a under key"""
+        old = self.fields.pop(key, None)
+        if old is not None:
+            self.nbytes -= old.itemsize * len(old)
+        self.fields[key] = a
+        self.nbytes += a.itemsize * len(a)
+        while self.nbytes > self.max_bytes:
+            old = self.fields.popitem(last=False)[1]
+            self.nbytes -= old.itemsize * len(old)
+            self.evictions += 1
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.
+
+    def as_dict(self):
+        return {
+            'entries':      len(self.fields),
+            'bytes':        self.nbytes,
+            'max_bytes':    self.max_bytes,
+            'hits':         self.hits,
+            'misses':       self.misses,
+            'evictions':    self.evictions,
+            'hit_rate':     self.hit_rate()
+        }
+
 class ServerBoard(quoboard.Board):
     """Board class to be used by server applications.
 
     Includes methods to add barriers and update the table of allowed moves"""
 
+    # Optional DistCache consulted before repairing a distance field
+    dist_cache = None
+    # Total time spent repairing the distance fields (or reading them from
+    # the cache), in seconds
+    dist_time = 0.
+
     def __init__(self, side, nplayers, player_ai):
         """A simple constructor, performs some sanity checks"""
         if nplayers < 2 or nplayers > 4:
             logging.critical('Barrier length must be >0 and <side length')
             raise
-        quoboard.Board.__init__(self, side)
-
-        initialised=False
-        while(not initialised):
-            self.pp = [Pawn(self.middle, 0, '1', down, player_ai[0])]
-            self.nplayers=nplayers
-            if self.nplayers == 2:
-                self.pp.append(Pawn(self.middle, self.side-1, '2', up, player_ai[1]))
-            elif self.nplayers == 3:
-                self.pp.append(Pawn(self.side-1, self.middle, '2', left, player_ai[1]))
-                self.pp.append(Pawn(self.middle, self.side-1, '3', up, player_ai[2]))
-            elif self.nplayers == 4:
-                self.pp.append(Pawn(self.side-1, self.middle, '2', left, player_ai[1]))
-                self.pp.append(Pawn(self.middle, self.side-1, '3', up, player_ai[2]))
-                self.pp.append(Pawn(0, self.middle, '4', right, player_ai[3]))
-            # Check that the hashes are all different
-            # (usually overkill, but anyway...)
-            initialised=True
-            hs = [ p.h for p in self.pp ]
-            for h in hs:
-                if hs.count(h) > 1: initialised=False
-
-        self.dists = []
-        self.moves_status = [
-            [ [ 0 for x in range(self.side) ] for y in range(self.side) ]
-            for i in range(self.nplayers) ]
-        for i in range(self.nplayers):
-            self.dists.append( self.init_dist(self.pp[i].goal, self.moves_status[i]) )
+        super(ServerBoard, self).__init__(side)
+
+        self.pp = [Pawn(self.middle, 0, '1', down, player_ai[0], 0)]
+        self.nplayers=nplayers
+        if self.nplayers == 2:
+            self.pp.append(Pawn(self.middle, self.side-1, '2', up, player_ai[1], 1))
+        elif self.nplayers == 3:
+            self.pp.append(Pawn(self.side-1, self.middle, '2', left, player_ai[1], 1))
+            self.pp.append(Pawn(self.middle, self.side-1, '3', up, player_ai[2], 2))
+        elif self.nplayers == 4:
+            self.pp.append(Pawn(self.side-1, self.middle, '2', left, player_ai[1], 1))
+            self.pp.append(Pawn(self.middle, self.side-1, '3', up, player_ai[2], 2))
+            self.pp.append(Pawn(0, self.middle, '4', right, player_ai[3], 3))
+
+        # Undo records of the moves applied by apply_move
+        self.undo = []
+
+        for i, p in enumerate(self.pp):
+            self.zobrist ^= self.zkeys.pawn[i][p.position[1]*self.side + p.position[0]]
+
+        self.recompute_dists()
+
+    def recompute_dists(self):
+        """Compute the distance fields of all the players from scratch.
+
+        Uses the vectorised distance engine if NumPy is available."""
+        self.forget_dists()
+        self.moves_status = [ self.new_field(0, 'B') for i in range(self.nplayers) ]
+        if quodist.numpy is not None:
+            self.dists = [ self.as_field(dist) for dist in quodist.init_dists(self,
+                [ p.goal for p in self.pp ], self.moves_status) ]
+        else:
+            self.dists = []
+            for i in range(self.nplayers):
+                self.dists.append( self.init_dist(self.pp[i].goal, self.moves_status[i]) )
+        if self.dist_cache is not None:
+            for i in range(self.nplayers):
+                self.dist_cache.put(self.dist_key(i), self.pack_dist(i))
+
+    def forget_dists(self):
+        """Reset the records of the barrier changes of the distance fields"""
+        # Barrier changes not yet applied to the distance field of each
+        # player, as (slot, added) pairs
+        self.pending = [ [] for i in range(self.nplayers) ]
+        # Changes applied to the field of each player, as (slot, added, log)
+        # triples, the log holding the previous contents of the modified
+        # cells (see undo_dists)
+        self.applied = [ [] for i in range(self.nplayers) ]
+        # Zobrist hash of the barriers on the map, the key of the fields in
+        # the DistCache
+        self.barrier_key = 0
+        for b in self.barriers:
+            self.barrier_key ^= self.zkeys.slot[self.slots.slot_of(b)]
+        # Shortest-path edges of each player, with the (barrier key, pawn
+        # position) pair they were computed for (see shortest_path_edges)
+        self.dag = [ None ] * self.nplayers
 
     def reconsider_dists(self, barrier):
-
+        """Take note that barrier was added to or removed from the map.
+
+        The distance fields are not repaired here, but when they are read
+        (see player_dists). The change is simply dropped for the players
+        whose field it cannot modify: a barrier added between two squares
+        at the same distance from the goal is on none of the shortest
+        paths, and a barrier removed between two squares whose distances
+        differ by at most one does not open any shorter path. If the change
+        takes back the last one (as when the search restores a move), it is
+        either forgotten along with the pending one, or reverted from the
+        log of the applied one."""
+
+        s = self.slots.slot_of(barrier)
+        self.barrier_key ^= self.zkeys.slot[s]
+        x, y, d = self.slots.edges[s][0]
+        added = not self.moves[x][y] & d
+        edges = self.barrier_edges(barrier)
         for i in range(self.nplayers):
- #           logging.debug('goal: %d', self.pp[i].goal)
-            stack = []
-            # Populate the stack
-            for pos in barrier.nodes():
-                if barrier.direction == right:
-                    if self.dists[i][pos[0]][pos[1]] > self.dists[i][pos[0]][pos[1]-1]:
-                        stack.append((pos[0],pos[1]))
-                        self.moves_status[i][pos[0]][pos[1]] = 0
-                    elif self.dists[i][pos[0]][pos[1]] < self.dists[i][pos[0]][pos[1]-1]:
-                        stack.append((pos[0],pos[1]-1))
-                        self.moves_status[i][pos[0]][pos[1]-1] = 0
+            pending = self.pending[i]
+            if pending:
+                if pending[-1] == (s, not added):
+                    pending.pop()
                 else:
-                    if self.dists[i][pos[0]][pos[1]] > self.dists[i][pos[0]-1][pos[1]]:
-                        stack.append((pos[0],pos[1]))
-                        self.moves_status[i][pos[0]][pos[1]] = 0
-                    elif self.dists[i][pos[0]][pos[1]] < self.dists[i][pos[0]-1][pos[1]]:
-                        stack.append((pos[0]-1,pos[1]))
-                        self.moves_status[i][pos[0]-1][pos[1]] = 0
-#            logging.debug('goal, stack in reconsider_dist: %d %s', self.pp[i].goal, repr(stack))
-#            for y in range(self.side):
-#                logging.debug("reconsider_dist: dist, moves_status = %s\t%s", repr([self.dists[i][x][y] for x in range(self.side)]), repr([self.moves_status[i][x][y] for x in range(self.side)]))
-#            logging.debug("")
-
-            stack2 = []
-            while stack:
-                p = stack.pop()
-                stack2.append(p)
-                if self.moves[p[0]][p[1]] & up and self.moves_status[i][p[0]][p[1]-1] != 0 and self.dists[i][p[0]][p[1]-1] - self.dists[i][p[0]][p[1]] == 1:
-                    stack.append( (p[0],p[1]-1) )
-                    self.moves_status[i][p[0]][p[1]-1] = 0
-                if self.moves[p[0]][p[1]] & right and self.moves_status[i][p[0]+1][p[1]] != 0 and self.dists[i][p[0]+1][p[1]] - self.dists[i][p[0]][p[1]] == 1:
-                    stack.append( (p[0]+1,p[1]) )
-                    self.moves_status[i][p[0]+1][p[1]] = 0
-                if self.moves[p[0]][p[1]] & down and self.moves_status[i][p[0]][p[1]+1] != 0 and self.dists[i][p[0]][p[1]+1] - self.dists[i][p[0]][p[1]] == 1:
-                    stack.append( (p[0],p[1]+1) )
-                    self.moves_status[i][p[0]][p[1]+1] = 0
-                if self.moves[p[0]][p[1]] & left and self.moves_status[i][p[0]-1][p[1]] != 0 and self.dists[i][p[0]-1][p[1]] - self.dists[i][p[0]][p[1]] == 1:
-                    stack.append( (p[0]-1,p[1]) )
-                    self.moves_status[i][p[0]-1][p[1]] = 0
-
-#            logging.debug('goal, stack2 in reconsider_dist: %d %s', self.pp[i].goal, repr(stack2))
-#            for y in range(self.side):
-#                logging.debug("reconsider_dist: dist, moves_status = %s\t%s", repr([self.dists[i][x][y] for x in range(self.side)]), repr([self.moves_status[i][x][y] for x in range(self.side)]))
-#            logging.debug("")
-
-            queue = []
-            while stack2:
-                p = stack2.pop()
-#                logging.debug('p: %d %d', p[0], p[1])
-                if self.moves[p[0]][p[1]] & up and self.moves_status[i][p[0]][p[1]-1] != 0:
-                    queue.append( (p[0],p[1]-1) )
-                    self.moves_status[i][p[0]][p[1]-1] = visited_or_enqueued
-                if self.moves[p[0]][p[1]] & right and self.moves_status[i][p[0]+1][p[1]] != 0:
-                    queue.append( (p[0]+1,p[1]) )
-                    self.moves_status[i][p[0]+1][p[1]] = visited_or_enqueued
-                if self.moves[p[0]][p[1]] & down and self.moves_status[i][p[0]][p[1]+1] != 0:
-                    queue.append( (p[0],p[1]+1) )
-                    self.moves_status[i][p[0]][p[1]+1] = visited_or_enqueued
-                if self.moves[p[0]][p[1]] & left and self.moves_status[i][p[0]-1][p[1]] != 0:
-                    queue.append( (p[0]-1,p[1]) )
-                    self.moves_status[i][p[0]-1][p[1]] = visited_or_enqueued
-
-#            logging.debug('goal, queue in reconsider_dist: %d %s', self.pp[i].goal, repr(queue))
-#            for y in range(self.side):
-#                logging.debug("reconsider_dist: dist, moves_status = %s\t%s", repr([self.dists[i][x][y] for x in range(self.side)]), repr([self.moves_status[i][x][y] for x in range(self.side)]))
-#            logging.debug("")
-
-            if queue:
-                min_pos = min(queue, key=lambda p: self.dists[i][p[0]][p[1]])
-                queue = deque( filter(lambda p: self.dists[i][p[0]][p[1]] == self.dists[i][min_pos[0]][min_pos[1]], queue) )
-#            logging.debug('goal, queue in reconsider_dist: %d %s', self.pp[i].goal, repr(queue))
-
-            while queue:
-                newqueue = []
-                while queue:
-                    p = queue.popleft()
-                    self.moves_status[i][p[0]][p[1]] |= visited
-#                    logging.debug('p: %d %d', p[0], p[1])
-                    if self.moves[p[0]][p[1]] & up and self.moves_status[i][p[0]][p[1]-1] == 0:
-                        newqueue.append( (p[0],p[1]-1) )
-                        self.moves_status[i][p[0]][p[1]-1] = visited_or_enqueued
-                        self.dists[i][p[0]][p[1]-1] = self.dists[i][p[0]][p[1]] + 1
-                    if self.moves[p[0]][p[1]] & right and self.moves_status[i][p[0]+1][p[1]] == 0:
-                        newqueue.append( (p[0]+1,p[1]) )
-                        self.moves_status[i][p[0]+1][p[1]] = visited_or_enqueued
-                        self.dists[i][p[0]+1][p[1]] = self.dists[i][p[0]][p[1]] + 1
-                    if self.moves[p[0]][p[1]] & down and self.moves_status[i][p[0]][p[1]+1] == 0:
-                        newqueue.append( (p[0],p[1]+1) )
-                        self.moves_status[i][p[0]][p[1]+1] = visited_or_enqueued
-                        self.dists[i][p[0]][p[1]+1] = self.dists[i][p[0]][p[1]] + 1
-                    if self.moves[p[0]][p[1]] & left and self.moves_status[i][p[0]-1][p[1]] == 0:
-                        newqueue.append( (p[0]-1,p[1]) )
-                        self.moves_status[i][p[0]-1][p[1]] = visited_or_enqueued
-                        self.dists[i][p[0]-1][p[1]] = self.dists[i][p[0]][p[1]] + 1
-                if newqueue:
-                    min_pos = min(newqueue, key=lambda p: self.dists[i][p[0]][p[1]] )
-                    queue = deque( filter(lambda p: self.dists[i][p[0]][p[1]] == self.dists[i][min_pos[0]][min_pos[1]], newqueue) )
-#            for y in range(self.side):
-#                logging.debug("reconsider_dist: dist, moves_status = %s\t%s", repr([self.dists[i][x][y] for x in range(self.side)]), repr([self.moves_status[i][x][y] for x in range(self.side)]))
-#            logging.debug("")
-
-    def distance_to_goal(self, p):
-        """Calculate the distance to the goal.
-        
-        Calls a bfs algorithm to determine the shortest distance to all board
-        squares."""
-
-        dist = self.dists[self.pp.index(p)][p.position[0]][p.position[1]]
-
-        if dist > 0:
-            return dist
+                    pending.append((s, added))
+                continue
+            applied = self.applied[i]
+            if applied and applied[-1][0] == s and applied[-1][1] != added:
+                self.undo_dists(applied.pop()[2])
+                continue
+            dist = self.dists[i]
+            for a, b in edges:
+                da, db = dist[a[0]][a[1]], dist[b[0]][b[1]]
+                if added:
+                    if da != db:
+                        break
+                elif (da < 0) != (db < 0) or abs(da - db) > 1:
+                    break
+            else:
+                applied.append((s, added, []))
+                continue
+            pending.append((s, added))
+
+    def player_dists(self, i):
+        """Return the distance field of player i, repairing it first if
+        barriers were added or removed since it was last read.
+
+        If the board has a DistCache, the field is looked up there before
+        being repaired, and stored there after."""
+        if self.pending[i]:
+            t = time.time()
+            cache = self.dist_cache
+            if cache is None:
+                self.repair_dists(i)
+            else:
+                key = self.dist_key(i)
+                a = cache.get(key)
+                if a is None:
+                    self.repair_dists(i)
+                    cache.put(key, self.pack_dist(i))
+                else:
+                    self.unpack_dist(i, a)
+            self.dist_time += time.time() - t
+        return self.dists[i]
+
+    def dist_key(self, i):
+        """Return the DistCache key of the field of player i"""
+        return (self.side, self.pp[i].goal, self.barrier_key)
+
+    def pack_dist(self, i):
+        """Return the distance field of player i as an array, x-major"""
+        a = array.array('h' if self.side * self.side <= 0x7fff else 'i')
+        for column in self.dists[i]:
+            a.extend(column)
+        return a
+
+    def unpack_dist(self, i, a):
+        """Replace the distance field of player i with the one packed in a.
+
+        The pending changes are cleared; the changes applied so far cannot
+        be reverted any more."""
+        side = self.side
+        self.dists[i] = dist = self.as_field( a[x*side:(x+1)*side] for x in range(side) )
+        self.moves_status[i] = self.as_field(
+            ( [ visited_or_enqueued if d >= 0 else 0 for d in column ] for column in dist ), 'B')
+        self.pending[i] = []
+        self.applied[i] = []
+
+    def repair_dists(self, i):
+        """Apply the pending barrier changes to the distance field of
+        player i.
+
+        The map is first brought back to the state the field describes, then
+        the changes are replayed one at a time, each of them repaired
+        incrementally."""
+        pending = self.pending[i]
+        applied = self.applied[i]
+        barriers = self.slots.barriers
+        # A single change needs no replay: the map is already in its state
+        replay = len(pending) > 1
+        if replay:
+            for s, added in reversed(pending):
+                if added:
+                    self.remove_barrier_from_map(barriers[s])
+                else:
+                    self.add_barrier_to_map(barriers[s])
+        for s, added in pending:
+            log = []
+            if added:
+                if replay:
+                    self.add_barrier_to_map(barriers[s])
+                self.lengthen_dists(i, barriers[s], log)
+            else:
+                if replay:
+                    self.remove_barrier_from_map(barriers[s])
+                self.shorten_dists(i, barriers[s], log)
+            applied.append((s, added, log))
+        self.pending[i] = []
+
+    def undo_dists(self, log):
+        """Revert the changes recorded by lengthen_dists or shorten_dists"""
+        for i, x, y, d, st in reversed(log):
+            self.dists[i][x][y] = d
+            self.moves_status[i][x][y] = st
+
+    def barrier_edges(self, barrier):
+        """Return the pairs of squares separated by barrier"""
+        if barrier.direction == right:
+            return [ ((pos[0],pos[1]-1), pos) for pos in barrier.nodes() ]
         else:
-            return -1
+            return [ ((pos[0]-1,pos[1]), pos) for pos in barrier.nodes() ]
+
+    def lengthen_dists(self, i, barrier, log):
+        """Repair the distance field of player i after barrier was added.
+
+        The squares whose shortest paths may go through the barrier are
+        invalidated, and their distances are recomputed by a breadth-first
+        search starting from the valid squares bordering them. The previous
+        contents of the modified cells are appended to log."""
+
+        dist = self.dists[i]
+        status = self.moves_status[i]
+        moves = self.moves
+
+        # Populate the stack with the far side of the cut edges
+        stack = []
+        for a, b in self.barrier_edges(barrier):
+            if dist[b[0]][b[1]] > dist[a[0]][a[1]]:
+                far = b
+            elif dist[b[0]][b[1]] < dist[a[0]][a[1]]:
+                far = a
+            else:
+                continue
+            if status[far[0]][far[1]] != 0:
+                log.append((i, far[0], far[1], dist[far[0]][far[1]], status[far[0]][far[1]]))
+                status[far[0]][far[1]] = 0
+                stack.append(far)
+
+        # Invalidate all the squares downstream
+        invalid = []
+        while stack:
+            p = stack.pop()
+            invalid.append(p)
+            for d, dx, dy in steps:
+                if moves[p[0]][p[1]] & d:
+                    q0, q1 = p[0]+dx, p[1]+dy
+                    if status[q0][q1] != 0 and dist[q0][q1] - dist[p[0]][p[1]] == 1:
+                        log.append((i, q0, q1, dist[q0][q1], status[q0][q1]))
+                        status[q0][q1] = 0
+                        stack.append((q0,q1))
+
+        # Collect the valid squares bordering the invalidated region
+        border = []
+        for p in invalid:
+            dist[p[0]][p[1]] = -1
+            for d, dx, dy in steps:
+                if moves[p[0]][p[1]] & d:
+                    q0, q1 = p[0]+dx, p[1]+dy
+                    if status[q0][q1] != 0:
+                        border.append((q0,q1))
+        border.sort(key=lambda q: dist[q[0]][q[1]])
+
+        # Breadth-first search, injecting the border squares as the wave
+        # reaches their distance
+        queue = deque()
+        k = 0
+        while queue or k < len(border):
+            if not queue or (k < len(border) and
+                    dist[border[k][0]][border[k][1]] <= dist[queue[0][0]][queue[0][1]]):
+                p = border[k]
+                k += 1
+            else:
+                p = queue.popleft()
+            for d, dx, dy in steps:
+                if moves[p[0]][p[1]] & d:
+                    q0, q1 = p[0]+dx, p[1]+dy
+                    if status[q0][q1] == 0 and dist[q0][q1] < 0:
+                        dist[q0][q1] = dist[p[0]][p[1]] + 1
+                        status[q0][q1] = visited_or_enqueued
+                        queue.append((q0,q1))
+
+    def shorten_dists(self, i, barrier, log):
+        """Repair the distance field of player i after barrier was removed.
+
+        Distances can only decrease: they are relaxed starting from the
+        squares joined by the removed barrier. The previous contents of the
+        modified cells are appended to log."""
+
+        dist = self.dists[i]
+        status = self.moves_status[i]
+        moves = self.moves
+
+        queue = deque()
+        for a, b in self.barrier_edges(barrier):
+            for p, q in ((a, b), (b, a)):
+                dp, dq = dist[p[0]][p[1]], dist[q[0]][q[1]]
+                if dp >= 0 and (dq < 0 or dq > dp + 1):
+                    log.append((i, q[0], q[1], dq, status[q[0]][q[1]]))
+                    dist[q[0]][q[1]] = dp + 1
+                    status[q[0]][q[1]] = visited_or_enqueued
+                    queue.append(q)
+
+        while queue:
+            p = queue.popleft()
+            dp = dist[p[0]][p[1]]
+            for d, dx, dy in steps:
+                if moves[p[0]][p[1]] & d:
+                    q0, q1 = p[0]+dx, p[1]+dy
+                    dq = dist[q0][q1]
+                    if dq < 0 or dq > dp + 1:
+                        log.append((i, q0, q1, dq, status[q0][q1]))
+                        dist[q0][q1] = dp + 1
+                        status[q0][q1] = visited_or_enqueued
+                        queue.append((q0,q1))
 
-    def move_pawn(self, h, direction):
-        """Check if the proposed move is allowed for the pawn identified by
-        hash h"""
+    def distance_to_goal(self, p):
+        """Distance of pawn p to its goal, -1 if it cannot reach it.
+
+        Reads the distance field of the pawn, repairing it if needed.
+        Board.goal_distance computes the same distance without the
+        field."""
+
+        # Unreachable squares are at distance -1 in the field
+        return self.player_dists(p.seat)[p.position[0]][p.position[1]]
+
+    def is_closed_off(self, p):
+        """Check if pawn p cannot reach its goal.
+
+        If the distance field of the pawn has pending changes, a path going
+        down the stale field through the edges open in the current map is
+        looked for first: when it reaches the goal, the field does not need
+        to be repaired."""
+        i = p.seat
+        if self.pending[i]:
+            dist = self.dists[i]
+            moves = self.moves
+            x, y = p.position
+            while dist[x][y] > 0:
+                for d, dx, dy in steps:
+                    if moves[x][y] & d and dist[x+dx][y+dy] == dist[x][y] - 1:
+                        x, y = x+dx, y+dy
+                        break
+                else:
+                    break
+            if dist[x][y] == 0:
+                return False
+        return self.distance_to_goal(p) < 0
+
+    def shortest_path_edges(self, i):
+        """Return the set of the edges lying on some shortest path of player
+        i from its pawn to its goal, as (x, y, direction) triples.
+
+        These edges form a directed acyclic graph, followed down the distance
+        field from the pawn. Only a barrier cutting one of them can lengthen
+        the distance of the pawn. The set is computed again only when the
+        barriers or the position of the pawn change."""
+        key = (self.barrier_key, self.pp[i].position)
+        if self.dag[i] is not None and self.dag[i][0] == key:
+            return self.dag[i][1]
+        dist = self.player_dists(i)
+        moves = self.moves
+        edges = set()
+        seen = set([self.pp[i].position])
+        stack = [self.pp[i].position]
+        while stack:
+            x, y = stack.pop()
+            dp = dist[x][y]
+            if dp <= 0:
+                continue
+            for d, dx, dy in steps:
+                if moves[x][y] & d and dist[x+dx][y+dy] == dp - 1:
+                    edges.add((x, y, d))
+                    q = (x+dx, y+dy)
+                    if q not in seen:
+                        seen.add(q)
+                        stack.append(q)
+        self.dag[i] = (key, edges)
+        return edges
+
+    def effective_barriers(self, players=None):
+        """Return a dictionary mapping the free slots whose barrier cuts a
+        shortest path of one of the players (by default, all of them) to the
+        number of shortest-path edges it cuts. The barriers of the other
+        free slots leave all the distances unchanged."""
+        if players is None:
+            players = range(self.nplayers)
+        edge_slots = self.slots.edge_slots
+        free = self.free_slots
+        counts = {}
+        for i in players:
+            for e in self.shortest_path_edges(i):
+                for s in edge_slots.get(e, ()):
+                    if s in free:
+                        counts[s] = counts.get(s, 0) + 1
+        return counts
+
+    def shortest_path(self, i):
+        """Return a shortest path of player i to its goal, as the list of
+        the (x, y, direction) edges it follows down the distance field"""
+        dist = self.player_dists(i)
+        moves = self.moves
+        x, y = self.pp[i].position
+        path = []
+        while dist[x][y] > 0:
+            for d, dx, dy in steps:
+                if moves[x][y] & d and dist[x+dx][y+dy] == dist[x][y] - 1:
+                    path.append((x, y, d))
+                    x, y = x+dx, y+dy
+                    break
+            else:
+                break
+        return path
+
+    def path_barriers(self, players=None):
+        """Return the free slots whose barrier cuts the shortest path (see
+        shortest_path) of one of the players (by default, all of them),
+        those cutting the most paths first, then those closest to the
+        pawns.
+
+        Unlike effective_barriers, this does not need the whole shortest
+        path graph, which may cover most of a large board: the work is
+        proportional to the length of the paths."""
+        if players is None:
+            players = range(self.nplayers)
+        edge_slots = self.slots.edge_slots
+        free = self.free_slots
+        counts = {}
+        first = {}
+        for i in players:
+            for k, e in enumerate(self.shortest_path(i)):
+                for s in edge_slots.get(e, ()):
+                    if s in free:
+                        counts[s] = counts.get(s, 0) + 1
+                        first[s] = min(first.get(s, k), k)
+        return sorted(counts, key=lambda s: (-counts[s], first[s], s))
+
+    def move_pawn(self, i, direction):
+        """Check if the proposed move is allowed for the pawn of player i,
+        and make it if it is"""
 
-        pl=filter(lambda q: h==q.h, self.pp)
-        if len(pl)==0:
-            logging.critical("Hash %s not recognized", h)
+        try:
+            p=self.pp[i]
+        except IndexError:
+            logging.critical("Player %d not recognized", i)
             raise
-
-        p=pl[0]
         posnew=tuple( map(sum, zip( p.position, vdir[direction]) ) )
 
         # Check if pawn can go there
@@ -205,7 +543,7 @@ class ServerBoard(quoboard.Board):
             return False
 
         # Jumping over another pawn?
-        if any( [ posnew == self.pp[i].position for i in range(self.nplayers) if self.pp[i].h != h ] ):
+        if any( [ posnew == q.position for q in self.pp if q.seat != i ] ):
             posnew2=tuple( map(sum, zip( posnew, vdir[direction]) ) )
             # Check if pawn can go there
             if not self.is_pawn_position_legal(*posnew2):
@@ -216,19 +554,35 @@ class ServerBoard(quoboard.Board):
                 # is just forbidden.
                 return False
             # Do not jump two pawns in a row
-            if any( [ posnew2 == self.pp[i].position for i in range(self.nplayers) if self.pp[i].h != h ] ):
+            if any( [ posnew2 == q.position for q in self.pp if q.seat != i ] ):
                 return False
 
-            p.move(posnew2)
+            self.set_pawn_position(p, posnew2)
             return True
 
         else:   # Not jumping over other pawns
-            p.move(posnew)
+            self.set_pawn_position(p, posnew)
             return True
 
+    def set_pawn_position(self, p, position):
+        """Move pawn p to the given position, keeping the hash up to date"""
+        keys = self.zkeys.pawn[p.seat]
+        self.zobrist ^= keys[p.position[1]*self.side + p.position[0]] ^ \
+            keys[position[1]*self.side + position[0]]
+        p.move(position)
+
     def add_barrier(self, barrier):
         """Add a new barrier if allowed"""
-        if self.check_barrier(barrier):
+        s = self.slots.slot_of(barrier)
+        if s is None:
+            #logging.info("Barrier %s, %d, len=%d is illegal, rejected", str(barrier.position), barrier.direction, barrier.length)
+            return False
+        return self.place_barrier(s)
+
+    def place_barrier(self, s):
+        """Add a new barrier in slot s if allowed"""
+        if self.check_slot(s):
+            barrier = self.slots.barriers[s]
             self.add_barrier_to_map(barrier)
             self.reconsider_dists(barrier)
             # Check if new barrier closes off one of the pawns
@@ -238,40 +592,186 @@ class ServerBoard(quoboard.Board):
                 #logging.info("Barrier %s, %d, len=%d closes off some pawns, rejected", str(barrier.position), barrier.direction, barrier.length)
                 return False
             else:
-                self.barriers.append(barrier)
+                self.occupy_slot(s)
                 return True
         else:
-            #logging.info("Barrier %s, %d, len=%d is illegal, rejected", str(barrier.position), barrier.direction, barrier.length)
             return False
 
     def remove_barrier(self, barrier):
         """Remove a barrier"""
+        self.lift_barrier(self.slots.slot_of(barrier))
+
+    def lift_barrier(self, s):
+        """Remove the barrier in slot s"""
+        barrier = self.slots.barriers[s]
         self.remove_barrier_from_map(barrier)
-        #logging.debug("nbarriers: %d", len(self.barriers))
-        #for b in self.barriers:
-        #    logging.debug("barrier: x, y == %d, %d, d == %d", b.position[0], b.position[1], b.direction)
-        self.barriers.remove(barrier)
+        self.release_slot(s)
         self.reconsider_dists(barrier)
 
-    def apply_move(self, h, m):
-        """Apply a move to the board"""
-        p = filter(lambda p: p.h==h, self.pp)[0]
-        if m.s[0] == 'm':
-            return self.move_pawn(h, int(m.s[2]))
-        elif m.s[0] == 'b':
-            mspl = m.s.split()
-            return self.add_barrier(quoboard.Barrier(
-                int(mspl[1]), int(mspl[2]), int(mspl[3]), length))
-
-    def restore_move(self, h, m):
-        """Take back a move from the board"""
-        p = filter(lambda p: p.h==h, self.pp)[0]
-        if m.s[0] == 'm':
-            return self.move_pawn(h, (int(m.s[2]) << 2) % 15)
-        elif m.s[0] == 'b':
-            mspl = m.s.split()
-            return self.remove_barrier(
-                quoboard.Barrier(int(mspl[1]), int(mspl[2]), int(mspl[3]), length))
+    def apply_move(self, i, m):
+        """Apply a move (encoded as an integer) of player i to the board.
+
+        If the move is legal, an undo record is pushed so that restore_move
+        can take it back without recomputing anything."""
+        if m & 1:
+            if not self.place_barrier(m >> 1):
+                return False
+            # Barriers need no record: taking the barrier back cancels or
+            # reverts its change of the distance fields
+            self.undo.append(None)
+            return True
+        else:
+            position = self.pp[i].position
+            if not self.move_pawn(i, m >> 1):
+                return False
+            self.undo.append(position)
+            return True
+
+    def restore_move(self, i, m):
+        """Take back the last move applied by apply_move, made by player i"""
+        if m & 1:
+            self.undo.pop()
+            self.lift_barrier(m >> 1)
+        else:
+            self.set_pawn_position(self.pp[i], self.undo.pop())
+        return True
+
+    def first_legal_move(self, i, moves):
+        """Return the first of the given moves that is legal for player i,
+        or None"""
+        for m in moves:
+            if self.apply_move(i, m):
+                self.restore_move(i, m)
+                return m
+        return None
+
+    def forget_moves(self):
+        """Drop the undo records: the moves applied so far cannot be taken
+        back any more"""
+        self.undo = []
+        for applied in self.applied:
+            del applied[:]
+
+class BitServerBoard(ServerBoard, quoboard.BitBoard):
+    """Server board using the bitboard backend.
+
+    The distance field of each player is also kept as the list of its BFS
+    levels (see BitBoard.wavefront). The squares closer to the goal than
+    both ends of a barrier change keep their distance, so the levels below
+    are kept and the others are computed again by a wavefront, a few shifts
+    per level, until the levels are the old ones again. Only the cells
+    whose distance changed are written to the field."""
+
+    def forget_dists(self):
+        super(BitServerBoard, self).forget_dists()
+        # BFS levels of the field of each player, None until they are
+        # derived from the field
+        self.levels = [ None ] * self.nplayers
+
+    def unpack_dist(self, i, a):
+        super(BitServerBoard, self).unpack_dist(i, a)
+        self.levels[i] = None
+
+    def dist_levels(self, i):
+        """Return the BFS levels of the distance field of player i"""
+        levels = self.levels[i]
+        if levels is None:
+            s = self.side
+            levels = []
+            for x, column in enumerate(self.dists[i]):
+                for y, d in enumerate(column):
+                    if d >= 0:
+                        while len(levels) <= d:
+                            levels.append(0)
+                        levels[d] |= 1 << y*s + x
+            self.levels[i] = levels
+        return levels
+
+    def lengthen_dists(self, i, barrier, log):
+        self.rewave_dists(i, barrier, True, log)
+
+    def shorten_dists(self, i, barrier, log):
+        self.rewave_dists(i, barrier, False, log)
+
+    def rewave_dists(self, i, barrier, added, log):
+        """Repair the distance field of player i after barrier was added or
+        removed.
+
+        A cut edge is only on the shortest paths of the squares as far as
+        its far end, and an opened edge only gives paths longer than its
+        near end: the levels up to the nearest end are kept. The previous
+        levels, then the previous contents of the modified cells, are
+        appended to log (see undo_dists)."""
+
+        dist = self.dists[i]
+        s = self.side
+        start = None
+        changed = 0
+        for a, b in self.barrier_edges(barrier):
+            changed |= 1 << a[1]*s + a[0] | 1 << b[1]*s + b[0]
+            da, db = dist[a[0]][a[1]], dist[b[0]][b[1]]
+            if (added and da == db) or (da < 0 and db < 0):
+                continue
+            near = min( d for d in (da, db) if d >= 0 )
+            if start is None or near < start:
+                start = near
+        if start is None:
+            return
+
+        levels = self.dist_levels(i)
+        seen = 0
+        for level in levels[:start]:
+            seen |= level
+        new = levels[:start] + self.wavefront(levels[start], seen, levels[start:], changed)
+        self.levels[i] = new
+        log.append((i, levels))
+
+        # Write the cells whose distance changed
+        status = self.moves_status[i]
+        reached, was_reached = 0, 0
+        nold, nnew = len(levels), len(new)
+        for d in range(start + 1, max(nold, nnew)):
+            old_level = levels[d] if d < nold else 0
+            new_level = new[d] if d < nnew else 0
+            if new_level == old_level:
+                continue
+            reached |= new_level
+            was_reached |= old_level
+            moved = new_level & ~old_level
+            while moved:
+                low = moved & -moved
+                n = low.bit_length() - 1
+                x, y = n % s, n // s
+                log.append((i, x, y, dist[x][y], status[x][y]))
+                dist[x][y] = d
+                status[x][y] = visited_or_enqueued
+                moved ^= low
+        lost = was_reached & ~reached
+        while lost:
+            low = lost & -lost
+            n = low.bit_length() - 1
+            x, y = n % s, n // s
+            log.append((i, x, y, dist[x][y], status[x][y]))
+            dist[x][y] = -1
+            status[x][y] = 0
+            lost ^= low
+
+    def undo_dists(self, log):
+        # The first entry holds the previous levels (see rewave_dists)
+        if log:
+            i, levels = log[0]
+            self.levels[i] = levels
+            super(BitServerBoard, self).undo_dists(log[1:])
+
+class CompactServerBoard(ServerBoard, quoboard.CompactBoard):
+    """Server board using the compact backend, for large boards"""
+    pass
+
+board_backends = {
+    'list':     ServerBoard,
+    'bits':     BitServerBoard,
+    'compact':  CompactServerBoard
+}
 
 class QuoServer:
 
@@ -281,10 +781,35 @@ class QuoServer:
 
         self.read_config()
 
-        self.serverboard=ServerBoard(self.side,self.nplayers,self.player_ai)
+        self.serverboard=board_backends[self.backend](self.side,self.nplayers,self.player_ai)
+        if self.dist_cache > 0:
+            self.serverboard.dist_cache = DistCache(int(self.dist_cache * (1 << 20)))
+        for p in self.serverboard.pp:
+            if p.ai:
+                if self.ai_engine == 'mcts':
+                    p.ai = quomcts.MCTSEngine(p.seat)
+                p.ai.max_time = self.ai_time
+                if self.ai_max_barriers > 0:
+                    p.ai.max_barriers = self.ai_max_barriers
+                p.ai.workers = self.ai_workers
+                p.ai.book = self.book
+        if self.record:
+            self.recorder = quorecord.GameRecorder(os.path.expanduser(self.record),
+                self.serverboard, self.record_interval)
+        else:
+            self.recorder = None
         self.ui = quoui.ui_curses(self.side,self.cellsizex,self.cellsizey,self.nplayers,self)
 
-        curses.wrapper(self.main_loop)
+        try:
+            curses.wrapper(self.main_loop)
+        finally:
+            quotrace.dump(os.path.expanduser('~/.quoserver.trace'))
+            for p in self.serverboard.pp:
+                if isinstance(p.ai, quoaiengine.QuoAIEngine):
+                    p.ai.close()
+            if self.recorder is not None:
+                # The game was interrupted
+                self.recorder.finish()
 
     def main_loop(self,scr):
         """The main loop of the game."""
@@ -293,40 +818,51 @@ class QuoServer:
 
         while(True):
             for i in range(self.nplayers):
+                # On large boards, follow the pawn to move
+                self.ui.focus(*self.serverboard.pp[i].position)
                 self.ui.draw_board(self.serverboard.pp, self.serverboard.barriers)
-                self.ui.draw_players_win(self.serverboard.pp, self.serverboard.pp[i].h)
+                self.ui.draw_players_win(self.serverboard.pp, i)
                 if self.serverboard.pp[i].ai:
-                    #while(not self.serverboard.move_pawn(self.serverboard.pp[i].h,
+                    #while(not self.serverboard.move_pawn(i,
                     #    random.choice([up,right,down,left]))):
                     #    pass
-                    self.ui.set_thinking(self.serverboard.pp, self.serverboard.pp[i].h)
-                    self.serverboard.apply_move(
-                        self.serverboard.pp[i].h,
-                        #self.serverboard.pp[i].ai.get_move(copy.deepcopy(self.serverboard))
-                        self.serverboard.pp[i].ai.get_move(self.serverboard)
-                        )
-                    self.ui.unset_thinking(self.serverboard.pp, self.serverboard.pp[i].h)
+                    self.ui.set_thinking(self.serverboard.pp, i)
+                    #m = self.serverboard.pp[i].ai.get_move(copy.deepcopy(self.serverboard))
+                    m = self.serverboard.pp[i].ai.get_move(self.serverboard)
+                    # A pawn with no legal move passes its turn
+                    if m is not None:
+                        self.serverboard.apply_move(i, m)
+                    self.ui.unset_thinking(self.serverboard.pp, i)
                 else:
                     moved=False
                     while(not moved):
+                        m = None
                         c = self.ui.get_input()
                         if c == self.ui.inp.quit: return
                         elif c == self.ui.inp.left:
-                            moved = self.serverboard.move_pawn(self.serverboard.pp[i].h, left)
+                            m = pawn_move(left)
                         elif c == self.ui.inp.right:
-                            moved = self.serverboard.move_pawn(self.serverboard.pp[i].h, right)
+                            m = pawn_move(right)
                         elif c == self.ui.inp.up:
-                            moved = self.serverboard.move_pawn(self.serverboard.pp[i].h, up)
+                            m = pawn_move(up)
                         elif c == self.ui.inp.down:
-                            moved = self.serverboard.move_pawn(self.serverboard.pp[i].h, down)
+                            m = pawn_move(down)
                         elif c == self.ui.inp.debug:
-                            logging.setLevel(logging.DEBUG)
+                            logging.getLogger().setLevel(logging.DEBUG)
+                            if quotrace.recorder is None:
+                                quotrace.enable()
                         elif c == self.ui.inp.barrier:
-                            moved = self.choose_barrier()
+                            m = self.choose_barrier(i)
+                            moved = m is not None
+                        if m is not None and not moved:
+                            moved = self.serverboard.apply_move(i, m)
                         if not moved:
                             self.ui.communicate("Illegal move, P" + self.serverboard.pp[i].symbol + "!\n")
                             self.ui.warn()
-                if self.serverboard.check_win(self.serverboard.pp[i].h):
+                self.serverboard.forget_moves()
+                if self.recorder is not None and m is not None:
+                    self.recorder.record(i, m, self.serverboard)
+                if self.serverboard.check_win(i):
                     self.win(i)
                     return
 
@@ -336,20 +872,25 @@ class QuoServer:
         self.ui.clear_panel()
         self.ui.clear_players_win()
 
-    def choose_barrier(self):
-        """Choose where to put the barrier on the map."""
+    def choose_barrier(self, i):
+        """Choose where to put the barrier on the map, and place it for
+        player i.
+
+        Returns the move, or None if the barrier was not placed."""
 
         # First choose the barrier position
         pos_curs=[self.serverboard.middle,self.serverboard.middle]
         chosen_position=False
         while not chosen_position:
 
+            if self.ui.focus(*pos_curs):
+                self.ui.draw_board(self.serverboard.pp, self.serverboard.barriers)
             self.ui.draw_barrier_cursor(*pos_curs)
 
             c = self.ui.get_input()
             if c == self.ui.inp.quit:
                 self.ui.delete_old_barrier_cursor(True)
-                return False
+                return None
             elif c == self.ui.inp.left:
                 pos_curs[0]=max(0,pos_curs[0]-1)
             elif c == self.ui.inp.right:
@@ -375,7 +916,7 @@ class QuoServer:
             c = self.ui.get_input()
             if c == self.ui.inp.quit:
                 self.ui.delete_old_barrier(True)
-                return False
+                return None
             elif c == self.ui.inp.left:
                 if pos_curs[0]>=length:
                     direction=left
@@ -399,13 +940,18 @@ class QuoServer:
             elif c == self.ui.inp.barrier:
                 chosen_direction=True
 
-        result= self.serverboard.add_barrier(quoboard.Barrier(
+        s = self.serverboard.slots.slot_of(quoboard.Barrier(
             pos_curs[0],pos_curs[1],direction,length))
+        result = s is not None and self.serverboard.apply_move(i, barrier_move(s))
         self.ui.delete_old_barrier(not result)
-        return result
+        if result:
+            return barrier_move(s)
+        return None
 
     def win(self,i):
-        pass
+        if self.recorder is not None:
+            self.recorder.finish(i)
+            self.recorder = None
 
     def demo(self):
         """Demo mode"""
@@ -416,7 +962,7 @@ class QuoServer:
                     random.randint(0,self.serverboard.side-1),
                     random.choice([up,right,down,left]),
                     2)):
-                    while(not self.serverboard.move_pawn(self.serverboard.pp[j].h,
+                    while(not self.serverboard.move_pawn(j,
                         random.choice([up,right,down,left]))):
                         pass
                 self.pretty_print(5,5)
@@ -444,8 +990,45 @@ class QuoServer:
         f.close()
 
         self.side = config.getint('Board','side')
+        if config.has_option('Board','backend'):
+            self.backend = config.get('Board','backend')
+        else:
+            self.backend = 'list'
+        if config.has_option('Board','dist_cache'):
+            self.dist_cache = config.getfloat('Board','dist_cache')
+        else:
+            self.dist_cache = 16
         self.nplayers = config.getint('Game','nplayers')
         self.player_ai = [ config.getboolean('Game','player'+str(i)+'_ai') for i in range(1,self.nplayers+1) ]
+        if config.has_option('Game','ai_time'):
+            self.ai_time = config.getfloat('Game','ai_time')
+        else:
+            self.ai_time = None
+        if config.has_option('Game','ai_engine'):
+            self.ai_engine = config.get('Game','ai_engine')
+        else:
+            self.ai_engine = 'minimax'
+        if config.has_option('Game','ai_max_barriers'):
+            self.ai_max_barriers = config.getint('Game','ai_max_barriers')
+        else:
+            self.ai_max_barriers = 0
+        if config.has_option('Game','ai_workers'):
+            self.ai_workers = config.getint('Game','ai_workers')
+        else:
+            self.ai_workers = 1
+        if config.has_option('Game','book') and config.get('Game','book'):
+            self.book = quobook.OpeningBook(os.path.expanduser(config.get('Game','book')),
+                self.side, self.nplayers)
+        else:
+            self.book = None
+        if config.has_option('Game','record'):
+            self.record = config.get('Game','record')
+        else:
+            self.record = ''
+        if config.has_option('Game','record_interval'):
+            self.record_interval = config.getint('Game','record_interval')
+        else:
+            self.record_interval = 32
         self.cellsizex = max(2,(config.getint('UI','cellsizex')/2)*2)
         self.cellsizey = max(2,(config.getint('UI','cellsizey')/2)*2)
 
@@ -456,14 +1039,23 @@ class QuoServer:
 
         # Dictionaries of default options and values
         opt_board = {
-            'side':         9
+            'side':         9,
+            'backend':      'list',
+            'dist_cache':   16
         }
         opt_game = {
             'nplayers':     4,
             'player1_ai':   'off',
             'player2_ai':   'off',
             'player3_ai':   'off',
-            'player4_ai':   'off'
+            'player4_ai':   'off',
+            'ai_time':      5,
+            'ai_engine':    'minimax',
+            'ai_max_barriers': 0,
+            'ai_workers':   1,
+            'book':         '',
+            'record':       '',
+            'record_interval': 32
         }
         opt_ui = {
             'cellsizex':     6,
@@ -494,5 +1086,10 @@ class QuoServer:
 
 
 
-my_quoridor_server=QuoServer()
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        datefmt='%a, %d %b %Y %H:%M:%S',
+        filename=os.path.expanduser('~/.quoserver.log'))
+    my_quoridor_server=QuoServer()
 
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+"""Compact binary snapshots of the state of a ServerBoard.
+
+A snapshot holds the board side, the pawns (position, goal and hash), the
+occupied barrier slots in placement order and, optionally, the distance
+fields of the players. Everything else (the table of allowed moves, the
+free slots, the Zobrist hash, the reachability tables) is rebuilt on load,
+and the distance fields are recomputed if they were not saved. AI engines
+are not part of the state: loaded pawns have none.
+
+Layout (little endian):
+
+    header      magic "QUOS", version, flags, side, nplayers, nbarriers
+    pawns       x, y, goal, hash, for each pawn
+    barriers    slot indices, as 16-bit integers (32-bit if flags & wide)
+    dists       if flags & with_dists: the distance field of each player,
+                indexed [i][x][y], as 16-bit integers (32-bit if wide)"""
+
+import quoserver
+from quoboard import up, right, down, left, visited_or_enqueued
+import struct, array, sys
+
+magic = 'QUOS'
+version = 1
+
+# Flags
+with_dists = 1
+wide = 2
+
+header = struct.Struct('<4sBBHBH')
+pawn_record = struct.Struct('<HHB16p')
+
+class SnapshotError(Exception):
+    """Raised when a snapshot cannot be decoded."""
+    pass
+
+def to_bytes(a):
+    """Return the little-endian contents of array a"""
+    if sys.byteorder == 'big':
+        a = array.array(a.typecode, a)
+        a.byteswap()
+    return a.tostring()
+
+def from_bytes(typecode, data, offset, n):
+    """Read an array of n items from data at offset"""
+    a = array.array(typecode)
+    end = offset + n * a.itemsize
+    if end > len(data):
+        raise SnapshotError('Truncated snapshot')
+    a.fromstring(data[offset:end])
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a, end
+
+def dumps(board, dists=True):
+    """Return the snapshot of board as a string.
+
+    The distance fields are saved if dists is true; they make snapshots
+    larger, but faster to load."""
+    side = board.side
+    flags = with_dists if dists else 0
+    if len(board.slots) > 0xffff or side * side > 0x7fff:
+        flags |= wide
+    slot_code, dist_code = ('I', 'i') if flags & wide else ('H', 'h')
+
+    parts = [ header.pack(magic, version, flags, side, board.nplayers,
+        len(board.barriers)) ]
+    for p in board.pp:
+        parts.append(pawn_record.pack(p.position[0], p.position[1], p.goal, p.h))
+    parts.append(to_bytes(array.array(slot_code,
+        [ board.slots.slot_of(b) for b in board.barriers ])))
+    if dists:
+        a = array.array(dist_code)
+        for i in range(board.nplayers):
+            for column in board.player_dists(i):
+                a.extend(column)
+        parts.append(to_bytes(a))
+    return ''.join(parts)
+
+def loads(data, board_class=None):
+    """Rebuild a board (an instance of board_class, by default ServerBoard)
+    from a snapshot"""
+    if board_class is None:
+        board_class = quoserver.ServerBoard
+    if len(data) < header.size:
+        raise SnapshotError('Truncated snapshot')
+    m, v, flags, side, nplayers, nbarriers = header.unpack_from(data)
+    if m != magic:
+        raise SnapshotError('Not a board snapshot')
+    if v != version:
+        raise SnapshotError('Unsupported snapshot version %d' % v)
+    if side < 3 or nplayers not in (2, 3, 4):
+        raise SnapshotError('Invalid board: side %d, %d players' % (side, nplayers))
+    slot_code, dist_code = ('I', 'i') if flags & wide else ('H', 'h')
+
+    # The constructor would set up new pawns and compute the distances:
+    # only the plain board is initialised
+    board = board_class.__new__(board_class)
+    super(quoserver.ServerBoard, board).__init__(side)
+    board.nplayers = nplayers
+    board.pp = []
+    board.undo = []
+    offset = header.size
+    if len(data) < offset + nplayers * pawn_record.size:
+        raise SnapshotError('Truncated snapshot')
+    for i in range(nplayers):
+        x, y, goal, h = pawn_record.unpack_from(data, offset)
+        offset += pawn_record.size
+        if x >= side or y >= side or goal not in (up, right, down, left):
+            raise SnapshotError('Invalid pawn %d' % (i+1))
+        p = quoserver.Pawn(x, y, str(i+1), goal, False, i)
+        p.h = h
+        board.pp.append(p)
+        board.zobrist ^= board.zkeys.pawn[i][y*side + x]
+
+    slots, offset = from_bytes(slot_code, data, offset, nbarriers)
+    for s in slots:
+        if s >= len(board.slots) or not board.check_slot(s):
+            raise SnapshotError('Invalid barrier slot %d' % s)
+        board.add_barrier_to_map(board.slots.barriers[s])
+        board.occupy_slot(s)
+
+    if flags & with_dists:
+        a, offset = from_bytes(dist_code, data, offset, nplayers * side * side)
+        board.dists = [ board.as_field( a[(i*side + x)*side:(i*side + x+1)*side]
+            for x in range(side) ) for i in range(nplayers) ]
+        board.moves_status = [ board.as_field(
+            ( [ visited_or_enqueued if d >= 0 else 0 for d in column ] for column in dist ), 'B')
+            for dist in board.dists ]
+        board.forget_dists()
+    else:
+        board.recompute_dists()
+    return board
+
+def save(board, filename, dists=True):
+    f = open(filename, 'wb')
+    try:
+        f.write(dumps(board, dists))
+    finally:
+        f.close()
+
+def load(filename, board_class=None):
+    f = open(filename, 'rb')
+    try:
+        return loads(f.read(), board_class)
+    finally:
+        f.close()
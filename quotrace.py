@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+"""Trace recorder for the hot loops (breadth-first searches, game tree
+search).
+
+Tracing is off by default: recorder is None. The hot loops read recorder
+once, before entering the loop, and test the local copy, so that a disabled
+trace costs one test per iteration and no string formatting at all.
+
+When tracing is on, events are stored as compact tuples (name followed by
+integers) in a bounded ring buffer: only the most recent events are kept,
+and they are written out by dump."""
+
+from collections import deque
+
+# The active TraceRecorder, or None
+recorder = None
+
+class TraceRecorder:
+    """Bounded ring buffer of trace events"""
+
+    def __init__(self, size=1 << 16):
+        self.events = deque(maxlen=size)
+        # Total number of events recorded, including the dropped ones
+        self.count = 0
+
+    def record(self, *event):
+        self.events.append(event)
+        self.count += 1
+
+    def clear(self):
+        self.events.clear()
+        self.count = 0
+
+    def dump(self, f):
+        """Write the buffered events to the file object f, one per line"""
+        f.write('# %d events, last %d kept\n' % (self.count, len(self.events)))
+        for e in self.events:
+            f.write(' '.join( str(v) for v in e ) + '\n')
+
+def enable(size=1 << 16):
+    """Start tracing into a new ring buffer of the given size"""
+    global recorder
+    recorder = TraceRecorder(size)
+    return recorder
+
+def disable():
+    global recorder
+    recorder = None
+
+def dump(filename):
+    """Write the events of the active recorder to a file, if tracing is on"""
+    if recorder is not None:
+        f = open(filename, 'w')
+        try:
+            recorder.dump(f)
+        finally:
+            f.close()
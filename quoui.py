@@ -40,6 +40,9 @@ class ui_curses:
         self.cellsizey_inp=cy
         self.nplayers=npl
         self.server=server
+        # First square shown in the board window
+        self.view_x=0
+        self.view_y=0
         the_ui=self
 
         # Set up the SIGWINCH handler
@@ -66,6 +69,15 @@ class ui_curses:
             self.cellsizey -= 2
             self.board_hei = self.side * self.cellsizey + 1
 
+        # Large boards do not fit even with the smallest cells: only the
+        # view_wid x view_hei squares of the viewport are drawn
+        self.view_wid = max(min(self.side, (self.boardw_wid - 1) / self.cellsizex), 1)
+        self.view_hei = max(min(self.side, (self.boardw_hei - 1) / self.cellsizey), 1)
+        self.view_x = min(self.view_x, self.side - self.view_wid)
+        self.view_y = min(self.view_y, self.side - self.view_hei)
+        self.board_wid = self.view_wid * self.cellsizex + 1
+        self.board_hei = self.view_hei * self.cellsizey + 1
+
         self.board_ox = max((self.boardw_wid - self.board_wid) / 2, 0)
         self.board_oy = max((self.boardw_hei - self.board_hei) / 2, 0)
 
@@ -101,6 +113,42 @@ class ui_curses:
 
         self.update_win_size()
 
+    def col(self, x):
+        """Return the board window column of the left edge of square x"""
+        return self.board_ox + (x - self.view_x) * self.cellsizex
+
+    def row(self, y):
+        """Return the board window row of the top edge of square y"""
+        return self.board_oy + (y - self.view_y) * self.cellsizey
+
+    def in_view(self, xc, yc):
+        """Check if the board window position (xc,yc) shows the viewport"""
+        return self.board_ox <= xc < min(self.board_ox + self.board_wid, self.boardw_wid) and \
+            self.board_oy <= yc < min(self.board_oy + self.board_hei, self.boardw_hei)
+
+    def focus(self, x, y):
+        """Scroll the viewport so that square (x,y) is shown, centring it
+        if it was not.
+
+        Returns True if the viewport moved: the board must then be drawn
+        again."""
+        x = min(x, self.side-1)
+        y = min(y, self.side-1)
+        view_x, view_y = self.view_x, self.view_y
+        if not view_x <= x < view_x + self.view_wid:
+            view_x = min(max(x - self.view_wid/2, 0), self.side - self.view_wid)
+        if not view_y <= y < view_y + self.view_hei:
+            view_y = min(max(y - self.view_hei/2, 0), self.side - self.view_hei)
+        if (view_x, view_y) == (self.view_x, self.view_y):
+            return False
+        self.view_x, self.view_y = view_x, view_y
+        # The characters saved under the cursors belong to the old view
+        for name in ['oldp', 'oldc', 'oldbp', 'oldbc', 'oldbd', 'oldbl']:
+            if hasattr(self, name):
+                delattr(self, name)
+        self.board_win.erase()
+        return True
+
     def draw_board(self, pp, barriers):
         """Pretty-print the board using curses"""
 
@@ -118,42 +166,40 @@ class ui_curses:
 #                scr.addstr(self.board_oy+y,ox+x,' ', curses.color_pair(1) | curses.A_REVERSE )
 #                scr.addstr(self.board_oy+y,ox,' ', curses.color_pair(1) | curses.A_REVERSE )
 
-        # Squares
-        for y in range(self.cellsizey*self.side+1):
-            if y%self.cellsizey==0: continue
-            if self.board_oy+y>=self.boardw_hei: break
-            for x in range(1,self.cellsizex*self.side+1,self.cellsizex):
-                if self.board_ox+x>=self.boardw_wid: break
-                #logging.debug('%d %d %d %d %d', self.board_ox, x, self.board_oy, y, self.boardw_wid)
-                self.board_win.addnstr(self.board_oy+y, self.board_ox+x, (self.cellsizex-1)*' ', self.boardw_wid-x-self.board_ox,
-                    curses.color_pair(1) | curses.A_REVERSE )
+        # Squares of the viewport
+        for y in range(self.view_y, self.view_y+self.view_hei):
+            for yc in range(self.row(y)+1, self.row(y)+self.cellsizey):
+                if yc>=self.boardw_hei: break
+                for x in range(self.view_x, self.view_x+self.view_wid):
+                    xc = self.col(x)+1
+                    if xc>=self.boardw_wid: break
+                    self.board_win.addnstr(yc, xc, (self.cellsizex-1)*' ', self.boardw_wid-xc,
+                        curses.color_pair(1) | curses.A_REVERSE )
 
         # Pawns
         for p in pp:
-            x = self.cellsizex / 2 + p.position[0]*self.cellsizex
-            y = self.cellsizey / 2 + p.position[1]*self.cellsizey
-            if self.board_oy+y>=self.boardw_hei or self.board_ox+x>=self.boardw_wid: continue
-            self.board_win.addch(self.board_oy+y, self.board_ox+x, ord(p.symbol), curses.color_pair(3) )
+            x = self.col(p.position[0]) + self.cellsizex / 2
+            y = self.row(p.position[1]) + self.cellsizey / 2
+            if not self.in_view(x, y): continue
+            self.board_win.addch(y, x, ord(p.symbol), curses.color_pair(3) )
 
-        # Barriers
+        # Barriers, clipped to the viewport
         for b in barriers:
             p=b.node(0)
-            x = p[0]*self.cellsizex
-            y = p[1]*self.cellsizey
+            x = self.col(p[0])
+            y = self.row(p[1])
             if b.direction == right:
-                if self.board_oy+y>=self.boardw_hei: continue
                 for i in range(1,b.length*self.cellsizex):
                     x += 1
-                    if self.board_ox+x>=self.boardw_wid: break
-                    self.board_win.addch(self.board_oy+y, self.board_ox+x,
-                        ord('X'), curses.color_pair(2) | curses.A_REVERSE )
+                    if self.in_view(x, y):
+                        self.board_win.addch(y, x,
+                            ord('X'), curses.color_pair(2) | curses.A_REVERSE )
             else:
-                if self.board_ox+x>=self.boardw_wid: continue
                 for i in range(1,b.length*self.cellsizey):
                     y += 1
-                    if self.board_oy+y>=self.boardw_hei: break
-                    self.board_win.addch(self.board_oy+y, self.board_ox+x,
-                        ord('X'), curses.color_pair(2) | curses.A_REVERSE )
+                    if self.in_view(x, y):
+                        self.board_win.addch(y, x,
+                            ord('X'), curses.color_pair(2) | curses.A_REVERSE )
 
         # Arrows
 #        for x in range(self.side):
@@ -182,28 +228,29 @@ class ui_curses:
         """Draw the cursor to select the barrier position."""
 
         if hasattr(self,'oldc') and hasattr(self,'oldp'):
-            xc = self.oldp[0] * self.cellsizex
-            yc = self.oldp[1] * self.cellsizey
-            if self.board_ox+xc<self.boardw_wid and self.board_oy+yc<self.boardw_hei:
-                self.board_win.addch(self.board_oy+yc, self.board_ox+xc,
+            xc = self.col(self.oldp[0])
+            yc = self.row(self.oldp[1])
+            if self.in_view(xc, yc):
+                self.board_win.addch(yc, xc,
                     self.oldc & 255, self.oldc ^ (self.oldc & 255) )
 
         self.oldp = [x,y]
-        xc = x * self.cellsizex
-        yc = y * self.cellsizey
-        self.oldc = self.board_win.inch(self.board_oy+yc,self.board_ox+xc)
-        if self.board_ox+xc<self.boardw_wid and self.board_oy+yc<self.boardw_hei:
-            self.board_win.addch(self.board_oy+yc, self.board_ox+xc,ord('X'),
+        xc = self.col(x)
+        yc = self.row(y)
+        self.oldc = 0
+        if self.in_view(xc, yc):
+            self.oldc = self.board_win.inch(yc,xc)
+            self.board_win.addch(yc, xc,ord('X'),
                 curses.color_pair(4) | curses.A_REVERSE )
         self.board_win.refresh()
 
     def delete_old_barrier_cursor(self,refresh):
         """Delete the old cursor to select the barrier position."""
         if hasattr(self,'oldc') and hasattr(self,'oldp'):
-            xc = self.oldp[0] * self.cellsizex
-            yc = self.oldp[1] * self.cellsizey
-            if self.board_ox+xc<self.boardw_wid and self.board_oy+yc<self.boardw_hei:
-                self.board_win.addch(self.board_oy+yc, self.board_ox+xc, self.oldc & 255, self.oldc ^ (self.oldc & 255) )
+            xc = self.col(self.oldp[0])
+            yc = self.row(self.oldp[1])
+            if self.in_view(xc, yc):
+                self.board_win.addch(yc, xc, self.oldc & 255, self.oldc ^ (self.oldc & 255) )
             del self.oldp
             del self.oldc
             if refresh: self.board_win.refresh()
@@ -212,105 +259,105 @@ class ui_curses:
         """Draw a barrier."""
 
         if hasattr(self,'oldbp') and hasattr(self,'oldbd') and hasattr(self,'oldbc') and hasattr(self,'oldbl'):
-            xc = self.oldbp[0] * self.cellsizex
-            yc = self.oldbp[1] * self.cellsizey
+            xc = self.col(self.oldbp[0])
+            yc = self.row(self.oldbp[1])
             if self.oldbd == right:
                 for i in range(1,self.oldbl*self.cellsizex):
                     xc += 1
                     occ = self.oldbc.pop(0)
-                    if self.board_ox + xc < self.boardw_wid and self.board_oy + yc < self.boardw_hei:
-                        self.board_win.addch(self.board_oy+yc, self.board_ox+xc,
+                    if self.in_view(xc, yc):
+                        self.board_win.addch(yc, xc,
                             occ & 255 , occ ^ (occ & 255) )
             elif self.oldbd == down:
                 for i in range(1,self.oldbl*self.cellsizey):
                     yc += 1
                     occ = self.oldbc.pop(0)
-                    if self.board_ox+xc<self.boardw_wid and self.board_oy+yc<self.boardw_hei:
-                        self.board_win.addch(self.board_oy+yc, self.board_ox+xc,
+                    if self.in_view(xc, yc):
+                        self.board_win.addch(yc, xc,
                             occ & 255 , occ ^ (occ & 255) )
             elif self.oldbd == left:
                 for i in range(1,self.oldbl*self.cellsizex):
                     xc -= 1
                     occ = self.oldbc.pop(0)
-                    if self.board_ox+xc<self.boardw_wid and self.board_oy+yc<self.boardw_hei:
-                        self.board_win.addch(self.board_oy+yc, self.board_ox+xc,
+                    if self.in_view(xc, yc):
+                        self.board_win.addch(yc, xc,
                             occ & 255 , occ ^ (occ & 255) )
             elif self.oldbd == up:
                 for i in range(1,self.oldbl*self.cellsizey):
                     yc -= 1
                     occ = self.oldbc.pop(0)
-                    if self.board_ox+xc<self.boardw_wid and self.board_oy+yc<self.boardw_hei:
-                        self.board_win.addch(self.board_oy+yc, self.board_ox+xc,
+                    if self.in_view(xc, yc):
+                        self.board_win.addch(yc, xc,
                             occ & 255 , occ ^ (occ & 255) )
 
         self.oldbp = [x,y]
         self.oldbc = []
         self.oldbd = d
         self.oldbl = l
-        xc = x * self.cellsizex
-        yc = y * self.cellsizey
+        xc = self.col(x)
+        yc = self.row(y)
         if d == right:
             for i in range(1,l*self.cellsizex):
                 xc += 1
-                self.oldbc.append(self.board_win.inch(self.board_oy+yc,self.board_ox+xc))
-                if self.board_ox+xc<self.boardw_wid and self.board_oy+yc<self.boardw_hei:
-                    self.board_win.addch(self.board_oy+yc, self.board_ox+xc,
+                self.oldbc.append(self.board_win.inch(yc,xc) if self.in_view(xc, yc) else 0)
+                if self.in_view(xc, yc):
+                    self.board_win.addch(yc, xc,
                         ord('X'), curses.color_pair(4) | curses.A_REVERSE )
         elif d == down:
             for i in range(1,l*self.cellsizey):
                 yc += 1
-                self.oldbc.append(self.board_win.inch(self.board_oy+yc,self.board_ox+xc))
-                if self.board_ox+xc<self.boardw_wid and self.board_oy+yc<self.boardw_hei:
-                    self.board_win.addch(self.board_oy+yc, self.board_ox+xc,
+                self.oldbc.append(self.board_win.inch(yc,xc) if self.in_view(xc, yc) else 0)
+                if self.in_view(xc, yc):
+                    self.board_win.addch(yc, xc,
                         ord('X'), curses.color_pair(4) | curses.A_REVERSE )
         elif d == left:
             for i in range(1,l*self.cellsizex):
                 xc -= 1
-                self.oldbc.append(self.board_win.inch(self.board_oy+yc,self.board_ox+xc))
-                if self.board_ox+xc<self.boardw_wid and self.board_oy+yc<self.boardw_hei:
-                    self.board_win.addch(self.board_oy+yc, self.board_ox+xc,
+                self.oldbc.append(self.board_win.inch(yc,xc) if self.in_view(xc, yc) else 0)
+                if self.in_view(xc, yc):
+                    self.board_win.addch(yc, xc,
                         ord('X'), curses.color_pair(4) | curses.A_REVERSE )
         elif d== up:
             for i in range(1,l*self.cellsizey):
                 yc -= 1
-                self.oldbc.append(self.board_win.inch(self.board_oy+yc,self.board_ox+xc))
-                if self.board_ox+xc<self.boardw_wid and self.board_oy+yc<self.boardw_hei:
-                    self.board_win.addch(self.board_oy+yc, self.board_ox+xc,
+                self.oldbc.append(self.board_win.inch(yc,xc) if self.in_view(xc, yc) else 0)
+                if self.in_view(xc, yc):
+                    self.board_win.addch(yc, xc,
                         ord('X'), curses.color_pair(4) | curses.A_REVERSE )
         self.board_win.refresh()
 
     def delete_old_barrier(self,refresh):
         """Delete the old barrier."""
         if hasattr(self,'oldbp') and hasattr(self,'oldbd') and hasattr(self,'oldbc') and hasattr(self,'oldbl'):
-            xc = self.oldbp[0] * self.cellsizex
-            yc = self.oldbp[1] * self.cellsizey
+            xc = self.col(self.oldbp[0])
+            yc = self.row(self.oldbp[1])
             if self.oldbd == right:
                 for i in range(1,self.oldbl*self.cellsizex):
                     xc += 1
                     occ = self.oldbc.pop(0)
-                    if self.board_ox+xc<self.boardw_wid and self.board_oy+yc<self.boardw_hei:
-                        self.board_win.addch(self.board_oy+yc, self.board_ox+xc,
+                    if self.in_view(xc, yc):
+                        self.board_win.addch(yc, xc,
                             occ & 255 , occ ^ (occ & 255) )
             elif self.oldbd == down:
                 for i in range(1,self.oldbl*self.cellsizey):
                     yc += 1
                     occ = self.oldbc.pop(0)
-                    if self.board_ox+xc<self.boardw_wid and self.board_oy+yc<self.boardw_hei:
-                        self.board_win.addch(self.board_oy+yc, self.board_ox+xc,
+                    if self.in_view(xc, yc):
+                        self.board_win.addch(yc, xc,
                             occ & 255 , occ ^ (occ & 255) )
             elif self.oldbd == left:
                 for i in range(1,self.oldbl*self.cellsizex):
                     xc -= 1
                     occ = self.oldbc.pop(0)
-                    if self.board_ox+xc<self.boardw_wid and self.board_oy+yc<self.boardw_hei:
-                        self.board_win.addch(self.board_oy+yc, self.board_ox+xc,
+                    if self.in_view(xc, yc):
+                        self.board_win.addch(yc, xc,
                             occ & 255 , occ ^ (occ & 255) )
             elif self.oldbd == up:
                 for i in range(1,self.oldbl*self.cellsizey):
                     yc -= 1
                     occ = self.oldbc.pop(0)
-                    if self.board_ox+xc<self.boardw_wid and self.board_oy+yc<self.boardw_hei:
-                        self.board_win.addch(self.board_oy+yc, self.board_ox+xc,
+                    if self.in_view(xc, yc):
+                        self.board_win.addch(yc, xc,
                             occ & 255 , occ ^ (occ & 255) )
 
             del self.oldbp
@@ -322,50 +369,40 @@ class ui_curses:
     def warn(self):
         curses.flash()
 
-    def draw_players_win(self, pp, hactive):
+    def draw_players_win(self, pp, active):
         """Draw the player window.
 
         pp is the vector of Pawn objects.
-        hactive is the hash of the active player."""
+        active is the index of the active player."""
 
         y = 1
 
         for p in pp:
-            if hactive == p.h:
+            if active == p.seat:
                 reverse = curses.A_REVERSE
             else:
                 reverse = curses.A_NORMAL
             if p.ai:
-                prefix = "C" + p.symbol + " "
+                prefix = "C" + p.symbol + " computer"
             else:
-                prefix = "P" + p.symbol + " "
-            self.players_win.addnstr(y, 0, prefix + p.h, self.playersw_wid, reverse )
+                prefix = "P" + p.symbol + " human"
+            self.players_win.addnstr(y, 0, prefix, self.playersw_wid, reverse )
             y += 1
 
         self.players_win.refresh()
 
-    def set_thinking(self, pp, h):
+    def set_thinking(self, pp, i):
         """While AI thinks, player's symbol blinks."""
         # This should be really done with chgat, but for some reason it won't
         # run
-        y = 1
-        for p in pp:
-            if h == p.h:
-                prefix = "C" + p.symbol 
-                self.players_win.addnstr(y, 0, prefix, self.playersw_wid, curses.A_REVERSE | curses.A_BLINK )
-                break
-            y += 1
+        prefix = "C" + pp[i].symbol
+        self.players_win.addnstr(i+1, 0, prefix, self.playersw_wid, curses.A_REVERSE | curses.A_BLINK )
         self.players_win.refresh()
 
-    def unset_thinking(self, pp, h):
+    def unset_thinking(self, pp, i):
         """When AI stops thinking, player's symbol stops blinking."""
-        y = 1
-        for p in pp:
-            if h == p.h:
-                prefix = "C" + p.symbol
-                self.players_win.addnstr(y, 0, prefix, self.playersw_wid, curses.A_REVERSE )
-                break
-            y += 1
+        prefix = "C" + pp[i].symbol
+        self.players_win.addnstr(i+1, 0, prefix, self.playersw_wid, curses.A_REVERSE )
         self.players_win.refresh()
 
     def get_input(self):
@@ -384,68 +421,65 @@ class ui_curses:
         self.panel_win.refresh()
 
     def print_board_ascii(self):
-        """Pretty-print the board in ASCII.
+        """Pretty-print the viewport of the board in ASCII.
         
         Not used for the moment."""
-        side=self.side
         cellsizex=self.cellsizex
         cellsizey=self.cellsizey
-        ox=0
-        oy=0
+        x0,y0=self.view_x,self.view_y
+        wid,hei=self.view_wid,self.view_hei
+
+        image=[(cellsizex*wid+1)*' ' for y in range(cellsizey*hei+1)]
 
-        image=[(cellsizex*side+1)*' ' for y in range(cellsizey*side+1)]
+        def put(xa,ya,c):
+            if 0<=xa<=cellsizex*wid and 0<=ya<=cellsizey*hei:
+                image[ya] = image[ya][:xa] + c + image[ya][xa+1:]
 
         # Horizontal lines
-        for y in range(0,cellsizey*side,cellsizey):
-            image[y] = side * ('+' + (cellsizex-1)*'-') + '+'
-        image[cellsizey*side] = side * ('+' + (cellsizex-1)*'-') + '+'
+        for y in range(0,cellsizey*hei,cellsizey):
+            image[y] = wid * ('+' + (cellsizex-1)*'-') + '+'
+        image[cellsizey*hei] = wid * ('+' + (cellsizex-1)*'-') + '+'
 
         # Vertical lines
-        for y in range(cellsizey*side+1):
+        for y in range(cellsizey*hei+1):
             if y%cellsizey==0: continue
-            for x in range(cellsizex,cellsizex*(side+1),cellsizex):
+            for x in range(cellsizex,cellsizex*(wid+1),cellsizex):
                 image[y]=image[y][:x]+'|'+image[y][x+1:]
                 image[y]='|'+image[y][1:]
 
         # Pawns
         for p in self.serverboard.pp:
-            x = cellsizex / 2 + p.position[0]*cellsizex
-            y = cellsizey / 2 + p.position[1]*cellsizey
-            image[y] = image[y][:x] + p.symbol + image[y][x+1:]
+            put(cellsizex / 2 + (p.position[0]-x0)*cellsizex,
+                cellsizey / 2 + (p.position[1]-y0)*cellsizey, p.symbol)
 
         # Barriers
         for b in self.serverboard.barriers:
             p=b.node(0)
-            x = p[0]*cellsizex
-            y = p[1]*cellsizey
+            x = (p[0]-x0)*cellsizex
+            y = (p[1]-y0)*cellsizey
             if b.direction == right:
                 for i in range(1,b.length*cellsizex):
                     x += 1
-                    image[y] = image[y][:x] + 'X' + image[y][x+1:]
+                    put(x, y, 'X')
             else:
                 for i in range(1,b.length*cellsizey):
                     y += 1
-                    image[y] = image[y][:x] + 'X' + image[y][x+1:]
+                    put(x, y, 'X')
 
         # Arrows
-        for x in range(self.side):
-            for y in range(self.side):
-                if self.serverboard.moves[x][y] & up:
-                    xa = cellsizex / 2 + x*cellsizex
-                    ya = cellsizey / 2 + y*cellsizey - 1
-                    image[ya] = image[ya][:xa] + '^' + image[ya][xa+1:]
-                if self.serverboard.moves[x][y] & right:
-                    xa = cellsizex / 2 + x*cellsizex + 1
-                    ya = cellsizey / 2 + y*cellsizey
-                    image[ya] = image[ya][:xa] + '>' + image[ya][xa+1:]
-                if self.serverboard.moves[x][y] & down:
-                    xa = cellsizex / 2 + x*cellsizex
-                    ya = cellsizey / 2 + y*cellsizey + 1
-                    image[ya] = image[ya][:xa] + 'v' + image[ya][xa+1:]
-                if self.serverboard.moves[x][y] & left:
-                    xa = cellsizex / 2 + x*cellsizex - 1
-                    ya = cellsizey / 2 + y*cellsizey
-                    image[ya] = image[ya][:xa] + '<' + image[ya][xa+1:]
+        moves = self.serverboard.moves
+        for x in range(x0,x0+wid):
+            for y in range(y0,y0+hei):
+                xa = cellsizex / 2 + (x-x0)*cellsizex
+                ya = cellsizey / 2 + (y-y0)*cellsizey
+                if moves[x][y] & up:
+                    put(xa, ya-1, '^')
+                if moves[x][y] & right:
+                    put(xa+1, ya, '>')
+                if moves[x][y] & down:
+                    put(xa, ya+1, 'v')
+                if moves[x][y] & left:
+                    put(xa-1, ya, '<')
 
         # Do the drawing
         for line in image: print line
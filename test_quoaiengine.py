@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""Tests of the minimax engine"""
+
+import quoserver, quoaiengine
+from quoboard import pawn_move, barrier_move, up, right, down, left
+from test_quoserver import boxed_in_board, stalemate_board, legal_moves
+from test_quosnapshot import random_board
+import random, time, unittest
+
+class LegalMoveTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+
+    def check_boxed_in(self, **options):
+        board = boxed_in_board()
+        legal = legal_moves(board, 3)
+        self.assertTrue(legal)
+        ai = quoaiengine.QuoAIEngine(3, **options)
+        self.assertTrue(ai.get_move(board) in legal)
+        # The search needs a legal move at the inner nodes as well
+        self.assertTrue(board.first_legal_move(3, ai.possible_moves(board.pp[3])) is not None)
+
+    def test_pruned(self):
+        self.check_boxed_in()
+        self.check_boxed_in(max_time=0.2)
+        self.check_boxed_in(mode='maxn')
+
+    def test_max_barriers(self):
+        for max_barriers in [1, 2, 4, 8]:
+            self.check_boxed_in(max_barriers=max_barriers)
+
+    def test_max_barriers_random(self):
+        # In random positions, a legal move is returned whenever there is one
+        rng = random.Random(0)
+        for k in range(20):
+            board = quoserver.ServerBoard(5, 4, [False] * 4)
+            for n in range(rng.randrange(4, 12)):
+                moves = [ pawn_move(d) for d in [up, right, down, left] ] + \
+                    [ barrier_move(s) for s in sorted(board.free_slots) ]
+                rng.shuffle(moves)
+                m = board.first_legal_move(n % 4, moves)
+                if m is not None:
+                    board.apply_move(n % 4, m)
+                    board.forget_moves()
+            seat = rng.randrange(4)
+            legal = legal_moves(board, seat)
+            m = quoaiengine.QuoAIEngine(seat, max_barriers=1).get_move(board)
+            if legal:
+                self.assertTrue(m in legal)
+            else:
+                self.assertEqual(m, None)
+
+    def test_stalemate(self):
+        board = stalemate_board()
+        self.assertEqual(legal_moves(board, 1), [])
+        self.assertEqual(quoaiengine.QuoAIEngine(1).get_move(board), None)
+        self.assertEqual(quoaiengine.QuoAIEngine(1, max_time=0.2).get_move(board), None)
+
+class TimeBudgetTest(unittest.TestCase):
+
+    def test_hard_deadline(self):
+        # Searching all the root moves to depth 1 takes seconds here: the
+        # search must stop at the deadline, with a legal move
+        board = quoserver.ServerBoard(51, 4, [False] * 4)
+        ai = quoaiengine.QuoAIEngine(0, max_time=0.01, prune=False)
+        start = time.time()
+        m = ai.get_move(board)
+        self.assertTrue(time.time() - start < 1.)
+        self.assertTrue(board.first_legal_move(0, [m]) is not None)
+
+class ParallelTest(unittest.TestCase):
+
+    def check_positions(self, board_class, side, nplayers):
+        ai = quoaiengine.QuoAIEngine(0, workers=2)
+        try:
+            pool = None
+            for seed in range(3):
+                board = random_board(board_class, side, nplayers, seed, nmoves=4 * nplayers)
+                serial = quoaiengine.QuoAIEngine(0)
+                random.seed(seed)
+                m_serial = serial.get_move(board)
+                random.seed(seed)
+                m_parallel = ai.get_move(board)
+                # The pool is kept from one move to the next
+                self.assertTrue(pool is None or ai.pool is pool)
+                pool = ai.pool
+                if m_parallel != m_serial:
+                    # Another move with the same loss
+                    depth = len(serial.players)
+                    self.assertEqual(serial.search_root_move(m_parallel, depth, quoaiengine.infinity),
+                        serial.search_root_move(m_serial, depth, quoaiengine.infinity))
+        finally:
+            ai.close()
+        self.assertEqual(ai.pool, None)
+
+    def test_same_move(self):
+        self.check_positions(quoserver.ServerBoard, 7, 2)
+        self.check_positions(quoserver.ServerBoard, 7, 3)
+        self.check_positions(quoserver.BitServerBoard, 7, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""Tests of the opening book"""
+
+import quoserver, quobook
+from quoboard import pawn_move, barrier_move, down, left
+import os, shutil, tempfile, unittest
+
+class BookTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'book.bin')
+        self.board = quoserver.ServerBoard(7, 2, [False] * 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def positions(self):
+        """Return (board, seat, move) triples: the start position and the
+        positions after each pawn move of seat 0"""
+        board = self.board
+        entries = [ (board, 0, pawn_move(down)) ]
+        for d in [down, left]:
+            b = quoserver.ServerBoard(7, 2, [False] * 2)
+            b.apply_move(0, pawn_move(d))
+            entries.append((b, 1, barrier_move(len(entries))))
+        return entries
+
+    def write(self):
+        entries = dict( (quobook.book_key(b, seat), m) for b, seat, m in self.positions() )
+        quobook.write_book(self.filename, entries, 7, 2)
+
+    def test_round_trip(self):
+        self.write()
+        book = quobook.OpeningBook(self.filename, 7, 2)
+        try:
+            self.assertEqual((book.side, book.nplayers, len(book)), (7, 2, 3))
+            for b, seat, m in self.positions():
+                self.assertEqual(book.lookup(b, seat), m)
+            # Same position, other seat to move
+            self.assertEqual(book.lookup(self.board, 1), None)
+            # Boards of another size are not in the book
+            self.assertEqual(book.lookup(quoserver.ServerBoard(9, 2, [False] * 2), 0), None)
+            self.assertEqual(book.lookup(quoserver.ServerBoard(7, 3, [False] * 3), 0), None)
+        finally:
+            book.close()
+
+    def test_other_board(self):
+        self.write()
+        self.assertRaises(IOError, quobook.OpeningBook, self.filename, 9, 2)
+        self.assertRaises(IOError, quobook.OpeningBook, self.filename, 7, 4)
+        # Without a side or number of players, nothing is checked
+        quobook.OpeningBook(self.filename).close()
+
+    def test_corrupt(self):
+        f = open(self.filename, 'wb')
+        f.write('QUOB')
+        f.close()
+        self.assertRaises(IOError, quobook.OpeningBook, self.filename)
+
+    def test_full_table(self):
+        # Without an empty bucket, a lookup of a missing key must still end
+        f = open(self.filename, 'wb')
+        f.write(quobook.header.pack(quobook.magic, quobook.version, 2, 7, 4, 4))
+        for k in range(4):
+            f.write(quobook.bucket.pack(k + 1, 0))
+        f.close()
+        book = quobook.OpeningBook(self.filename, 7, 2)
+        try:
+            self.assertEqual(book.lookup(self.board, 0), None)
+        finally:
+            book.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+
+"""Tests of the Monte Carlo tree search engine"""
+
+import quomcts
+from test_quoserver import boxed_in_board, stalemate_board, legal_moves
+import random, unittest
+
+class LegalMoveTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+
+    def test_boxed_in(self):
+        board = boxed_in_board()
+        legal = legal_moves(board, 3)
+        self.assertTrue(legal)
+        for workers in [1, 2]:
+            m = quomcts.MCTSEngine(3, iterations=50, workers=workers).get_move(board)
+            self.assertTrue(m in legal)
+
+    def test_stalemate(self):
+        board = stalemate_board()
+        self.assertEqual(legal_moves(board, 1), [])
+        self.assertEqual(quomcts.MCTSEngine(1, iterations=50).get_move(board), None)
+
+if __name__ == '__main__':
+    unittest.main()
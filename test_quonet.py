@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+"""Tests of the network protocol, against a server running in a thread"""
+
+import quonet
+from quoboard import move_to_str
+from test_quoserver import stalemate_board, legal_moves
+import asyncore, socket, threading, unittest
+
+class Client:
+    """Blocking client connection"""
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port), 10)
+        self.f = self.sock.makefile('r')
+
+    def send(self, line):
+        self.sock.sendall(line + '\n')
+
+    def read(self):
+        return self.f.readline().strip()
+
+    def expect(self, prefix):
+        """Read lines until one starts with prefix, and return its words"""
+        while True:
+            line = self.read()
+            if not line:
+                raise AssertionError('connection closed while expecting %s' % prefix)
+            if line.startswith(prefix):
+                return line.split()
+
+    def close(self):
+        self.f.close()
+        self.sock.close()
+
+class ProtocolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = quonet.QuoNetServer('127.0.0.1', 0, 1, 0.05)
+        self.port = self.server.getsockname()[1]
+        self.running = True
+        self.thread = threading.Thread(target=self.loop)
+        self.thread.start()
+        self.clients = []
+
+    def loop(self):
+        while self.running:
+            asyncore.loop(0.05, True, count=1)
+
+    def tearDown(self):
+        for c in self.clients:
+            c.close()
+        self.running = False
+        self.thread.join()
+        self.server.pool.terminate()
+        asyncore.close_all()
+
+    def client(self):
+        c = Client(self.port)
+        self.clients.append(c)
+        return c
+
+    def new_game(self, c, side, nplayers, nai):
+        c.send('NEW %d %d %d' % (side, nplayers, nai))
+        return int(c.expect('GAME')[1])
+
+    def test_join(self):
+        a, b, c = self.client(), self.client(), self.client()
+        gid = self.new_game(a, 5, 2, 0)
+        a.send('JOIN %d' % gid)
+        token = a.expect('JOINED')[3]
+        b.send('JOIN %d' % gid)
+        b.expect('JOINED')
+        a.expect('START')
+        # A started game cannot be joined without a token, even once a seat
+        # is left
+        c.send('JOIN %d' % gid)
+        self.assertEqual(c.read(), 'ERR game already started')
+        a.close()
+        self.clients.remove(a)
+        b.send('BOARD')
+        b.expect('TURN')
+        c.send('JOIN %d' % gid)
+        self.assertEqual(c.read(), 'ERR game already started')
+        c.send('JOIN %d bad' % gid)
+        self.assertEqual(c.read(), 'ERR bad token')
+        c.send('JOIN %d %s' % (gid, token))
+        self.assertEqual(c.expect('JOINED')[1:3], [str(gid), '0'])
+        self.assertEqual(c.expect('TURN'), ['TURN', '0'])
+
+    def stalemate_game(self, c, nai):
+        """Create a 4-player game in the position of stalemate_board, where
+        seat 1 has no legal move"""
+        gid = self.new_game(c, 5, 4, nai)
+        # The server thread is idle until the next command
+        self.server.games[gid].board = stalemate_board()
+        return gid
+
+    def unblocking_move(self):
+        """Return a move of seat 0 after which seat 1 still has no legal move"""
+        for m in legal_moves(stalemate_board(), 0):
+            board = stalemate_board()
+            board.apply_move(0, m)
+            if not legal_moves(board, 1):
+                return move_to_str(m, board.slots)
+
+    def test_ai_pass(self):
+        c = self.client()
+        gid = self.stalemate_game(c, 3)
+        c.send('JOIN %d' % gid)
+        c.expect('START')
+        c.expect('TURN 0')
+        c.send('PASS')
+        self.assertEqual(c.read(), 'ERR you have a legal move')
+        c.send('MOVE ' + self.unblocking_move())
+        c.expect('MOVED 0')
+        self.assertEqual(c.read(), 'TURN 1')
+        self.assertEqual(c.read(), 'PASSED 1')
+        self.assertEqual(c.read(), 'TURN 2')
+        c.expect('MOVED 2')
+
+    def test_human_pass(self):
+        a, b = self.client(), self.client()
+        gid = self.stalemate_game(a, 2)
+        a.send('JOIN %d' % gid)
+        a.expect('JOINED')
+        b.send('JOIN %d' % gid)
+        b.expect('TURN 0')
+        b.send('PASS')
+        self.assertEqual(b.read(), 'ERR not your turn')
+        a.send('MOVE ' + self.unblocking_move())
+        b.expect('TURN 1')
+        b.send('PASS')
+        self.assertEqual(b.read(), 'PASSED 1')
+        self.assertEqual(b.read(), 'TURN 2')
+        b.expect('MOVED 2')
+
+class DrawTest(unittest.TestCase):
+
+    def test_draw(self):
+        # The game is drawn once every seat has passed in a row
+        g = quonet.Game(1, 5, 2, 0)
+        g.pass_turn(0)
+        self.assertFalse(g.finished)
+        g.play(1, legal_moves(g.board, 1)[0])
+        g.pass_turn(0)
+        self.assertFalse(g.finished)
+        g.pass_turn(1)
+        self.assertTrue(g.finished)
+        self.assertEqual(g.history[-1], (1, None))
+
+if __name__ == '__main__':
+    unittest.main()
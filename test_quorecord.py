@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""Tests of the game records"""
+
+import quoserver, quorecord, quosnapshot
+from quoboard import pawn_move, barrier_move, up, right, down, left
+from test_quosnapshot import board_state
+import random, os, shutil, tempfile, unittest
+
+class RecordTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'game.quo')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def record_game(self, interval, nmoves=40, finish=True, seed=0):
+        """Record a random game, and return the states of the board at each
+        ply"""
+        rng = random.Random(seed)
+        board = quoserver.ServerBoard(7, 3, [False] * 3)
+        recorder = quorecord.GameRecorder(self.filename, board, interval)
+        states = [ board_state(board) ]
+        for k in range(nmoves):
+            i = k % board.nplayers
+            moves = [ pawn_move(d) for d in [up, right, down, left] ] + \
+                [ barrier_move(s) for s in sorted(board.free_slots) ]
+            rng.shuffle(moves)
+            m = board.first_legal_move(i, moves)
+            board.apply_move(i, m)
+            board.forget_moves()
+            recorder.record(i, m, board)
+            states.append(board_state(board))
+        if finish:
+            recorder.finish(None)
+        else:
+            recorder.f.close()
+        return states
+
+    def check_board_at(self, interval, finish=True):
+        states = self.record_game(interval, finish=finish)
+        record = quorecord.GameRecord(self.filename)
+        try:
+            for ply, state in enumerate(states):
+                self.assertEqual(board_state(record.board_at(ply)), state)
+            self.assertEqual(len(list(record.moves())), len(states) - 1)
+            self.assertRaises(quorecord.RecordError, record.board_at, len(states))
+        finally:
+            record.close()
+
+    def test_board_at(self):
+        for interval in [1, 3, 7, 32, 100]:
+            self.check_board_at(interval)
+
+    def test_unfinished(self):
+        # Without the index, the checkpoints are found by scanning
+        self.check_board_at(5, finish=False)
+
+    def test_not_a_record(self):
+        f = open(self.filename, 'wb')
+        f.write('QUOX' + '\0' * 16)
+        f.close()
+        self.assertRaises(quorecord.RecordError, quorecord.GameRecord, self.filename)
+
+    def test_truncated_header(self):
+        f = open(self.filename, 'wb')
+        f.write('QUOR')
+        f.close()
+        self.assertRaises(quorecord.RecordError, quorecord.GameRecord, self.filename)
+
+    def corrupt(self, offset, data):
+        f = open(self.filename, 'r+b')
+        f.seek(offset)
+        f.write(data)
+        f.close()
+
+    def test_corrupt_checkpoint(self):
+        self.record_game(10)
+        # Overwrite the magic of the first snapshot
+        self.corrupt(quorecord.header.size + 1 + quorecord.checkpoint_record.size, 'XXXX')
+        record = quorecord.GameRecord(self.filename)
+        try:
+            self.assertRaises(quorecord.RecordError, record.board_at, 3)
+            self.assertEqual(board_state(record.board_at(12))['side'], 7)
+        finally:
+            record.close()
+
+    def test_illegal_move(self):
+        self.record_game(100, nmoves=3)
+        record = quorecord.GameRecord(self.filename)
+        try:
+            offset = [ o for o, t, payload in record.records() if t == 'M' ][0]
+        finally:
+            record.close()
+        # A pawn move off the board
+        self.corrupt(offset + 1, quorecord.move_record.pack(0, pawn_move(up)))
+        record = quorecord.GameRecord(self.filename)
+        try:
+            self.assertRaises(quorecord.RecordError, record.board_at, 1)
+        finally:
+            record.close()
+
+    def test_corrupt_index(self):
+        self.record_game(10)
+        record = quorecord.GameRecord(self.filename)
+        index_offset = [ o for o, t, payload in record.records() if t == 'E' ][0] + 2
+        record.close()
+        self.corrupt(index_offset, 'C')
+        record = quorecord.GameRecord(self.filename)
+        try:
+            self.assertRaises(quorecord.RecordError, record.board_at, 3)
+        finally:
+            record.close()
+
+if __name__ == '__main__':
+    unittest.main()
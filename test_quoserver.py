@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+"""Tests of ServerBoard.
+
+Run with: python -m unittest discover -p 'test_*.py'"""
+
+import quoserver
+from quoboard import pawn_move, barrier_move, up, right, down, left
+import random, array, unittest
+
+def field_lists(field):
+    """Return a table of the squares as a list of lists"""
+    return [ list(column) for column in field ]
+
+def fresh_dists(board):
+    """Return the distance fields of all the players of board, computed from
+    scratch"""
+    return [ field_lists(board.init_dist(p.goal, board.new_field(0, 'B')))
+        for p in board.pp ]
+
+def board_dists(board):
+    """Return the distance fields of all the players of board, as repaired
+    by the board"""
+    return [ field_lists(board.player_dists(i)) for i in range(board.nplayers) ]
+
+def boxed_in_board():
+    """Return a 4-player position found in self-play, where the pawn of
+    seat 3 is boxed in and every barrier cutting the shortest path of
+    another pawn would close a pawn off. Only barriers elsewhere are
+    legal."""
+    board = quoserver.ServerBoard(5, 4, [False] * 4)
+    for p, position in zip(board.pp, [(1, 0), (1, 4), (0, 1), (1, 1)]):
+        board.set_pawn_position(p, position)
+    for s in [5, 13, 22, 17, 10, 7, 20]:
+        board.place_barrier(s)
+    return board
+
+def stalemate_board():
+    """Return a 4-player position found in self-play, where the pawn of
+    seat 1 has no legal move at all"""
+    board = quoserver.ServerBoard(5, 4, [False] * 4)
+    for p, position in zip(board.pp, [(3, 2), (2, 3), (1, 3), (3, 3)]):
+        board.set_pawn_position(p, position)
+    for s in [29, 10, 20, 31, 5, 18, 0, 7, 12]:
+        board.place_barrier(s)
+    return board
+
+def legal_moves(board, seat):
+    """Return all the legal moves of seat"""
+    moves = [ pawn_move(d) for d in [up, right, down, left] ] + \
+        [ barrier_move(s) for s in sorted(board.free_slots) ]
+    return [ m for m in moves if board.first_legal_move(seat, [m]) is not None ]
+
+class DistRepairTest(unittest.TestCase):
+    """The fields repaired by lengthen_dists and shorten_dists are the ones
+    Board.init_dist computes"""
+
+    def check_barriers(self, side, nplayers, seed):
+        rng = random.Random(seed)
+        board = quoserver.ServerBoard(side, nplayers, [False] * nplayers)
+        placed = []
+        for k in range(4 * side):
+            if placed and rng.random() < 0.3:
+                board.lift_barrier(placed.pop(rng.randrange(len(placed))))
+            else:
+                s = rng.choice(sorted(board.free_slots))
+                if board.place_barrier(s):
+                    placed.append(s)
+            # Reading the fields after each change repairs them one change
+            # at a time
+            self.assertEqual(board_dists(board), fresh_dists(board))
+
+    def test_two_players(self):
+        for seed in range(5):
+            self.check_barriers(9, 2, seed)
+
+    def test_four_players(self):
+        for seed in range(5):
+            self.check_barriers(7, 4, seed)
+
+class LazyDistTest(unittest.TestCase):
+    """The fields read after any sequence of applied, restored and forgotten
+    moves are the ones Board.init_dist computes, whatever the backend"""
+
+    def check_moves(self, board_class, side, nplayers, seed, cache=None):
+        rng = random.Random(seed)
+        board = board_class(side, nplayers, [False] * nplayers)
+        board.dist_cache = cache
+        applied = []
+        for k in range(300):
+            r = rng.random()
+            if applied and r < 0.3:
+                i, m = applied.pop()
+                board.restore_move(i, m)
+            elif r < 0.35:
+                board.forget_moves()
+                applied = []
+            else:
+                i = rng.randrange(nplayers)
+                moves = [ pawn_move(d) for d in [up, right, down, left] ] + \
+                    [ barrier_move(s) for s in sorted(board.free_slots) ]
+                rng.shuffle(moves)
+                for m in moves:
+                    if board.apply_move(i, m):
+                        applied.append((i, m))
+                        break
+            # Read some of the fields only, so that changes pile up in the
+            # others
+            if rng.random() < 0.3:
+                i = rng.randrange(nplayers)
+                self.assertEqual(field_lists(board.player_dists(i)), fresh_dists(board)[i])
+        self.assertEqual(board_dists(board), fresh_dists(board))
+
+    def test_list(self):
+        for seed in range(4):
+            self.check_moves(quoserver.ServerBoard, 7, 4, seed)
+
+    def test_bits(self):
+        for seed in range(4):
+            self.check_moves(quoserver.BitServerBoard, 7, 3, seed)
+            self.check_moves(quoserver.BitServerBoard, 9, 2, seed)
+
+    def test_compact(self):
+        for seed in range(4):
+            self.check_moves(quoserver.CompactServerBoard, 9, 2, seed)
+
+    def test_cache(self):
+        # Fields found in the cache are the ones a repair gives; a small
+        # cache also exercises the evictions
+        for max_bytes in [1 << 20, 2000]:
+            cache = quoserver.DistCache(max_bytes)
+            for seed in range(4):
+                self.check_moves(quoserver.ServerBoard, 7, 4, seed, cache)
+                self.check_moves(quoserver.BitServerBoard, 7, 3, seed, cache)
+            self.assertTrue(cache.hits > 0)
+            self.assertTrue(cache.nbytes <= max_bytes)
+
+class DistCacheTest(unittest.TestCase):
+
+    def field(self, n):
+        return array.array('h', [ n ] * 100)
+
+    def test_lru(self):
+        cache = quoserver.DistCache(3 * 200)
+        for k in range(3):
+            cache.put(k, self.field(k))
+        self.assertEqual((len(cache), cache.nbytes, cache.evictions), (3, 600, 0))
+        # 0 becomes the most recently used, 1 is evicted first
+        self.assertEqual(cache.get(0), self.field(0))
+        cache.put(3, self.field(3))
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.get(1), None)
+        self.assertEqual(cache.get(0), self.field(0))
+        self.assertEqual(cache.get(2), self.field(2))
+        self.assertEqual(cache.get(3), self.field(3))
+        self.assertEqual((cache.hits, cache.misses), (4, 1))
+        cache.put(4, self.field(4))
+        self.assertEqual(cache.get(0), None)
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (4, 2, 2))
+
+    def test_overwrite(self):
+        cache = quoserver.DistCache(1000)
+        cache.put('a', self.field(1))
+        cache.put('a', array.array('h', [ 2 ] * 50))
+        self.assertEqual((len(cache), cache.nbytes), (1, 100))
+        self.assertEqual(cache.get('a'), array.array('h', [ 2 ] * 50))
+        # A field larger than the cache does not stay
+        cache.put('b', array.array('i', [ 0 ] * 1000))
+        self.assertEqual((len(cache), cache.nbytes), (0, 0))
+        cache.clear()
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (0, 0, 0))
+
+class GoalTest(unittest.TestCase):
+
+    def check_queries(self, board_class, side, seed):
+        """The A* and best-first queries of Board agree with the distance
+        fields, on random boards"""
+        rng = random.Random(seed)
+        board = board_class(side, 4, [False] * 4)
+        for k in range(side * side / 2):
+            board.place_barrier(rng.choice(sorted(board.free_slots)))
+        for i, p in enumerate(board.pp):
+            dist = board.player_dists(i)
+            for x in range(side):
+                for y in range(side):
+                    self.assertEqual(board.goal_distance((x, y), p.goal), dist[x][y])
+                    self.assertEqual(board.goal_reachable((x, y), p.goal), dist[x][y] >= 0)
+
+    def test_queries(self):
+        for seed in range(3):
+            self.check_queries(quoserver.ServerBoard, 7, seed)
+            self.check_queries(quoserver.BitServerBoard, 7, seed)
+            self.check_queries(quoserver.CompactServerBoard, 9, seed)
+
+    def test_pawn_on_goal(self):
+        board = quoserver.ServerBoard(5, 2, [False] * 2)
+        p = board.pp[0]
+        # Find a barrier leaving a change pending in the field of the pawn
+        for s in sorted(board.free_slots):
+            if board.place_barrier(s):
+                if board.pending[0]:
+                    break
+                board.lift_barrier(s)
+        board.set_pawn_position(p, (p.position[0], board.side-1))
+        self.assertTrue(board.pending[0])
+        self.assertFalse(board.is_closed_off(p))
+        self.assertEqual(board.distance_to_goal(p), 0)
+        board.player_dists(0)
+        self.assertFalse(board.pending[0])
+        self.assertFalse(board.is_closed_off(p))
+        self.assertEqual(board.distance_to_goal(p), 0)
+
+if __name__ == '__main__':
+    unittest.main()
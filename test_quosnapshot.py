@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""Tests of the board snapshots"""
+
+import quoserver, quosnapshot
+from quoboard import pawn_move, barrier_move, up, right, down, left
+import random, struct, unittest
+
+def random_board(board_class, side, nplayers, seed, nmoves=20):
+    """Return a board of board_class after nmoves random legal moves"""
+    rng = random.Random(seed)
+    board = board_class(side, nplayers, [False] * nplayers)
+    for k in range(nmoves):
+        i = k % nplayers
+        if rng.random() < 0.5:
+            moves = [ barrier_move(s) for s in sorted(board.free_slots) ]
+        else:
+            moves = [ pawn_move(d) for d in [up, right, down, left] ]
+        rng.shuffle(moves)
+        m = board.first_legal_move(i, moves)
+        if m is not None:
+            board.apply_move(i, m)
+            board.forget_moves()
+    return board
+
+def board_state(board):
+    """Return everything a snapshot must restore, in comparable form"""
+    side = board.side
+    return {
+        'side':         side,
+        'nplayers':     board.nplayers,
+        'pawns':        [ (p.position, p.goal, p.h, p.seat) for p in board.pp ],
+        'barriers':     [ board.slots.slot_of(b) for b in board.barriers ],
+        'free_slots':   sorted(board.free_slots),
+        'zobrist':      board.zobrist,
+        'moves':        [ [ board.moves[x][y] for y in range(side) ] for x in range(side) ],
+        'dists':        [ [ list(column) for column in board.player_dists(i) ]
+                            for i in range(board.nplayers) ]
+    }
+
+class RoundTripTest(unittest.TestCase):
+
+    def check_round_trip(self, board_class, side, nplayers):
+        for seed in range(3):
+            board = random_board(board_class, side, nplayers, seed)
+            for dists in [True, False]:
+                loaded = quosnapshot.loads(quosnapshot.dumps(board, dists), board_class)
+                self.assertTrue(isinstance(loaded, board_class))
+                self.assertEqual(board_state(loaded), board_state(board))
+
+    def test_list(self):
+        self.check_round_trip(quoserver.ServerBoard, 9, 2)
+        self.check_round_trip(quoserver.ServerBoard, 7, 4)
+
+    def test_bits(self):
+        self.check_round_trip(quoserver.BitServerBoard, 9, 2)
+        self.check_round_trip(quoserver.BitServerBoard, 7, 3)
+
+    def test_compact(self):
+        self.check_round_trip(quoserver.CompactServerBoard, 9, 4)
+
+    def test_wide(self):
+        # Boards with more than 0x7fff squares use 32-bit entries
+        board = random_board(quoserver.CompactServerBoard, 191, 2, 0, nmoves=6)
+        data = quosnapshot.dumps(board)
+        self.assertTrue(ord(data[5]) & quosnapshot.wide)
+        loaded = quosnapshot.loads(data, quoserver.CompactServerBoard)
+        self.assertEqual(board_state(loaded), board_state(board))
+
+class CorruptSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = quosnapshot.dumps(random_board(quoserver.ServerBoard, 9, 2, 0))
+
+    def assertCorrupt(self, data):
+        self.assertRaises(quosnapshot.SnapshotError, quosnapshot.loads, data)
+
+    def replace_header(self, **fields):
+        values = dict(zip(['magic', 'version', 'flags', 'side', 'nplayers', 'nbarriers'],
+            quosnapshot.header.unpack_from(self.data)))
+        values.update(fields)
+        return quosnapshot.header.pack(values['magic'], values['version'], values['flags'],
+            values['side'], values['nplayers'], values['nbarriers']) + \
+            self.data[quosnapshot.header.size:]
+
+    def test_truncated(self):
+        for n in [0, 3, quosnapshot.header.size - 1, quosnapshot.header.size + 5,
+                len(self.data) - 1]:
+            self.assertCorrupt(self.data[:n])
+
+    def test_bad_header(self):
+        self.assertCorrupt(self.replace_header(magic='QUOX'))
+        self.assertCorrupt(self.replace_header(version=quosnapshot.version + 1))
+        self.assertCorrupt(self.replace_header(nplayers=0))
+        self.assertCorrupt(self.replace_header(nplayers=5))
+        self.assertCorrupt(self.replace_header(side=0))
+        self.assertCorrupt(self.replace_header(nbarriers=1000))
+
+    def test_bad_pawn(self):
+        offset = quosnapshot.header.size
+        x, y, goal, h = quosnapshot.pawn_record.unpack_from(self.data, offset)
+        for record in [(x, y, 3, h), (99, y, goal, h)]:
+            self.assertCorrupt(self.data[:offset] + quosnapshot.pawn_record.pack(*record) +
+                self.data[offset + quosnapshot.pawn_record.size:])
+
+    def test_bad_slot(self):
+        offset = quosnapshot.header.size + 2 * quosnapshot.pawn_record.size
+        self.assertCorrupt(self.data[:offset] + struct.pack('<H', 0xffff) +
+            self.data[offset+2:])
+
+if __name__ == '__main__':
+    unittest.main()